@@ -127,6 +127,8 @@ pp_longitude       COMMENT    user3
 pp_depth           COMMENT    user4
 box_pos            COMMENT    user5
 box_length         COMMENT    user6
+percentile         COMMENT    user7
+num                COMMENT    user8
 =================  =========  ======
 
 .. note::
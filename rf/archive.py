@@ -0,0 +1,184 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Consolidated array archive for large collections of receiver functions.
+
+The archive consists of two files.
+The data of all traces is stored consecutively in one flat NumPy array
+(file ending ``.npy``) which can be memory-mapped.
+The header table (file ending ``.hdr``) has one line in JSON format per
+trace with the `~rf.rfstream._HEADERS` entries, the seed id, start time,
+sampling rate and the position of the trace inside the data array.
+
+New traces are appended to both files. Reading memory-maps the data array,
+the data of the returned traces are views into this array
+(copy-on-write, i.e. changes are not written back to the file).
+
+The data array has the data type of the traces written first, single
+precision (float32) if all of them are float32, otherwise double precision
+(float64). Appended traces are converted to this data type.
+Therefore float32 and float64 streams keep their data type on a round-trip,
+but float64 data appended to a float32 archive is stored with single
+precision.
+"""
+import json
+import os.path
+import struct
+
+import numpy as np
+from obspy import UTCDateTime
+
+
+_DTYPES = ('<f4', '<f8')
+_NPY_HEADER_LEN = 128
+_NPY_MAGIC = b'\x93NUMPY\x01\x00'
+_ID_HEADERS = ('network', 'station', 'location', 'channel', 'starttime',
+               'sampling_rate', 'processing')
+_UTC_HEADERS = ('starttime', 'onset', 'event_time')
+
+
+def header_table_filename(fname):
+    """Return name of header table for name of data array file."""
+    return os.path.splitext(fname)[0] + '.hdr'
+
+
+def _write_npy_header(f, size, dtype):
+    """
+    Write header of a flat npy file with fixed length.
+
+    The fixed length allows to update the shape when appending data.
+    """
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }"
+    header = (header % (dtype, size)).ljust(_NPY_HEADER_LEN - 11) + '\n'
+    f.seek(0)
+    f.write(_NPY_MAGIC + struct.pack('<H', len(header)) +
+            header.encode('latin1'))
+
+
+def _read_npy_size(f):
+    """Return size and data type of a flat npy file."""
+    f.seek(0)
+    version = np.lib.format.read_magic(f)
+    if version != (1, 0):
+        raise IOError('Unsupported npy version %s' % (version,))
+    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+    if (f.tell() != _NPY_HEADER_LEN or
+            dtype not in [np.dtype(dt) for dt in _DTYPES]):
+        raise IOError('File %s is not an rf archive' % f.name)
+    return shape[0], dtype.str
+
+
+def _archive_dtype(stream):
+    """Return float32 if the data of all traces are float32."""
+    if all(tr.data.dtype == np.float32 for tr in stream):
+        return _DTYPES[0]
+    return _DTYPES[1]
+
+
+def _json_default(obj):
+    if isinstance(obj, UTCDateTime):
+        return str(obj)
+    return obj.item()  # numpy types
+
+
+def stats2row(stats):
+    """Return dictionary with seed id, start time and rf stats entries."""
+    from rf.rfstream import _HEADERS
+    headers = _ID_HEADERS + tuple(_HEADERS)
+    return {head: stats[head] for head in headers if head in stats}
+
+
+def row2stats(row):
+    """Return dictionary with stats entries from header table row."""
+    stats = dict(row)
+    for head in _UTC_HEADERS:
+        if head in stats:
+            stats[head] = UTCDateTime(stats[head])
+    return stats
+
+
+def read_header_table(fname):
+    """
+    Read header table.
+
+    :param fname: name of header table or data array file
+    :return: list of dictionaries, one for each trace
+    """
+    if not fname.endswith('.hdr'):
+        fname = header_table_filename(fname)
+    with open(fname) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_header_table(rows, fname, mode='a'):
+    """
+    Write header table.
+
+    :param rows: list of dictionaries, one for each trace
+    :param fname: name of header table
+    :param mode: 'w' (write new table) or 'a' (append to table)
+    """
+    with open(fname, mode) as f:
+        for row in rows:
+            f.write(json.dumps(row, default=_json_default) + '\n')
+
+
+def write_npy(stream, fname, mode='w'):
+    """
+    Write stream into an archive.
+
+    :param stream: stream to write
+    :param fname: name of data array file
+    :param mode: 'w' (write new archive) or 'a' (append to archive)
+
+    The data type of a new archive is float32 if the data of all traces
+    are float32 and float64 otherwise, appended data is converted to the
+    data type of the archive.
+    """
+    hname = header_table_filename(fname)
+    if mode == 'w' or not os.path.exists(fname):
+        with open(fname, 'wb') as f:
+            _write_npy_header(f, 0, _archive_dtype(stream))
+        open(hname, 'w').close()
+    rows = []
+    with open(fname, 'r+b') as f:
+        offset, dtype = _read_npy_size(f)
+        f.seek(_NPY_HEADER_LEN + offset * np.dtype(dtype).itemsize)
+        for tr in stream:
+            data = np.require(tr.data, dtype=dtype, requirements='C')
+            f.write(data.tobytes())
+            row = stats2row(tr.stats)
+            row['offset'] = offset
+            row['npts'] = len(data)
+            rows.append(row)
+            offset += len(data)
+        f.flush()
+        _write_npy_header(f, offset, dtype)
+    write_header_table(rows, hname)
+
+
+def read_npy(fname, headonly=False):
+    """
+    Read archive into RFStream.
+
+    :param fname: name of data array file
+    :param headonly: read only the header table
+    :return: RFStream, the trace data are views into the memory-mapped
+        data array
+    """
+    from rf.rfstream import RFStream, RFTrace
+    rows = read_header_table(fname)
+    if not headonly and len(rows) > 0:
+        data = np.load(fname, mmap_mode='c')
+    traces = []
+    for row in rows:
+        stats = row2stats(row)
+        offset = stats.pop('offset')
+        npts = stats.pop('npts')
+        stats['_format'] = 'NPY'
+        if headonly:
+            tr = RFTrace(header=stats)
+            tr.stats.npts = npts
+        else:
+            tr = RFTrace(data=data[offset:offset + npts], header=stats)
+        traces.append(tr)
+    return RFStream(traces)
@@ -5,18 +5,25 @@ rf: receiver function calculation - batch command line utility
 
 import argparse
 from argparse import SUPPRESS
+import collections
+from glob import glob
+import hashlib
 from importlib import import_module
 import json
 import os
 from os.path import join
-from pkg_resources import resource_filename
+import re
 import shutil
 import sys
+import threading
 
 import numpy as np
 import obspy
+from rf.instrument import set_background, stage
 from rf.rfstream import read_rf
-from rf.util import iter_event_data, iter_event_metadata
+from rf.timing import count, count_pairs, get_timings, set_gauge
+from rf.util import (_get_event_data, _get_stations, in_shard,
+                     iter_event_data, iter_event_metadata)
 
 try:
     from tqdm import tqdm
@@ -24,6 +31,11 @@ except ImportError:
     def tqdm():
         return None
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 try:
     basestring
 except NameError:
@@ -38,15 +50,38 @@ FNAMES = {
     'SAC': join('{root}', '{network}.{station}.{location}',
                 '{network}.{station}.{location}.{channel}_'
                 '{event_time%s}.SAC' % _TF),
-    'H5': '{root}.h5'}
+    'H5': '{root}.h5',
+    'NPY': '{root}.npy'}
+_YM = join('{event_time.datetime:%Y}', '{event_time.datetime:%m}')
+SHARDED_FNAMES = dict(FNAMES, **{
+    'Q': join('{root}', '{network}.{station}.{location}', _YM,
+              '{network}.{station}.{location}_{event_time%s}.QHD' % _TF),
+    'SAC': join('{root}', '{network}.{station}.{location}', _YM,
+                '{network}.{station}.{location}.{channel}_'
+                '{event_time%s}.SAC' % _TF)})
+#: Output layouts for receiver functions of single events, the layout
+#: sharded puts the files of each station into year/month subdirectories
+#: and lists them in the file FILE_LIST_FNAME of the station directory
+LAYOUTS = {'flat': FNAMES, 'sharded': SHARDED_FNAMES}
+FILE_LIST_FNAME = join('{root}', '{network}.{station}.{location}',
+                       'files.hdr')
 STACK_FNAMES = {
     'Q': join('{root}', '{network}.{station}.{location}.QHD'),
     'SAC': join('{root}', '{network}.{station}.{location}.{channel}.SAC'),
-    'H5': '{root}.h5'}
+    'H5': '{root}.h5',
+    'NPY': '{root}.npy'}
 PROFILE_FNAMES = {
     'Q': '{root}.QHD',
     'SAC': join('{root}', 'profile_{channel[2]}_{box_pos}.SAC'),
-    'H5': '{root}.h5'}
+    'H5': '{root}.h5',
+    'NPY': '{root}.npy'}
+HK_FNAMES = join('{root}', '{network}.{station}.{location}.npz')
+SHARD_ROOT = '{root}_shard{i}of{n}'
+PIPELINE_STEPS = ('calc', 'moveout', 'stack', 'profile', 'write')
+MANIFEST_FNAMES = {'Q': join('{root}', 'manifest.json'),
+                   'SAC': join('{root}', 'manifest.json'),
+                   'H5': '{root}.manifest.json'}
+_CONFIG_SECTIONS = {'data': 'options', 'calc': 'rf', 'moveout': 'moveout'}
 PLOT_FNAMES = join('{root}', '{network}.{station}.{location}.{channel}.pdf')
 PLOT_PROFILE_FNAMES = join('{root}', 'profile_{channel[2]}.pdf')
 
@@ -74,30 +109,452 @@ def _create_dir(filename):
         os.makedirs(head)
 
 
-def write(stream, root, format, type=None):
-    """Write stream to one or more files depending on format."""
+def _get_layout(layout):
+    if layout is None:
+        layout = 'flat'
+    if layout not in LAYOUTS:
+        raise ParseError('Unknown layout: %s' % layout)
+    return LAYOUTS[layout]
+
+
+def _fnames(stream, root, format, type=None, layout=None):
+    """Return names of files written by `write()`."""
+    fname_pattern = (STACK_FNAMES if type == 'stack' else
+                     PROFILE_FNAMES if type == 'profile' else
+                     _get_layout(layout))[format.upper()]
+    if format.upper() == 'SAC':
+        return [fname_pattern.format(root=root, **tr.stats) for tr in stream]
+    return [fname_pattern.format(root=root, **stream[0].stats)]
+
+
+def write(stream, root, format, type=None, layout=None, mode='a',
+          index=None):
+    """
+    Write stream to one or more files depending on format.
+
+    :param layout: layout of receiver function files, 'flat' (default) or
+        'sharded' (SAC and Q files in year/month subdirectories of the
+        station directory, which are listed in a file list, see `LAYOUTS`)
+    :param mode: 'a' appends to an existing NPY archive, 'w' replaces it
+    :param index: list, the entries of written SAC and Q files for the
+        index of root are appended to this list (see `rf.index.append_index`)
+        instead of being appended to an existing index directly
+    """
     format = format.upper()
     if len(stream) == 0:
         return
-    fname_pattern = (STACK_FNAMES if type == 'stack' else
-                     PROFILE_FNAMES if type == 'profile' else
-                     FNAMES)[format]
-    fname = fname_pattern.format(root=root, **stream[0].stats)
+    fnames = _fnames(stream, root, format, type=type, layout=layout)
+    fname = fnames[0]
     _create_dir(fname)
     if format == 'H5':
         stream.write(fname, format, mode='a', ignore=('mseed',))
+    elif format == 'NPY':
+        stream.write(fname, format, mode=mode)
     elif format == 'Q':
         stream.write(fname, format)
     elif format == 'SAC':
-        for tr in stream:
-            fname = fname_pattern.format(root=root, **tr.stats)
+        for tr, fname in zip(stream, fnames):
             tr.write(fname, format)
+    if layout == 'sharded' and type is None and format in ('Q', 'SAC'):
+        _append_file_list(root, stream[0].stats, fnames)
+    if format in ('Q', 'SAC'):
+        from rf.index import append_index, stream_index_rows
+        rows = stream_index_rows(stream, root, fnames, format)
+        if index is None:
+            append_index(root, rows)
+        else:
+            index.extend(rows)
+
+
+#: Listed files of file lists, {path: (size of file list, set of rows)}
+_FILE_LISTS = {}
+_FILE_LISTS_LOCK = threading.Lock()
+
+
+def _append_file_list(root, stats, fnames):
+    """
+    Append files of one event to file list of station directory.
+
+    Files which are already listed are skipped. The listed files are
+    cached and read again if the size of the file list changes.
+    """
+    from rf.archive import read_header_table, write_header_table
+    fname = FILE_LIST_FNAME.format(root=root, **stats)
+    key = os.path.abspath(fname)
+    rows = [{'event_time': _event_key(stats.event_time),
+             'path': os.path.relpath(fn, root)} for fn in fnames]
+    with _FILE_LISTS_LOCK:
+        size = os.path.getsize(fname) if os.path.exists(fname) else 0
+        entry = _FILE_LISTS.get(key)
+        if entry is None or entry[0] != size:
+            listed = set()
+            if size > 0:
+                listed = set((row['event_time'], row['path'])
+                             for row in read_header_table(fname))
+        else:
+            listed = entry[1]
+        rows = [row for row in rows
+                if (row['event_time'], row['path']) not in listed]
+        if len(rows) > 0:
+            write_header_table(rows, fname)
+            listed.update((row['event_time'], row['path']) for row in rows)
+            size = os.path.getsize(fname)
+        _FILE_LISTS[key] = (size, listed)
+
+
+def _read_file_list(root, meta):
+    """
+    Return files listed in file list of station directory.
+
+    :return: ordered dictionary {event key: list of paths relative to root}
+        or None if the station directory has no file list
+    """
+    from rf.archive import read_header_table
+    fname = FILE_LIST_FNAME.format(root=root, **meta)
+    if not os.path.exists(fname):
+        return
+    files = collections.OrderedDict()
+    for row in read_header_table(fname):
+        paths = files.setdefault(row['event_time'], [])
+        if row['path'] not in paths:
+            paths.append(row['path'])
+    return files
+
+
+#: Versions of obspyh5 (major.minor) whose file layout is mirrored by
+#: `Writer` to keep H5 files open, other versions use obspyh5.writeh5
+H5_KEEP_OPEN_VERSIONS = ('0.6',)
+
+
+def _h5_keep_open(version):
+    return '.'.join(version.split('.')[:2]) in H5_KEEP_OPEN_VERSIONS
+
+
+class Writer(object):
+
+    """
+    Write streams to one or more files depending on format.
+
+    The streams are buffered and written in batches of at least buffer
+    traces. H5 files are kept open until the writer is closed, the index of
+    the H5 file is set only once (for obspyh5 versions in
+    `H5_KEEP_OPEN_VERSIONS`, otherwise the file is opened for each batch).
+    The entries for an existing index of the directory (see `rf.index`) are
+    appended once per batch. Streams can be written from several threads.
+    Use the writer as a context manager or call `close()` after the last
+    stream.
+
+    :param root: directory of files (SAC, Q) or basename of file (H5, NPY)
+    :param format: file format
+    :param type: None, 'stack' or 'profile', see `write()`
+    :param buffer: number of buffered traces
+    :param override: behavior for traces already existing in the H5 file,
+        see `obspyh5.writeh5()`
+    :param layout: layout of receiver function files, see `write()`
+    :param mode: 'w' replaces an existing NPY archive with the first
+        written streams, 'a' appends to it
+    """
+
+    def __init__(self, root, format, type=None, buffer=100, override='warn',
+                 layout=None, mode='a'):
+        self.root = root
+        self.format = format.upper()
+        self.type = type
+        self.buffer = buffer
+        self.override = override
+        self.layout = layout
+        self.mode = mode
+        self._streams = []
+        self._callbacks = []
+        self._ntraces = 0
+        self._index = []
+        self._h5 = None
+        self._lock = threading.Lock()
+
+    def write(self, stream, callback=None):
+        """
+        Buffer stream and flush the buffer if it is full.
+
+        :param callback: function called after the stream was written
+        """
+        if len(stream) == 0:
+            return
+        with self._lock:
+            self._streams.append(stream)
+            if callback is not None:
+                self._callbacks.append(callback)
+            self._ntraces += len(stream)
+            if self._ntraces >= self.buffer:
+                self._flush()
+
+    def flush(self):
+        """Write all buffered streams."""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """Write all buffered streams and close open files."""
+        with self._lock:
+            self._flush()
+            if self._h5 is not None:
+                self._h5.close()
+                self._h5 = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _flush(self):
+        streams = self._streams
+        callbacks = self._callbacks
+        self._streams = []
+        self._callbacks = []
+        self._ntraces = 0
+        if len(streams) == 0:
+            return
+        if get_timings() is not None:
+            count('written_bytes', sum(tr.data.nbytes for stream in streams
+                                       for tr in stream))
+        with stage('write'):
+            if self.format == 'H5':
+                self._write_h5(streams)
+            elif self.format == 'NPY':
+                # append all buffered traces to the archive at once
+                stream = streams[0].__class__(
+                    [tr for stream in streams for tr in stream])
+                write(stream, self.root, self.format, type=self.type,
+                      mode=self.mode)
+                self.mode = 'a'
+            else:
+                for stream in streams:
+                    write(stream, self.root, self.format, type=self.type,
+                          layout=self.layout, index=self._index)
+                from rf.index import append_index
+                append_index(self.root, self._index)
+                self._index = []
+        for callback in callbacks:
+            callback()
+
+    def _write_h5(self, streams):
+        import obspyh5
+        if not _h5_keep_open(obspyh5.__version__):
+            # write with the public interface, the file is opened per batch
+            stream = streams[0].__class__(
+                [tr for stream in streams for tr in stream])
+            fname = FNAMES['H5'].format(root=self.root)
+            _create_dir(fname)
+            stream.write(fname, 'H5', mode='a', ignore=('mseed',),
+                         override=self.override)
+            return
+        # mirrors obspyh5.writeh5 but keeps the file open, the index is
+        # stored in the file and used by obspyh5.trace2group
+        if self._h5 is None:
+            import h5py
+            from rf.rfstream import _H5INDEX
+            fname = FNAMES['H5'].format(root=self.root)
+            _create_dir(fname)
+            f = self._h5 = h5py.File(fname, 'a', libver='earliest')
+            f.attrs['file_format'] = 'obspyh5'
+            f.attrs['version'] = obspyh5.__version__
+            index = streams[0].type
+            if index is None and 'event_time' in streams[0][0].stats:
+                index = 'rf'
+            if 'index' not in f.attrs and index in _H5INDEX:
+                # otherwise trace2group sets the default index of obspyh5
+                f.attrs['index'] = _H5INDEX[index]
+            if 'offset_trc_num' not in f.attrs:
+                f.attrs['offset_trc_num'] = 0
+        f = self._h5
+        trc_num = f.attrs['offset_trc_num']
+        group = f.require_group('/')
+        for stream in streams:
+            for tr in stream:
+                obspyh5.trace2group(tr, group, override=self.override,
+                                    ignore=('mseed',), trc_num=trc_num)
+                trc_num += 1
+        f.attrs['offset_trc_num'] = trc_num
+        f.flush()
+
+
+class AsyncWriter(Writer):
+
+    """
+    Writer writing the streams in a background thread.
+
+    The streams are passed to the writer thread by a queue of maximal size
+    maxsize. `write()` blocks while the queue is full. An exception raised
+    in the writer thread is raised again by the next call to `write()` or
+    by `close()`.
+    Other parameters are the same as for `Writer`.
+
+    :param verbose: print a message if streams are still waiting to be
+        written when the writer is closed
+    """
+
+    def __init__(self, root, format, type=None, buffer=100, override='warn',
+                 layout=None, mode='a', maxsize=10, verbose=False):
+        super(AsyncWriter, self).__init__(root, format, type=type,
+                                          buffer=buffer, override=override,
+                                          layout=layout, mode=mode)
+        self.verbose = verbose
+        self._queue = queue.Queue(maxsize)
+        set_gauge('write', self._queue.qsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        set_background()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is None:
+                try:
+                    Writer.write(self, *item)
+                except Exception as ex:
+                    # keep draining the queue, the producer must not block
+                    self._error = ex
+
+    def _raise(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def write(self, stream, callback=None):
+        """Put stream into the queue of the writer thread."""
+        self._raise()
+        if len(stream) > 0:
+            self._queue.put((stream, callback))
+
+    def close(self):
+        """Wait for the writer thread, write buffered streams and close."""
+        try:
+            if self._thread is not None:
+                if self.verbose and not self._queue.empty():
+                    msg = 'write remaining %d streams\n'
+                    sys.stderr.write(msg % self._queue.qsize())
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+            self._raise()
+        finally:
+            super(AsyncWriter, self).close()
+
+
+def _event_key(event_time):
+    """Return event time with the precision used in file names."""
+    return ('{%s}' % _TF).format(event_time)
+
+
+def _iter_archive_data(events, inventory, pin, pbar=None, shard=None):
+    """
+    Read archive once and yield streams grouped by event and station.
+
+    Traces appended again to the archive (e.g. by incremental runs) replace
+    the earlier traces with the same id and event time.
+    """
+    stream = read_rf(FNAMES['NPY'].format(root=pin), 'NPY')
+    groups = collections.defaultdict(collections.OrderedDict)
+    for tr in stream:
+        st = tr.stats
+        key = (st.network, st.station, st.location)
+        if events is not None:
+            if 'event_time' not in st:
+                continue
+            key = key + (_event_key(st.event_time),)
+        trkey = (tr.id, str(st.get('event_time', st.starttime)))
+        groups[key].pop(trkey, None)
+        groups[key][trkey] = tr
+    for meta in iter_event_metadata(events, inventory, pbar=pbar,
+                                    shard=shard):
+        key = (meta['network'], meta['station'], meta['location'])
+        if events is not None:
+            key = key + (_event_key(meta['event_time']),)
+        traces = groups.pop(key, None)
+        if traces:
+            yield stream.__class__(list(traces.values()))
+
+
+def _glob_pattern(root, format, layout=None):
+    """Return glob expression matching all files written with format."""
+    return _get_layout(layout)[format].format(
+        root=root, network='*', station='*', location='*', channel='*',
+        event_time=_DummyUTC())
+
+
+def _iter_indexed_data(events, inventory, pin, format, pbar=None,
+                       shard=None):
+    """Yield streams of files listed in index, no other files are opened."""
+    from rf.index import read_index, read_indexed
+    groups = collections.defaultdict(list)
+    for row in read_index(pin):
+        key = (row['network'], row['station'], row['location'])
+        if events is not None:
+            key = key + (_event_key(obspy.UTCDateTime(row['event_time'])),)
+        groups[key].append(row)
+    for meta in iter_event_metadata(events, inventory, pbar=pbar,
+                                    shard=shard):
+        key = (meta['network'], meta['station'], meta['location'])
+        if events is not None:
+            key = key + (_event_key(meta['event_time']),)
+        rows = groups.pop(key, None)
+        if rows:
+            yield read_indexed(rows, pin, format)
 
 
 def iter_event_processed_data(events, inventory, pin, format,
-                              yield_traces=False, pbar=None):
-    """Iterator yielding streams or traces which are read from disc."""
-    for meta in iter_event_metadata(events, inventory, pbar=pbar):
+                              yield_traces=False, pbar=None, shard=None):
+    """
+    Iterator yielding streams or traces which are read from disc.
+
+    If the directory contains an index (see `.index`), only the files listed
+    in the index are read. The index is updated when files are written
+    into the directory (see `write()`).
+    If shard is given, only pairs of events and stations of the shard are
+    read (see `~rf.util.in_shard()`).
+    If a station directory contains a file list (layout sharded, see
+    `write()`), the files are looked up in the file list, otherwise the
+    file names of the flat layout are used. Directories are not listed in
+    both cases, except for the SAC channels of the flat layout and
+    for reading all events of a station of the flat layout.
+    """
+    from rf.index import index_filename
+    if format == 'NPY' or (format in ('Q', 'SAC') and
+                           os.path.exists(index_filename(pin))):
+        if format == 'NPY':
+            iter_ = _iter_archive_data(events, inventory, pin, pbar=pbar,
+                                       shard=shard)
+        else:
+            iter_ = _iter_indexed_data(events, inventory, pin, format,
+                                       pbar=pbar, shard=shard)
+        for stream in iter_:
+            if yield_traces:
+                for tr in stream:
+                    yield tr
+            else:
+                yield stream
+        return
+    file_lists = {}
+    for meta in iter_event_metadata(events, inventory, pbar=pbar,
+                                    shard=shard):
+        paths = None
+        if format in ('Q', 'SAC'):
+            key = (meta['network'], meta['station'], meta['location'])
+            if key not in file_lists:
+                file_lists[key] = _read_file_list(pin, meta)
+            files = file_lists[key]
+            if files is not None:
+                if 'event_time' in meta:
+                    paths = files.get(_event_key(meta['event_time']), [])
+                else:
+                    paths = [p for ps in files.values() for p in ps]
+                if len(paths) == 0:
+                    continue
         meta['channel'] = '???'
         if 'event_time' not in meta and format != 'H5':
             meta['event_time'] = _DummyUTC()
@@ -107,7 +564,12 @@ def iter_event_processed_data(events, inventory, pin, format,
             meta.pop('channel')
             kwargs['readonly'] = meta
         try:
-            stream = read_rf(fname, format, **kwargs)
+            if paths is None:
+                stream = read_rf(fname, format, **kwargs)
+            else:
+                from rf.rfstream import RFStream
+                stream = sum((read_rf(join(pin, p), format) for p in paths),
+                             RFStream())
         except:
             pass
         else:
@@ -123,6 +585,61 @@ def _iter_profile(pin, format):
     yield read_rf(fname)
 
 
+def _parse_shard(shard):
+    """Return tuple (i, n) for string 'i/n'."""
+    try:
+        i, n = map(int, shard.split('/'))
+        assert 1 <= i <= n
+    except (ValueError, AssertionError):
+        msg = "shard has to be given as 'i/n' with 1 <= i <= n, not '%s'"
+        raise ParseError(msg % shard)
+    return i, n
+
+
+def merge(root, path_out, format):
+    """
+    Merge files written by the shards of a command.
+
+    Receiver functions and stacks are combined into one file (H5, NPY),
+    profiles are combined with `~rf.profile.merge_profiles()`.
+
+    :param root: output directory or basename of the sharded command
+    :param path_out: output directory or output file basename
+    :param format: file format
+    """
+    from rf.profile import merge_profiles
+    from rf.rfstream import RFStream
+    format = format.upper()
+    pattern = SHARD_ROOT.format(root=root, i='*', n='*')
+    shards = {}
+    for fname in glob(pattern + '*'):
+        if not os.path.isdir(fname):
+            fname = os.path.splitext(fname)[0]
+        match = re.search(r'_shard(\d+)of(\d+)$', fname)
+        if match:
+            shards[fname] = tuple(map(int, match.groups()))
+    if len(shards) == 0:
+        raise ParseError('No shards found for %s' % root)
+    ns = set(n for _, n in shards.values())
+    found = set(i for i, _ in shards.values())
+    if len(ns) != 1 or found != set(range(1, max(ns) + 1)):
+        raise ParseError('Shards of %s are incomplete' % root)
+    stream = RFStream()
+    for fname in sorted(shards, key=shards.get):
+        if format == 'SAC':
+            fname = join(fname, '*.SAC')
+        else:
+            fname = fname + {'H5': '.h5', 'NPY': '.npy', 'Q': '.QHD'}[format]
+        stream.extend(read_rf(fname, format))
+    type_ = None
+    if len(stream) > 0 and all(tr.stats.get('type') == 'profile'
+                               for tr in stream):
+        stream = merge_profiles(stream)
+        type_ = 'profile'
+    with Writer(path_out, format, type=type_, mode='w') as writer:
+        writer.write(stream)
+
+
 def load_func(modulename, funcname):
     """Load and return function from Python module."""
     sys.path.append(os.path.curdir)
@@ -188,11 +705,15 @@ class ParseError(Exception):
     pass
 
 
-def run(command, conf=None, tutorial=False, **kw):
+def run(command, conf=None, tutorial=False, synthetic=None, seed=0, **kw):
     """Create example configuration file and tutorial or load config.
 
     After that call `run_commands`.
     """
+    if command == 'serve':
+        from rf.serve import serve
+        serve(**kw)
+        return
     if command == 'create':
         if conf is None:
             conf = 'conf.json'
@@ -205,9 +726,12 @@ def run(command, conf=None, tutorial=False, **kw):
             srcs.extend(example_files)
             for src in example_files:
                 dests.append(os.path.join(dest_dir, src))
+        from pkg_resources import resource_filename
         for src, dest in zip(srcs, dests):
             src = resource_filename('rf', 'example/%s' % src)
             shutil.copyfile(src, dest)
+        if synthetic:
+            _create_synthetic(conf, synthetic[0], synthetic[1], seed=seed)
         return
     # Load configuration
     if conf in ('None', 'none', 'null', ''):
@@ -229,16 +753,89 @@ def run(command, conf=None, tutorial=False, **kw):
     run_commands(command, **kw)
 
 
-DICT_OPTIONS = ['client_options', 'options', 'rf', 'moveout',
-                'boxbins', 'boxes', 'profile', 'plot', 'plot_profile']
+def _create_synthetic(conf, nevents, nstations, seed=0):
+    """Create synthetic dataset and point configuration file to it."""
+    from rf.synthetic_dataset import create_synthetic_dataset
+    with open(conf) as f:
+        text = f.read()
+    for old, new in (
+            ('"example_events.xml"', '"synthetic_events.xml"'),
+            ('"example_inventory.xml"', '"synthetic_inventory.xml"'),
+            ('"data": "example_data.mseed"', '"data": "filesystem.sds"'),
+            ('{"user": "name@insitution.com"}',
+             '{"sds_root": "synthetic_data"}')):
+        if old not in text:
+            msg = 'Option %s not found in configuration file %s'
+            raise ParseError(msg % (old, conf))
+        text = text.replace(old, new)
+    path = os.path.dirname(conf) or '.'
+    create_synthetic_dataset(nevents, nstations, path=path, seed=seed)
+    with open(conf, 'w') as f:
+        f.write(text)
+
+
+DICT_OPTIONS = ['client_options', 'options', 'rf', 'moveout', 'stack',
+                'boxbins', 'boxes', 'profile', 'hk', 'plot', 'plot_profile']
 
 
 def run_commands(command, commands=(), events=None, inventory=None,
                  objects=None, get_waveforms=None, data=None, plugin=None,
                  phase=None, moveout_phase=None,
                  path_in=None, path_out=None, format='Q',
-                 newformat=None, **kw):
-    """Load files, apply commands and write result files."""
+                 newformat=None, jobs=1, shard=None, pipeline=None,
+                 incremental=False, timing=None, metrics=None,
+                 metrics_interval=60, pair_cache=None, plan_json=None,
+                 timing_report=None, layout=None, progress=None, **kw):
+    """Load files, apply commands and write result files.
+
+    If timing is set, wall time and number of calls of the processing stages
+    are measured, a summary table is printed and a report in JSON format
+    is written to the file timing (timing.json for timing=True,
+    see `rf.timing`).
+    If metrics is set, the metrics are written to this file every
+    metrics_interval seconds in the text format of Prometheus.
+    If pair_cache is set, the results of rfstats for the commands data and
+    pipeline are stored in a table in this directory and reused by later
+    runs (see `rf.pairs`).
+    The command plan prints the plan of the command data or pipeline given
+    in commands and writes it to the file plan_json (see `rf.plan`).
+    The runtime is estimated from the timing report timing_report
+    (default: timing.json if it exists).
+    If layout is 'sharded', receiver functions of single events in SAC and
+    Q format are written into year/month subdirectories of the station
+    directories and listed in a file list of the station directory (see
+    `write()`). Files written with both layouts are read without setting
+    this option.
+    progress is a function returning progressbars (default: tqdm), see
+    `rf.serve`.
+    """
+    if timing or metrics:
+        from rf.timing import MetricsFile, start_timing, stop_timing
+        timings = start_timing()
+        if metrics:
+            metrics_file = MetricsFile(timings, metrics, metrics_interval)
+        try:
+            run_commands(
+                command, commands=commands, events=events,
+                inventory=inventory, objects=objects,
+                get_waveforms=get_waveforms, data=data, plugin=plugin,
+                phase=phase, moveout_phase=moveout_phase, path_in=path_in,
+                path_out=path_out, format=format, newformat=newformat,
+                jobs=jobs, shard=shard, pipeline=pipeline,
+                incremental=incremental, pair_cache=pair_cache,
+                plan_json=plan_json, timing_report=timing_report,
+                layout=layout, progress=progress, **kw)
+        finally:
+            stop_timing()
+            if metrics:
+                metrics_file.close()
+        if timing:
+            print(timings.table())
+            timings.write('timing.json' if timing is True else timing)
+        return
+    custom_get_waveforms = get_waveforms
+    if progress is None:
+        progress = tqdm
     for opt in kw:
         if opt not in DICT_OPTIONS:
             raise ParseError('Unknown config option: %s' % opt)
@@ -264,13 +861,45 @@ def run_commands(command, commands=(), events=None, inventory=None,
     except:
         raise ParseError('calc or moveout command given more than once')
 
+    if isinstance(shard, basestring):
+        shard = _parse_shard(shard)
+    if command == 'pipeline':
+        if pipeline is None:
+            pipeline = ('calc', 'moveout', 'stack', 'profile')
+        for step in pipeline:
+            if step not in PIPELINE_STEPS:
+                raise ParseError('Unknown pipeline step: %s' % step)
+        if shard is not None:
+            raise ParseError('pipeline does not support option shard')
+    if incremental and command in ('data', 'calc', 'moveout', 'stack',
+                                   'profile'):
+        if format not in MANIFEST_FNAMES:
+            msg = 'option incremental is not supported for format %s'
+            raise ParseError(msg % format)
+        if command == 'data' and jobs > 1:
+            msg = 'option incremental is not supported for data with jobs'
+            raise ParseError(msg)
+    else:
+        incremental = False
+    if shard is not None and (
+            command == 'profile' or
+            command in ('data', 'calc', 'moveout', 'convert', 'stack') and
+            (newformat or format) in ('H5', 'NPY')):
+        # shards write into separate files, combine them with merge command
+        path_out = SHARD_ROOT.format(root=path_out, i=shard[0], n=shard[1])
+    if command == 'merge':
+        merge(path_in, path_out, format)
+        return
+    if command == 'index':
+        from rf.index import build_index
+        build_index(path_in, _glob_pattern(path_in, format, layout), format)
+        return
     # Read events and inventory
     try:
-        if command in ('stack', 'plot'):
+        if command in ('stack', 'plot', 'hk'):
             events = None
         elif command != 'print' or objects[0] == 'events':
-            if (not isinstance(events, obspy.Catalog) or
-                    not isinstance(events, list) or
+            if (not isinstance(events, (obspy.Catalog, list)) or
                     (len(events) == 2 and isinstance(events[0], basestring))):
                 if isinstance(events, basestring):
                     format_ = None
@@ -289,8 +918,12 @@ def run_commands(command, commands=(), events=None, inventory=None,
     except:
         print('cannot read events or stations')
         return
+    if command == 'plan':
+        _plan(commands, events, inventory, format, jobs, shard, pipeline,
+              pair_cache, plan_json, timing_report, kw)
+        return
     # Initialize get_waveforms
-    if command == 'data':
+    if command in ('data', 'pipeline'):
         try:
             # Initialize get_waveforms
             if get_waveforms is None:
@@ -309,23 +942,37 @@ def run_commands(command, commands=(), events=None, inventory=None,
             print(inventory)
         else:
             from rf.rfstream import RFStream
-            stream = sum((read_rf(fname) for fname in objects), RFStream())
+            stream = sum((read_rf(fname, headonly='lazy')
+                          for fname in objects), RFStream())
             print(stream.__str__(True))
         return
+    # Calculate missing pairs of persistent rfstats table
+    pairs = None
+    if pair_cache and command in ('data', 'pipeline'):
+        pairs = _pair_table(events, inventory, pair_cache, kw['options'])
+        pairs.compute(pbar=progress(), shard=shard)
     # Select appropriate iterator
-    if command == 'data':
-        iter_ = iter_event_data(events, inventory, get_waveforms, pbar=tqdm(),
+    if command in ('data', 'pipeline') and jobs > 1:
+        iter_ = _iter_event_tasks(events, inventory, pbar=progress(),
+                                  shard=shard)
+    elif command in ('data', 'pipeline'):
+        iter_ = iter_event_data(events, inventory, get_waveforms,
+                                pbar=progress(), shard=shard, pairs=pairs,
                                 **kw['options'])
     elif command == 'plot-profile':
         iter_ = _iter_profile(path_in, format)
     else:
         yt = command == 'profile'
         iter_ = iter_event_processed_data(
-            events, inventory, path_in, format, pbar=tqdm(), yield_traces=yt)
-    # Run all commands
+            events, inventory, path_in, format, pbar=progress(),
+            yield_traces=yt, shard=shard)
+    # Run all commands, report pending output only on a terminal
+    verbose = sys.stderr.isatty()
     if command == 'convert':
-        for stream in iter_:
-            write(stream, path_out, newformat)
+        with AsyncWriter(path_out, newformat, layout=layout, mode='w',
+                         verbose=verbose) as writer:
+            for stream in iter_:
+                writer.write(stream)
     elif command == 'plot':
         for stream in iter_:
             channels = set(tr.stats.channel for tr in stream)
@@ -345,27 +992,462 @@ def run_commands(command, commands=(), events=None, inventory=None,
                 _create_dir(fname)
                 st2.plot_profile(fname, **kw['plot_profile'])
     elif command == 'stack':
+        if incremental:
+            manifest = _Manifest(path_out, format, shard=shard)
+            iter_ = manifest.filter(iter_, _station_key, kw['stack'])
+        override = 'ignore' if incremental else 'warn'
+        mode = 'a' if incremental else 'w'
+        with AsyncWriter(path_out, format, type='stack', override=override,
+                         mode=mode, verbose=verbose) as writer:
+            for stream in iter_:
+                stack = stream.stack(**kw['stack'])
+                callback = None
+                if incremental and len(stack) > 0:
+                    # file names before the writer thread changes headers
+                    callback = manifest.callback(_station_key(stream), _fnames(
+                        stack, path_out, format, type='stack'))
+                writer.write(stack, callback=callback)
+        if incremental:
+            manifest.save()
+    elif command == 'hk':
         for stream in iter_:
-            stack = stream.stack()
-            write(stack, path_out, format, type='stack')
+            stream = stream.select(component='Q') + stream.select(
+                component='R')
+            if len(stream) == 0:
+                continue
+            result = stream.hk_stack(**kw['hk'])
+            fname = HK_FNAMES.format(root=path_out, **stream[0].stats)
+            _create_dir(fname)
+            np.savez(fname, **result)
     elif command == 'profile':
         from rf.profile import get_profile_boxes, profile
+        if incremental:
+            # the profile is up to date if the manifest of the input and the
+            # configuration did not change
+            manifest = _Manifest(path_out, format, shard=shard)
+            inputs = _Manifest(path_in, format).entries
+            config = {'boxes': kw['boxes'], 'profile': kw['profile'],
+                      'inputs': inputs}
+            digest = _digest(config)
+            if len(inputs) > 0 and manifest.current('profile', digest):
+                return
         boxx = get_profile_boxes(**kw['boxes'])
         prof = profile(iter_, boxx, **kw['profile'])
-        write(prof, path_out, format, type='profile')
+        write(prof, path_out, format, type='profile', mode='w')
+        if incremental and len(inputs) > 0 and len(prof) > 0:
+            manifest.done('profile', _fnames(prof, path_out, format,
+                                             type='profile'), digest=digest)
+            manifest.save()
+    elif command == 'pipeline':
+        commands = ['data'] + [step for step in ('calc', 'moveout')
+                               if step in pipeline]
+        if jobs > 1:
+            initargs = (commands, kw, inventory, data, plugin,
+                        custom_get_waveforms, get_timings() is not None,
+                        pairs)
+            iter_ = _iter_parallel(iter_, jobs, initargs)
+        else:
+            iter_ = (_apply_commands(stream, commands, kw)
+                     for stream in iter_)
+        iter_ = count_pairs(iter_)
+        run_pipeline(iter_, pipeline, path_out, format, kw, verbose=verbose,
+                     layout=layout)
     else:
         commands = [command] + list(commands)
+        if incremental:
+            manifest = _Manifest(path_out, format, shard=shard)
+            config = {'commands': commands}
+            for c in commands:
+                config[_CONFIG_SECTIONS[c]] = kw[_CONFIG_SECTIONS[c]]
+            iter_ = manifest.filter(iter_, _pair_key, config)
+        if jobs > 1:
+            initargs = (commands, kw, inventory, data, plugin,
+                        custom_get_waveforms, get_timings() is not None,
+                        pairs)
+            iter_ = _iter_parallel(iter_, jobs, initargs)
+        else:
+            iter_ = (_apply_commands(stream, commands, kw)
+                     for stream in iter_)
+        iter_ = count_pairs(iter_)
+        override = 'ignore' if incremental else 'warn'
+        mode = 'a' if incremental else 'w'
+        with AsyncWriter(path_out, format, override=override, layout=layout,
+                         mode=mode, verbose=verbose) as writer:
+            for stream in iter_:
+                callback = None
+                if incremental:
+                    # file names before the writer thread changes headers
+                    callback = manifest.callback(_pair_key(stream), _fnames(
+                        stream, path_out, format, layout=layout))
+                writer.write(stream, callback=callback)
+        if incremental:
+            manifest.save()
+
+
+def _plan(commands, events, inventory, format, jobs, shard, pipeline,
+          pair_cache, plan_json, timing_report, kw):
+    """Print plan of command data or pipeline and write it to JSON file."""
+    from rf.plan import format_plan, plan
+    if len(commands) == 0 or commands[0] not in ('data', 'pipeline'):
+        raise ParseError('plan needs command data or pipeline')
+    command = commands[0]
+    if command == 'pipeline':
+        commands = pipeline or ('calc', 'moveout', 'stack', 'profile')
+    else:
+        commands = commands[1:]
+    pairs = None
+    if pair_cache:
+        pairs = _pair_table(events, inventory, pair_cache, kw['options'])
+    if timing_report is None and os.path.exists('timing.json'):
+        timing_report = 'timing.json'
+    result = plan(command, events, inventory, commands=commands,
+                  format=format, options=kw['options'], rf=kw['rf'],
+                  jobs=jobs, shard=shard, pairs=pairs, timing=timing_report)
+    print(format_plan(result))
+    if plan_json:
+        with open(plan_json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+def _pair_table(events, inventory, path, options):
+    """Return `rf.pairs.PairTable` for the rfstats options of data."""
+    from rf.pairs import PairTable
+    options = {k: v for k, v in options.items()
+               if k not in ('request_window', 'pad')}
+    return PairTable(events, inventory, path, **options)
+
+
+def _digest(config, stream=()):
+    """Return hash of configuration and of data and headers of stream."""
+    from rf.archive import stats2row
+
+    def dump(obj):
+        return json.dumps(obj, sort_keys=True, default=str).encode('utf-8')
+
+    h = hashlib.sha1(dump(config))
+    for tr in stream:
+        h.update(dump(stats2row(tr.stats)))
+        h.update(np.ascontiguousarray(tr.data).tobytes())
+    return h.hexdigest()
+
+
+def _station_key(stream):
+    st = stream[0].stats
+    return '.'.join((st.network, st.station, st.location))
+
+
+def _pair_key(stream):
+    return _station_key(stream) + '_' + _event_key(stream[0].stats.event_time)
+
+
+class _Manifest(object):
+
+    """
+    Hashes of inputs and configuration of the outputs in a directory or file.
+
+    The manifest is stored next to the output, see MANIFEST_FNAMES.
+    For each key the digest and the output files are recorded after the
+    output was written. An output is up to date if the digest did not
+    change and all of its files exist.
+    Each shard writes its own manifest (e.g. manifest.1of4.json), so that
+    shards can run at the same time. The manifests of all shards are merged
+    when loading.
+
+    :param shard: tuple (i, n) of the shard or None
+    """
+
+    def __init__(self, root, format, shard=None):
+        fname = MANIFEST_FNAMES[format].format(root=root)
+        base, ext = os.path.splitext(fname)
+        self.fname = fname
+        if shard is not None:
+            self.fname = '%s.%dof%d%s' % (base, shard[0], shard[1], ext)
+        self.entries = {}
+        self._own = {}
+        self._pending = {}
+        fnames = [fname] + sorted(glob(base + '.*of*' + ext))
+        for fn in fnames:
+            if not os.path.exists(fn):
+                continue
+            with open(fn) as f:
+                entries = json.load(f)
+            self.entries.update(entries)
+            if fn == self.fname:
+                self._own = entries
+
+    def _path(self, fname):
+        return os.path.join(os.path.dirname(self.fname), fname)
+
+    def current(self, key, digest):
+        """Return if output of key is written with this digest."""
+        entry = self.entries.get(key)
+        return (isinstance(entry, dict) and entry['digest'] == digest and
+                all(os.path.exists(self._path(fname))
+                    for fname in entry['files']))
+
+    def filter(self, iter_, key, config):
+        """Yield streams whose data or configuration changed."""
         for stream in iter_:
-            for command in commands:
-                if command == 'data':
-                    pass
-                elif command == 'calc':
-                    stream.rf(**kw['rf'])
-                elif command == 'moveout':
-                    stream.moveout(**kw['moveout'])
-                else:
-                    raise NotImplementedError
-            write(stream, path_out, format)
+            k = key(stream)
+            digest = _digest(config, stream)
+            if self.current(k, digest):
+                continue
+            self._pending[k] = digest
+            yield stream
+
+    def done(self, key, fnames, digest=None):
+        """
+        Record digest of key after its output was written to fnames.
+
+        :param digest: digest, by default the digest of the stream of key
+            yielded by `filter()`
+        """
+        if digest is None:
+            digest = self._pending.pop(key, None)
+            if digest is None:
+                return
+        root = os.path.dirname(self.fname)
+        fnames = sorted(set(os.path.relpath(fname, root or '.')
+                            for fname in fnames))
+        self.entries[key] = self._own[key] = {'digest': digest,
+                                              'files': fnames}
+
+    def callback(self, key, fnames):
+        """
+        Return function recording key, call it after fnames were written.
+
+        Return None if key was not yielded by `filter()`.
+        """
+        digest = self._pending.pop(key, None)
+        if digest is not None:
+            return lambda: self.done(key, fnames, digest=digest)
+
+    def save(self):
+        """Write entries recorded by this shard."""
+        _create_dir(self.fname)
+        with open(self.fname, 'w') as f:
+            json.dump(self._own, f, indent=0, sort_keys=True)
+
+
+class _StackAccumulator(object):
+
+    """
+    Accumulate receiver functions for station stacks.
+
+    For the default mean stack only the running sums per seed id are kept,
+    for other stack options the traces of each station are collected.
+
+    :param \*\*kwargs: options passed to `~rf.rfstream.RFStream.stack()`
+    """
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.running = set(kwargs) <= {'method'} and (
+            kwargs.get('method', 'mean') == 'mean')
+        self._groups = collections.OrderedDict()
+
+    def add(self, stream):
+        """Add receiver functions in stream."""
+        for tr in stream:
+            st = tr.stats
+            group = self._groups.setdefault(
+                (st.network, st.station, st.location),
+                collections.OrderedDict())
+            if not self.running:
+                group.setdefault(None, []).append(tr)
+            elif tr.id not in group:
+                group[tr.id] = [tr, np.array(tr.data, dtype=float), 1]
+            else:
+                acc = group[tr.id]
+                if tr.stats.npts != acc[0].stats.npts:
+                    msg = 'Traces with id %s have different number of samples'
+                    raise ValueError(msg % tr.id)
+                acc[1] += tr.data
+                acc[2] += 1
+
+    def stacks(self):
+        """Yield stack of each station."""
+        from rf.rfstream import RFStream
+        for group in self._groups.values():
+            if not self.running:
+                yield RFStream(group[None]).stack(**self.kwargs)
+                continue
+            traces = []
+            for tr, data, num in group.values():
+                tr = tr.copy()
+                tr.data = data / num
+                traces.append(tr)
+            # stack of single traces sets the headers like RFStream.stack
+            yield RFStream(traces).stack(**self.kwargs)
+
+
+def run_pipeline(iter_, steps, root, format, kw, verbose=False, layout=None):
+    """
+    Stack receiver functions, calculate profile and write files in one pass.
+
+    :param iter_: iterable of streams with processed receiver functions
+    :param steps: pipeline steps 'stack', 'profile' or 'write', other steps
+        are ignored
+    :param root: output directory, receiver functions, stacks and profile
+        are written to rf, stack and profile inside this directory
+    :param format: output format
+    :param kw: dictionary with configuration of 'stack', 'boxes', 'profile'
+    :param verbose: passed to `AsyncWriter`
+    :param layout: layout of receiver function files, see `write()`
+    """
+    stacks = _StackAccumulator(**kw['stack']) if 'stack' in steps else None
+    writer = None
+    if 'write' in steps:
+        writer = AsyncWriter(join(root, 'rf'), format, layout=layout,
+                             mode='w', verbose=verbose)
+
+    def iter_traces():
+        for stream in iter_:
+            if stacks is not None:
+                stacks.add(stream)
+            for tr in stream:
+                yield tr
+            # the writer thread may change headers, write stream at last
+            if writer is not None:
+                writer.write(stream)
+
+    try:
+        if 'profile' in steps:
+            from rf.profile import get_profile_boxes, profile
+            boxx = get_profile_boxes(**kw['boxes'])
+            prof = profile(iter_traces(), boxx, **kw['profile'])
+        else:
+            for _ in iter_traces():
+                pass
+    finally:
+        if writer is not None:
+            writer.close()
+    if stacks is not None:
+        with Writer(join(root, 'stack'), format, type='stack',
+                    mode='w') as writer:
+            for stack in stacks.stacks():
+                writer.write(stack)
+    if 'profile' in steps:
+        write(prof, join(root, 'profile'), format, type='profile', mode='w')
+
+
+def _apply_commands(stream, commands, kw):
+    """Apply commands data, calc and moveout to stream in-place."""
+    for command in commands:
+        if command == 'data':
+            pass
+        elif command == 'calc':
+            stream.rf(**kw['rf'])
+        elif command == 'moveout':
+            stream.moveout(**kw['moveout'])
+        else:
+            raise NotImplementedError
+    return stream
+
+
+def _iter_event_tasks(events, inventory, pbar=None, shard=None):
+    """Yield event, seed id and component for all event station pairs."""
+    stations = _get_stations(inventory)
+    if pbar is not None:
+        pbar.total = len(events) * len(stations)
+    for event in events:
+        for seedid in stations:
+            if pbar is not None:
+                pbar.update(1)
+            if in_shard(shard, seedid, event):
+                yield event, seedid, stations[seedid]
+
+
+_WORKER = {}
+
+
+def _init_worker(commands, kw, inventory, data, plugin, get_waveforms,
+                 timing=False, pairs=None):
+    """Initialize worker process and load travel time and moveout models."""
+    from rf.rfstream import _get_taup_model
+    from rf.simple_model import load_model
+    if pairs is not None:
+        # with the fork start method pairs is not pickled, but the same
+        # object as in the parent process
+        pairs.readonly = True
+    _WORKER.update(commands=commands, kw=kw, inventory=inventory,
+                   pairs=pairs)
+    if timing:
+        from rf.timing import start_timing
+        start_timing()
+    if commands[0] == 'data':
+        if get_waveforms is None:
+            get_waveforms = init_data(
+                data, client_options=kw['client_options'], plugin=plugin)
+        _WORKER['get_waveforms'] = get_waveforms
+        _get_taup_model(kw['options'].get('tt_model', 'iasp91'))
+    if 'moveout' in commands:
+        load_model(kw['moveout'].get('model', 'iasp91'))
+
+
+def _process(task):
+    """
+    Process stream or event station pair in worker process.
+
+    Return processed stream or None and the timing report of this task.
+    """
+    commands = _WORKER['commands']
+    kw = _WORKER['kw']
+    if commands[0] == 'data':
+        stream = _get_event_data(*task, inventory=_WORKER['inventory'],
+                                 get_waveforms=_WORKER['get_waveforms'],
+                                 pairs=_WORKER['pairs'], **kw['options'])
+    else:
+        stream = task
+    if stream is not None:
+        stream = _apply_commands(stream, commands, kw)
+    timings = get_timings()
+    if timings is None:
+        return stream, None
+    # send timing of this task to the main process and start anew
+    from rf.timing import start_timing
+    start_timing()
+    return stream, timings.report()
+
+
+def _get_result(result):
+    stream, report = result.get()
+    if report is not None and get_timings() is not None:
+        get_timings().update(report)
+    if stream is not None:
+        # unpickling moves the stats entries delta and endtime to the end,
+        # restore the order of entries to write identical files
+        for tr in stream:
+            tr.stats = tr.stats.__class__(tr.stats)
+    return stream
+
+
+def _iter_parallel(tasks, jobs, initargs):
+    """
+    Process tasks in worker processes and yield the results in order.
+
+    At most 4 tasks per process are pending at the same time.
+    """
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs, initializer=_init_worker,
+                                initargs=initargs)
+    results = collections.deque()
+    set_gauge('tasks', results.__len__)
+    try:
+        for task in tasks:
+            results.append(pool.apply_async(_process, (task,)))
+            if len(results) >= 4 * jobs:
+                stream = _get_result(results.popleft())
+                if stream is not None:
+                    yield stream
+        while results:
+            stream = _get_result(results.popleft())
+            if stream is not None:
+                yield stream
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def run_cli(args=None):
@@ -379,6 +1461,36 @@ def run_cli(args=None):
     p.add_argument('-v', '--version', action='version', version=version)
     msg = 'Configuration file to load (default: conf.json)'
     p.add_argument('-c', '--conf', default='conf.json', help=msg)
+    msg = ("process only shard i of n shards, given as 'i/n', the shards "
+           "partition the pairs of events and stations (stations for "
+           "commands without events)")
+    p.add_argument('--shard', default=SUPPRESS, help=msg)
+    msg = ('process only events and stations whose input data or '
+           'configuration changed since the last run (SAC, Q, H5)')
+    p.add_argument('--incremental', action='store_true', default=SUPPRESS,
+                   help=msg)
+    msg = ('measure wall time and number of calls of the processing stages, '
+           'print a summary and write a report in JSON format to the file '
+           'timing.json')
+    p.add_argument('--timing', action='store_true', default=SUPPRESS,
+                   help=msg)
+    msg = ('periodically write metrics (processed and rejected pairs, '
+           'written bytes, queue depths, stage latencies) in the text format '
+           'of Prometheus to this file, e.g. for the textfile collector of '
+           'the node exporter')
+    p.add_argument('--metrics', default=SUPPRESS, help=msg)
+    msg = 'interval for writing the metrics file in seconds (default: 60)'
+    p.add_argument('--metrics-interval', type=float, default=SUPPRESS,
+                   help=msg)
+    msg = ('store the results of rfstats for all pairs of events and '
+           'stations in this directory and reuse them (commands data and '
+           'pipeline), see rf.pairs')
+    p.add_argument('--pair-cache', default=SUPPRESS, help=msg)
+    msg = ('layout of receiver function files in SAC and Q format, '
+           'sharded: year/month subdirectories of station directories '
+           'with file list (default: flat)')
+    p.add_argument('--layout', choices=('flat', 'sharded'), default=SUPPRESS,
+                   help=msg)
 
     sub = p.add_subparsers(title='commands', dest='command')
     msg = 'create config file in current directory'
@@ -393,17 +1505,39 @@ def run_cli(args=None):
     p_stack = sub.add_parser('stack', help=msg)
     msg = 'stack receiver functions to profile'
     p_profile = sub.add_parser('profile', help=msg)
+    msg = 'calculate H-k stacks for crustal thickness and Vp/Vs ratio'
+    p_hk = sub.add_parser('hk', help=msg)
+    msg = ('calculate receiver functions, stacks and profile in a single '
+           'pass over the data')
+    p_pipe = sub.add_parser('pipeline', help=msg)
+    msg = 'build or update header index of directory (SAC, Q)'
+    p_index = sub.add_parser('index', help=msg)
     msg = 'convert files to different format'
     p_conv = sub.add_parser('convert', help=msg)
+    msg = 'merge output files of shards (H5, NPY or profiles)'
+    p_merge = sub.add_parser('merge', help=msg)
+    msg = ('print number of pairs, requested data, output and estimated '
+           'runtime of command data or pipeline without running it')
+    p_plan = sub.add_parser('plan', help=msg)
     msg = 'print information about events, stations or waveform files'
     p_print = sub.add_parser('print', help=msg)
     msg = 'plot receiver functions'
     p_plot = sub.add_parser('plot', help=msg)
     msg = 'plot receiver function profile'
     p_plotp = sub.add_parser('plot-profile', help=msg)
+    msg = ('run jobs sent to a Unix socket with warm caches of events, '
+           'stations and models, see rf.serve')
+    p_serve = sub.add_parser('serve', help=msg)
 
     msg = 'create example files for tutorial'
     p_create.add_argument('-t', '--tutorial', help=msg, action='store_true')
+    msg = ('create synthetic events, stations and waveforms (SDS archive) '
+           'for load tests and use them in the config file, '
+           'see rf.synthetic_dataset')
+    p_create.add_argument('-s', '--synthetic', nargs=2, type=int, help=msg,
+                          metavar=('NEVENTS', 'NSTATIONS'))
+    msg = 'seed of the random number generator for synthetic data'
+    p_create.add_argument('--seed', type=int, default=0, help=msg)
     # the default='moveout' is an ugly work-around for
     # http://bugs.python.org/issue27227 and related issue9625
     msg = 'calculate receiver functions, perform moveout correction, optional'
@@ -412,19 +1546,42 @@ def run_cli(args=None):
     msg = 'perform also moveout correction'
     p_calc.add_argument('commands', nargs='*', help=msg,
                         choices=('moveout',), default='moveout')
+    msg = "command data (optionally with calc and moveout) or pipeline"
+    p_plan.add_argument('commands', nargs='+', help=msg,
+                        choices=('data', 'calc', 'moveout', 'pipeline'))
+    msg = 'write plan in JSON format to this file'
+    p_plan.add_argument('--json', dest='plan_json', default=SUPPRESS,
+                        help=msg)
+    msg = ('timing report of a previous run for the runtime estimate '
+           '(default: timing.json if it exists)')
+    p_plan.add_argument('--timing-report', default=SUPPRESS, help=msg)
+    msg = 'path of the Unix socket (default: rf.sock)'
+    p_serve.add_argument('--socket', default=SUPPRESS, help=msg)
+    msg = 'maximal number of jobs running at the same time (default: 4)'
+    p_serve.add_argument('-w', '--workers', type=int, default=SUPPRESS,
+                         help=msg)
+    msg = 'number of worker processes'
+    for pp in (p_data, p_calc, p_mout, p_pipe, p_plan):
+        pp.add_argument('-j', '--jobs', type=int, default=SUPPRESS, help=msg)
     msg = "one of 'events', 'inventory' or filenames"
     p_print.add_argument('objects', nargs='+', help=msg)
 
-    io = [p_calc, p_mout, p_conv, p_plot, p_stack, p_profile, p_plotp]
+    io = [p_calc, p_mout, p_conv, p_plot, p_stack, p_profile, p_hk,
+          p_plotp, p_merge]
     for pp in io:
-        msg = 'directory of files (SAC, Q) or basename of file (H5)'
+        msg = 'directory of files (SAC, Q) or basename of file (H5, NPY)'
         pp.add_argument('path_in', help=msg)
-    io.append(p_data)
+    msg = 'directory of files (SAC, Q)'
+    p_index.add_argument('path_in', help=msg)
+    io.extend([p_data, p_pipe])
     for pp in io:
         msg = 'output directory or output file basename'
         pp.add_argument('path_out', help=msg)
+    msg = ('pipeline steps, any of calc, moveout, stack, profile, write '
+           '(default: config option pipeline or calc moveout stack profile)')
+    p_pipe.add_argument('pipeline', nargs='*', default=SUPPRESS, help=msg)
 
-    msg = 'new format (supported: Q, SAC or H5)'
+    msg = 'new format (supported: Q, SAC, H5 or NPY)'
     p_conv.add_argument('newformat', help=msg)
 
     msg = ('Use these flags to overwrite values in the config file. '
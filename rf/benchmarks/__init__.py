@@ -0,0 +1,420 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Benchmarks for the hot paths of rf.
+
+The benchmarks run on synthetic datasets of several sizes which are built
+from the example data by `synthetic_stream()`. Only the benchmarked
+operation is timed, the preparation of the data is not.
+The results are appended to a JSON history file together with the git
+commit, so that the runs of different commits can be compared.
+A benchmark is regarded as a regression if its time increased by more
+than the threshold relative to the reference run.
+
+Run the benchmarks with ::
+
+    python -m rf.benchmarks -s 1000 10000 --label before
+    python -m rf.benchmarks -s 1000 10000 --compare before
+
+The exit status is 1 if a regression was detected.
+
+`import_time()` measures the time for importing rf in a new interpreter,
+heavy dependencies are imported on first use only. The command line
+interface checks the import time against `IMPORT_BUDGET`, exceeding the
+budget or importing one of `LAZY_MODULES` counts as regression.
+"""
+import argparse
+from glob import glob
+import json
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+import numpy as np
+from rf.util import minimal_example_rf
+
+
+SIZES = (1000, 10000, 100000)
+HISTORY = 'benchmarks.json'
+_EXCLUDE_HEADERS = ('sac', 'processing', '_format', 'delta', 'endtime',
+                    'npts', 'moveout', 'slowness_before_moveout',
+                    'pp_depth', 'pp_latitude', 'pp_longitude')
+
+
+def _raw_example():
+    from rf.rfstream import read_rf, rfstats
+    stream = read_rf()
+    rfstats(stream)
+    return stream
+
+
+def synthetic_stream(n, raw=False, seed=0):
+    """
+    Return stream with n receiver functions built from the example data.
+
+    The traces of the example events are repeated with random station
+    coordinates (40 stations around the example station), back azimuths,
+    slownesses, event times and noise.
+
+    :param n: number of traces, rounded up to a multiple of 3
+    :param raw: use the raw example seismograms (ZNE components)
+        instead of the receiver functions (LQT components)
+    :param seed: seed of the random number generator
+    """
+    from rf.rfstream import RFStream, RFTrace
+    template = _raw_example() if raw else minimal_example_rf()
+    groups = [template[i:i + 3] for i in range(0, len(template), 3)]
+    ngroups = -(-n // 3)
+    rs = np.random.RandomState(seed)
+    nsta = 40
+    lat = -21 + rs.uniform(-1, 1, nsta)
+    lon = -69.5 + rs.uniform(-1, 1, nsta)
+    choice = rs.randint(len(groups), size=ngroups)
+    station = rs.randint(nsta, size=ngroups)
+    baz = rs.uniform(0, 360, ngroups)
+    slowness = rs.uniform(4.5, 8.5, ngroups)
+    traces = []
+    for j in range(ngroups):
+        # shift events by one hour to get unique event times
+        shift = 3600 * j
+        for tr in groups[choice[j]]:
+            header = {k: v for k, v in tr.stats.items()
+                      if k not in _EXCLUDE_HEADERS}
+            for key in ('starttime', 'onset', 'event_time'):
+                header[key] = tr.stats[key] + shift
+            header['station'] = 'S%03d' % station[j]
+            header['station_latitude'] = lat[station[j]]
+            header['station_longitude'] = lon[station[j]]
+            header['back_azimuth'] = baz[j]
+            header['slowness'] = slowness[j]
+            noise = 0.01 * np.max(np.abs(tr.data))
+            data = tr.data + rs.normal(0, noise, len(tr.data))
+            traces.append(RFTrace(data=data, header=header))
+    return RFStream(traces)
+
+
+def _bench_deconvf(n):
+    from rf.deconvolve import deconvf
+    stream = synthetic_stream(n, raw=True)
+    groups = [[tr.data for tr in stream[i:i + 3]]
+              for i in range(0, len(stream), 3)]
+
+    def run():
+        for e, n_, z in groups:
+            deconvf([e, n_], z, 5.)
+    return run
+
+
+def _bench_deconvt(n):
+    from rf.deconvolve import deconvt
+    stream = synthetic_stream(n, raw=True)
+    groups = [[tr.data for tr in stream[i:i + 3]]
+              for i in range(0, len(stream), 3)]
+
+    def run():
+        for e, n_, z in groups:
+            deconvt([e, n_], z, 50, length=250)
+    return run
+
+
+def _bench_moveout(n):
+    from rf.simple_model import load_model
+    model = load_model()
+    stream = synthetic_stream(n)
+    return lambda: model.moveout(stream)
+
+
+def _bench_ppoints(n):
+    stream = synthetic_stream(n)
+    return lambda: stream.ppoints(50)
+
+
+def _bench_profile(n):
+    from rf.profile import get_profile_boxes, profile
+    stream = synthetic_stream(n)
+    stream.ppoints(50)
+    boxes = get_profile_boxes((-22, -69.5), 0, np.linspace(0, 220, 23),
+                              width=300)
+    return lambda: profile(stream, boxes)
+
+
+def _bench_stack(n):
+    stream = synthetic_stream(n)
+    return lambda: stream.stack()
+
+
+def _bench_rfstats(n):
+    from rf.rfstream import rfstats
+    stream = synthetic_stream(n, raw=True)
+    return lambda: rfstats(stream)
+
+
+def _write(stream, root, format):
+    """Write stream per event and station like the batch commands."""
+    from rf.batch import Writer
+    with Writer(root, format) as writer:
+        for i in range(0, len(stream), 3):
+            writer.write(stream[i:i + 3])
+
+
+def _bench_write(format):
+    def bench(n):
+        stream = synthetic_stream(n)
+        path = tempfile.mkdtemp()
+        root = os.path.join(path, 'rf')
+        return lambda: _write(stream, root, format), path
+    return bench
+
+
+def _bench_read(format):
+    def bench(n):
+        from rf.rfstream import read_rf
+        stream = synthetic_stream(n)
+        path = tempfile.mkdtemp()
+        root = os.path.join(path, 'rf')
+        _write(stream, root, format)
+        if format == 'H5':
+            fnames = [root + '.h5']
+        else:
+            ext = '*.QHD' if format == 'Q' else '*.SAC'
+            fnames = glob(os.path.join(root, '*', ext))
+
+        def run():
+            for fname in fnames:
+                read_rf(fname, format)
+        return run, path
+    return bench
+
+
+#: Benchmarks and maximal size (None: no maximum).
+#: The taup calculations of rfstats, the box search of profile and the many
+#: small files of SAC are too slow for the largest size.
+BENCHMARKS = {
+    'deconvf': (_bench_deconvf, None),
+    'deconvt': (_bench_deconvt, None),
+    'moveout': (_bench_moveout, None),
+    'ppoints': (_bench_ppoints, None),
+    'profile': (_bench_profile, 10000),
+    'stack': (_bench_stack, None),
+    'rfstats': (_bench_rfstats, 10000),
+    'write_Q': (_bench_write('Q'), None),
+    'read_Q': (_bench_read('Q'), None),
+    'write_SAC': (_bench_write('SAC'), 10000),
+    'read_SAC': (_bench_read('SAC'), 10000),
+    'write_H5': (_bench_write('H5'), None),
+    'read_H5': (_bench_read('H5'), None)}
+
+
+def _has_obspyh5():
+    try:
+        import obspyh5  # noqa
+    except ImportError:
+        return False
+    return True
+
+
+def run_benchmarks(names=None, sizes=SIZES, repeat=3, verbose=False):
+    """
+    Run benchmarks.
+
+    :param names: names of benchmarks (default: all, see `BENCHMARKS`),
+        H5 benchmarks are skipped if obspyh5 is not installed
+    :param sizes: numbers of traces
+    :param repeat: every benchmark is repeated with fresh data, the
+        minimal time is used
+    :param verbose: print the results
+    :return: dictionary {name: {size: time in seconds}}, sizes are strings
+    """
+    import warnings
+    if names is None:
+        names = sorted(BENCHMARKS)
+        if not _has_obspyh5():
+            names = [name for name in names if not name.endswith('H5')]
+    results = {}
+    for name in names:
+        bench, max_size = BENCHMARKS[name]
+        results[name] = {}
+        for size in sizes:
+            if max_size is not None and size > max_size:
+                continue
+            times = []
+            for _ in range(repeat):
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    run = bench(size)
+                    path = None
+                    if isinstance(run, tuple):
+                        run, path = run
+                    try:
+                        t1 = default_timer()
+                        run()
+                        times.append(default_timer() - t1)
+                    finally:
+                        if path is not None:
+                            shutil.rmtree(path)
+            results[name][str(size)] = min(times)
+            if verbose:
+                print('%-10s %7d %10.4fs' % (name, size, min(times)))
+    return results
+
+
+#: Dependencies which must not be imported by ``import rf.batch``
+#: (geographiclib is imported by obspy itself)
+LAZY_MODULES = ('obspy.taup', 'scipy', 'matplotlib', 'cartopy', 'shapely',
+                'pkg_resources')
+#: Time budget for ``import rf.batch`` in seconds, checked by the command
+#: line interface
+IMPORT_BUDGET = 1.
+
+_IMPORT_SCRIPT = """
+import json, sys
+from timeit import default_timer
+t1 = default_timer()
+import %s
+t2 = default_timer()
+print(json.dumps([t2 - t1, [m for m in %r if m in sys.modules]]))
+"""
+
+
+def import_time(module='rf.batch', repeat=3):
+    """
+    Measure import time of module in a new interpreter.
+
+    :param module: name of module
+    :param repeat: number of interpreters, the minimal time is used
+    :return: import time in seconds and list of modules of `LAZY_MODULES`
+        which were imported
+    """
+    script = _IMPORT_SCRIPT % (module, LAZY_MODULES)
+    times = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', script])
+        t, imported = json.loads(out.decode('utf-8').splitlines()[-1])
+        times.append(t)
+    return min(times), imported
+
+
+def _git_commit():
+    path = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=path, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return
+    return commit.decode('ascii').strip()
+
+
+def read_history(fname=HISTORY):
+    """Return list of runs in history file."""
+    if not os.path.exists(fname):
+        return []
+    with open(fname) as f:
+        return json.load(f)
+
+
+def append_history(results, fname=HISTORY, label=None):
+    """
+    Append results to history file.
+
+    :return: run, a dictionary with entries label, commit, date, version,
+        python and results
+    """
+    from rf import __version__
+    run = {'label': label, 'commit': _git_commit(),
+           'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'version': __version__, 'python': sys.version.split()[0],
+           'results': results}
+    history = read_history(fname)
+    history.append(run)
+    with open(fname, 'w') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+    return run
+
+
+def find_run(history, ref=None):
+    """
+    Return run of history with label ref or commit starting with ref.
+
+    Labels take precedence over commits. If ref is None, the second last run
+    is returned. Return None if no run is found.
+    """
+    if ref is None:
+        return history[-2] if len(history) > 1 else None
+    for run in history[::-1]:
+        if run['label'] == ref:
+            return run
+    for run in history[::-1]:
+        if (run['commit'] or '').startswith(ref):
+            return run
+
+
+def compare(old, new, threshold=0.2):
+    """
+    Compare results of two runs.
+
+    :param old,new: results, see `run_benchmarks()`
+    :param threshold: relative increase of time regarded as regression
+    :return: list of tuples (name, size, old time, new time, ratio,
+        regression) for all benchmarks contained in both results
+    """
+    rows = []
+    for name in sorted(new):
+        for size in sorted(new[name], key=int):
+            if size not in old.get(name, {}):
+                continue
+            t_old = old[name][size]
+            t_new = new[name][size]
+            ratio = t_new / t_old if t_old > 0 else float('inf')
+            rows.append((name, int(size), t_old, t_new, ratio,
+                         ratio > 1 + threshold))
+    return rows
+
+
+def main(args=None):
+    """Command line interface of the benchmarks."""
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                prog='python -m rf.benchmarks')
+    msg = 'benchmarks to run (default: all): %s' % ', '.join(
+        sorted(BENCHMARKS))
+    p.add_argument('-b', '--benchmarks', nargs='+', help=msg,
+                   choices=sorted(BENCHMARKS), metavar='NAME')
+    msg = 'numbers of traces (default: %s)' % ' '.join(map(str, SIZES))
+    p.add_argument('-s', '--sizes', nargs='+', type=int, default=SIZES,
+                   help=msg)
+    msg = 'number of repetitions, the minimal time is used (default: 3)'
+    p.add_argument('-r', '--repeat', type=int, default=3, help=msg)
+    msg = 'history file (default: %s)' % HISTORY
+    p.add_argument('--history', default=HISTORY, help=msg)
+    msg = 'label of this run in the history'
+    p.add_argument('--label', help=msg)
+    msg = ('compare with the run with this label or commit '
+           '(default: previous run)')
+    p.add_argument('--compare', nargs='?', const=True, help=msg)
+    msg = 'relative increase of time regarded as regression (default: 0.2)'
+    p.add_argument('--threshold', type=float, default=0.2, help=msg)
+    args = p.parse_args(args)
+    t, imported = import_time(repeat=args.repeat)
+    reg = t > IMPORT_BUDGET or len(imported) > 0
+    print('%-18s %10.4fs (budget %.1fs) %s' % (
+        'import rf.batch', t, IMPORT_BUDGET,
+        ' '.join(imported + ['REGRESSION'] * reg)))
+    regressions = int(reg)
+    results = run_benchmarks(args.benchmarks, args.sizes, args.repeat,
+                             verbose=True)
+    append_history(results, args.history, label=args.label)
+    if args.compare:
+        ref = None if args.compare is True else args.compare
+        run = find_run(read_history(args.history), ref)
+        if run is None:
+            p.error('No run %s found in history' % (ref or 'to compare'))
+        print('\ncompared to %s' % (run['label'] or run['commit']))
+        for name, size, t_old, t_new, ratio, reg in compare(
+                run['results'], results, args.threshold):
+            print('%-10s %7d %10.4fs %10.4fs %6.2f %s' % (
+                name, size, t_old, t_new, ratio, 'REGRESSION' if reg else ''))
+            regressions += reg
+    if regressions:
+        sys.exit(1)
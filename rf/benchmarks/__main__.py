@@ -0,0 +1,3 @@
+from rf.benchmarks import main
+
+main()
@@ -4,9 +4,6 @@ Frequency and time domain deconvolution.
 """
 import numpy as np
 from numpy import max, pi
-from obspy.signal.util import next_pow_2
-from scipy.fftpack import fft, ifft
-from scipy.signal import correlate
 try:
     from toeplitz import sto_sl
 except ImportError:
@@ -14,6 +11,7 @@ except ImportError:
     msg = 'Toeplitz import error. Time domain deconvolution will not work.'
     warnings.warn(msg)
 
+from rf.instrument import instrumented
 from rf.util import _add_processing_info
 
 
@@ -27,6 +25,7 @@ def __find_nearest(array, value):
         return idx
 
 
+@instrumented('deconvolve')
 @_add_processing_info
 def deconvolve(stream, method='time', func=None,
                source_components='LZ', response_components=None,
@@ -155,6 +154,8 @@ def deconvf(rsp_list, src, sampling_rate, waterlevel=0.05, gauss=2.,
 
     :return: (list of) array(s) with deconvolution(s)
     """
+    from obspy.signal.util import next_pow_2
+    from scipy.fftpack import fft, ifft
     if length is None:
         length = __get_length(rsp_list)
     N = length
@@ -218,6 +219,7 @@ def _acorrt(a, num):
     :param num: Number of returned data points
     :return: autocorrelation
     """
+    from scipy.signal import correlate
     return correlate(_add_zeros(a, 0, num - 1), a, 'valid')
 
 
@@ -233,6 +235,7 @@ def _xcorrt(a, b, num, zero_sample=0):
         If zero_sample != 0 a will be shifted additionally to the left.
     :return: cross-correlation
     """
+    from scipy.signal import correlate
     if zero_sample > 0:
         a = _add_zeros(a, 2 * abs(zero_sample), 0)
     elif zero_sample < 0:
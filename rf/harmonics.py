@@ -0,0 +1,132 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Back-azimuth harmonic decomposition of receiver functions.
+
+The radial (Q or R) and transverse (T) receiver functions are modeled as
+a sum of back-azimuth harmonics up to second order (e.g. Bianchi et al. 2010)::
+
+    R(baz) = A0 + A1 cos(baz) + B1 sin(baz) + A2 cos(2baz) + B2 sin(2baz)
+    T(baz) =      A1 sin(baz) - B1 cos(baz) + A2 sin(2baz) - B2 cos(2baz)
+
+The coefficients are obtained for all time samples at once by a single
+least-squares solve.
+"""
+import warnings
+
+import numpy as np
+from rf.util import (IterMultipleComponents, _add_processing_info,
+                     _percentile_traces)
+
+
+HARMONICS = ('constant', 'cos', 'sin', 'cos2', 'sin2')
+
+
+def _design_matrix(baz, component):
+    """Return design matrix for back azimuths (degree) and component."""
+    baz = np.radians(baz)
+    if component in 'QR':
+        cols = (np.ones_like(baz), np.cos(baz), np.sin(baz),
+                np.cos(2 * baz), np.sin(2 * baz))
+    else:
+        cols = (np.zeros_like(baz), np.sin(baz), -np.cos(baz),
+                np.sin(2 * baz), -np.cos(2 * baz))
+    return np.transpose(cols)
+
+
+@_add_processing_info
+def harmonics(stream, components='QT', bootstrap=None,
+              percentiles=(2.5, 97.5), seed=None, chunksize=100):
+    """
+    Decompose receiver functions of one station into back-azimuth harmonics.
+
+    :param stream: stream with receiver functions of one station with stats
+        entries back_azimuth and onset. All traces need to have the same
+        number of samples and the same time window around the onset.
+    :param components: use radial and transverse components ('QT' or 'RT')
+        or only the radial component ('Q' or 'R')
+    :param bootstrap: number of bootstrap iterations. If set, each
+        harmonic trace is followed by traces with the given percentiles of
+        the bootstrapped coefficients (stats entry percentile).
+        The events are resampled and the bootstrap fits of each chunk of
+        iterations are solved in one batched weighted least-squares step.
+    :param percentiles: percentiles returned for bootstrap
+    :param seed: seed of the random number generator used for bootstrap
+    :param chunksize: number of bootstrap iterations solved at once,
+        bounds the used memory
+    :return: stream with 5 traces with the coefficients of the constant,
+        cos(baz), sin(baz), cos(2baz) and sin(2baz) terms.
+        The last character of the channel is set to 0, 1, 2, 3, 4,
+        the stats entry harmonic holds the name of the term.
+
+    If the back azimuths do not constrain all coefficients (e.g. events
+    from a single direction), a warning is issued and the minimum-norm
+    solution is returned.
+    """
+    components = components.upper()
+    if components not in ('QT', 'RT', 'Q', 'R'):
+        msg = "components must be one of 'QT', 'RT', 'Q', 'R', but is '%s'"
+        raise ValueError(msg % components)
+    rows = []
+    events = []
+    traces = []
+    n = 0
+    for stream3c in IterMultipleComponents(stream, key='onset'):
+        sel = [stream3c.select(component=comp) for comp in components]
+        if any(len(s) != 1 for s in sel):
+            continue
+        for comp, s in zip(components, sel):
+            traces.append(s[0])
+            rows.append(_design_matrix([s[0].stats.back_azimuth], comp))
+            events.append(n)
+        n += 1
+    if len(traces) == 0:
+        raise ValueError('No traces with components %s' % components)
+    npts = traces[0].stats.npts
+    if any(tr.stats.npts != npts for tr in traces):
+        raise ValueError('Traces need to have the same number of samples')
+    X = np.vstack(rows)
+    data = np.array([tr.data for tr in traces], dtype=float)
+    coef, _, rank, _ = np.linalg.lstsq(X, data, rcond=None)
+    if rank < X.shape[1]:
+        msg = ('Back azimuth distribution does not constrain all harmonics '
+               '(rank %d of %d), return minimum-norm solution')
+        warnings.warn(msg % (rank, X.shape[1]))
+    if bootstrap:
+        rs = np.random.RandomState(seed)
+        coefs = np.empty((bootstrap,) + coef.shape)
+        deficient = 0
+        for i in range(0, bootstrap, chunksize):
+            num = min(chunksize, bootstrap - i)
+            w = rs.multinomial(n, np.ones(n) / n, size=num)[:, events]
+            WXt = np.transpose(w[:, :, np.newaxis] * X, (0, 2, 1))
+            XtWX = np.matmul(WXt, X)
+            deficient += np.count_nonzero(
+                np.linalg.matrix_rank(XtWX) < X.shape[1])
+            coefs[i:i + num] = np.matmul(np.linalg.pinv(XtWX),
+                                         np.matmul(WXt, data))
+        if deficient and rank == X.shape[1]:
+            msg = ('%d of %d bootstrap samples do not constrain all '
+                   'harmonics, use minimum-norm solutions')
+            warnings.warn(msg % (deficient, bootstrap))
+        perc = np.percentile(coefs, percentiles, axis=0)
+    tr0 = traces[0]
+    result = []
+    for i, name in enumerate(HARMONICS):
+        header = {'network': tr0.stats.network,
+                  'station': tr0.stats.station,
+                  'location': tr0.stats.location,
+                  'channel': tr0.stats.channel[:-1] + str(i),
+                  'sampling_rate': tr0.stats.sampling_rate,
+                  'harmonic': name}
+        for entry in ('phase', 'moveout', 'station_latitude',
+                      'station_longitude', 'station_elevation',
+                      'processing'):
+            if entry in tr0.stats:
+                header[entry] = tr0.stats[entry]
+        tr = tr0.__class__(data=coef[i], header=header)
+        onset = tr0.stats.onset - tr0.stats.starttime
+        tr.stats.onset = tr.stats.starttime + onset
+        result.append(tr)
+        if bootstrap:
+            result.extend(_percentile_traces(tr, perc[:, i], percentiles))
+    return stream.__class__(result)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+H-κ stacking for crustal thickness and Vp/Vs ratio.
+
+The amplitudes of the receiver functions at the predicted delay times of the
+Ps conversion and the PpPs and PpSs+PsPs multiples are stacked for a grid of
+crustal thicknesses H and Vp/Vs ratios κ (Zhu and Kanamori 2000).
+The delay times are calculated with the vertical slownesses of a single
+layer in the same way as in `.SimpleModel.calculate_delay_times()`.
+"""
+import numpy as np
+from obspy.core import AttribDict
+from rf.util import DEG2KM
+
+
+_PHASES = ('Ps', 'PpPs', 'PpSs')
+
+
+def _delay_times(H, k, slowness, vp, phase):
+    """
+    Return delay times for all combinations of H, k and slowness.
+
+    :return: array with shape (len(H), len(k), len(slowness))
+    """
+    phase = phase.upper()
+    hslow = np.asarray(slowness)[np.newaxis, :] / DEG2KM
+    vs = vp / np.asarray(k)[:, np.newaxis]
+    with np.errstate(invalid='ignore'):
+        qp = np.sqrt(vp ** (-2) - hslow ** 2)
+        qs = np.sqrt(vs ** (-2) - hslow ** 2)
+    dt = (qp * phase.count('P') + qs * phase.count('S') -
+          2 * (qp if phase[0] == 'P' else qs))
+    return np.asarray(H)[:, np.newaxis, np.newaxis] * dt[np.newaxis, :, :]
+
+
+def _trace_matrix(stream):
+    """Return data matrix, onset indices and sampling rate of stream."""
+    sr = stream[0].stats.sampling_rate
+    if any(tr.stats.sampling_rate != sr for tr in stream):
+        raise ValueError('Traces need to have the same sampling rate')
+    npts = max(tr.stats.npts for tr in stream)
+    data = np.zeros((len(stream), npts + 1))
+    for i, tr in enumerate(stream):
+        data[i, :tr.stats.npts] = tr.data
+    index0 = np.array([(tr.stats.onset - tr.stats.starttime) * sr
+                       for tr in stream])
+    return data, index0, sr
+
+
+def hk_stack(stream, H=None, k=None, vp=6.3, phases=_PHASES,
+             weights=(0.7, 0.2, -0.1), chunksize=50):
+    """
+    Calculate H-κ stack of P receiver functions of one station.
+
+    :param stream: stream with P receiver functions (Q or R components) and
+        stats entries onset and slowness.
+        The receiver functions should not be moveout corrected.
+    :param H: crustal thicknesses of the grid in km
+        (default: 20km to 70km in 0.25km steps)
+    :param k: Vp/Vs ratios of the grid (default: 1.6 to 2.0 in 0.0025 steps)
+    :param vp: average crustal P wave velocity in km/s
+    :param phases: converted phase and multiples, the delay times are
+        calculated as in `.SimpleModel.calculate_delay_times()`
+    :param weights: weights of the phases, the negative weight of the
+        PpSs+PsPs multiple accounts for its negative polarity
+    :param chunksize: number of traces processed at once, bounds the used
+        memory
+    :return: AttribDict with entries
+        'H', 'k' (grid), 'stack' (array with shape (len(H), len(k))),
+        'H_best', 'k_best' (grid node with maximum stack), 'vp' and 'num'
+        (number of used traces)
+
+    The predicted delay times of all phases, grid nodes and traces are
+    calculated by broadcasting. The amplitudes are interpolated linearly from
+    the trace matrix with vectorized indexing.
+    """
+    if H is None:
+        H = np.linspace(20, 70, 201)
+    if k is None:
+        k = np.linspace(1.6, 2.0, 161)
+    H = np.asarray(H, dtype=float)
+    k = np.asarray(k, dtype=float)
+    if len(phases) != len(weights):
+        raise ValueError('Number of phases and weights differ')
+    stream = stream.__class__(
+        [tr for tr in stream if tr.stats.channel[-1] in 'QR'])
+    if len(stream) == 0:
+        raise ValueError('No Q or R component in stream')
+    data, index0, sr = _trace_matrix(stream)
+    slowness = np.array([tr.stats.slowness for tr in stream])
+    stack = np.zeros((len(H), len(k)))
+    npts = data.shape[1] - 1
+    for i in range(0, len(stream), chunksize):
+        sl = slice(i, i + chunksize)
+        rows = np.arange(len(stream))[sl]
+        for phase, weight in zip(phases, weights):
+            t = _delay_times(H, k, slowness[sl], vp, phase)
+            x = t * sr + index0[sl]
+            valid = (x >= 0) & (x < npts)
+            x = np.where(valid, x, 0)
+            j = np.floor(x).astype(int)
+            frac = x - j
+            amp = (data[rows, j] * (1 - frac) + data[rows, j + 1] * frac)
+            stack += weight * np.sum(np.where(valid, amp, 0), axis=-1)
+    stack = stack / len(stream)
+    iH, ik = np.unravel_index(np.argmax(stack), stack.shape)
+    return AttribDict({'H': H, 'k': k, 'stack': stack, 'H_best': H[iH],
+                       'k_best': k[ik], 'vp': vp, 'num': len(stream)})
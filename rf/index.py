@@ -0,0 +1,212 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Header-only index of directories with receiver function files.
+
+The index lists all traces of the waveform files in a directory together
+with their headers (seed id, event time, onset, slowness, back azimuth,
+piercing point, ...), the path of the file relative to the directory and
+the position of the trace in the file.
+It is stored as a header table (see `.archive`) in the file ``index.hdr``.
+The index is built once and updated incrementally, only new or modified
+files are read (headers only). The batch writers append the entries of
+written files to an existing index, later entries of a file replace
+earlier entries. These entries are created from the headers in memory,
+they are buffered and appended to the index in one write. Incomplete
+rows of interrupted writes are ignored.
+Selections can be performed on the index without opening the waveform
+files:
+
+>>> from rf.index import build_index, query, read_indexed
+>>> index = build_index('rfs', 'rfs/*/*.QHD')
+>>> selection = query(index, back_azimuth=(90, 180))
+>>> stream = read_indexed(selection, 'rfs')
+"""
+import collections
+from glob import glob
+import json
+import os.path
+
+import numpy as np
+from obspy import UTCDateTime
+from rf.archive import (_UTC_HEADERS, _json_default, stats2row,
+                        write_header_table)
+
+
+INDEX_FNAME = 'index.hdr'
+
+
+def index_filename(root):
+    """Return file name of index for directory root."""
+    return os.path.join(root, INDEX_FNAME)
+
+
+def _read_rows(fname):
+    with open(fname) as f:
+        lines = f.read().splitlines()
+    rows = []
+    for line in lines:
+        try:
+            rows.append(json.loads(line))
+        except ValueError:  # incomplete row of interrupted write
+            continue
+    return rows
+
+
+def read_index(root):
+    """Return index of directory root as list of dictionaries."""
+    files = collections.OrderedDict()
+    for row in _read_rows(index_filename(root)):
+        if row['trace'] == 0 or row['path'] not in files:
+            # file was written again
+            files[row['path']] = []
+        files[row['path']].append(row)
+    return [row for rows in files.values() for row in rows]
+
+
+def _index_rows(root, path, format=None):
+    """Return index entries of traces in file."""
+    from rf.rfstream import read_rf
+    relpath = os.path.relpath(path, root)
+    mtime = os.path.getmtime(path)
+    stream = read_rf(path, format, headonly=True)
+    rows = []
+    for i, tr in enumerate(stream):
+        row = stats2row(tr.stats)
+        row.update({'path': relpath, 'mtime': mtime, 'trace': i})
+        rows.append(row)
+    return rows
+
+
+def stream_index_rows(stream, root, paths, format):
+    """
+    Return index entries of a stream which was just written.
+
+    The entries are created from the headers in memory, the files are not
+    read again.
+
+    :param stream: written stream
+    :param root: directory of index
+    :param paths: paths of written files, one per trace (SAC) or one for
+        all traces (Q)
+    :param format: format of files ('SAC' or 'Q')
+    """
+    if format.upper() == 'SAC':
+        files = [(path, [tr]) for tr, path in zip(stream, paths)]
+    else:
+        files = [(paths[0], stream)]
+    rows = []
+    for path, traces in files:
+        relpath = os.path.relpath(path, root)
+        mtime = os.path.getmtime(path)
+        for i, tr in enumerate(traces):
+            row = stats2row(tr.stats)
+            # processing is not stored in the files
+            row.pop('processing', None)
+            row.update({'path': relpath, 'mtime': mtime, 'trace': i})
+            rows.append(row)
+    return rows
+
+
+def append_index(root, rows):
+    """
+    Append entries to an existing index.
+
+    Nothing is done if the directory has no index. All entries are written
+    at once.
+
+    :param root: directory of index
+    :param rows: index entries, see `stream_index_rows()`
+    """
+    fname = index_filename(root)
+    if len(rows) == 0 or not os.path.exists(fname):
+        return
+    text = ''.join(json.dumps(row, default=_json_default) + '\n'
+                   for row in rows)
+    with open(fname, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                # terminate incomplete row of an interrupted write
+                text = '\n' + text
+    with open(fname, 'a') as f:
+        f.write(text)
+
+
+def build_index(root, pattern, format=None):
+    """
+    Build or update index of waveform files.
+
+    :param root: directory, the index is written to this directory
+    :param pattern: glob expression of waveform files inside directory
+    :param format: format of waveform files (default: autodetect)
+    :return: index as list of dictionaries
+    """
+    fname = index_filename(root)
+    old = collections.defaultdict(list)
+    if os.path.exists(fname):
+        for row in read_index(root):
+            old[row['path']].append(row)
+    rows = []
+    for path in sorted(glob(pattern)):
+        relpath = os.path.relpath(path, root)
+        mtime = os.path.getmtime(path)
+        if relpath in old and old[relpath][0]['mtime'] == mtime:
+            rows.extend(old[relpath])
+            continue
+        rows.extend(_index_rows(root, path, format))
+    write_header_table(rows, fname, mode='w')
+    return _read_rows(fname)
+
+
+def query(index, **kwargs):
+    r"""
+    Select entries of index.
+
+    :param index: index as list of dictionaries
+    :param \*\*kwargs: conditions, either a single value for equality
+        (e.g. station='PB01') or a tuple (min, max) for an inclusive range
+        (e.g. back_azimuth=(90, 180))
+    :return: selected entries of index
+    """
+    mask = np.ones(len(index), dtype=bool)
+    for key, cond in kwargs.items():
+        if key in _UTC_HEADERS:
+            values = np.array([row.get(key, '') for row in index])
+            if isinstance(cond, (tuple, list)):
+                cond = [str(UTCDateTime(c)) for c in cond]
+            else:
+                cond = str(UTCDateTime(cond))
+        elif isinstance(cond, (tuple, list)):
+            values = np.array([row.get(key, np.nan) for row in index],
+                              dtype=float)
+        else:
+            values = np.array([row.get(key) for row in index],
+                              dtype=object)
+        if isinstance(cond, (tuple, list)):
+            mask &= (values >= cond[0]) & (values <= cond[1])
+        else:
+            mask &= values == cond
+    return [row for row, m in zip(index, mask) if m]
+
+
+def read_indexed(index, root, format=None):
+    """
+    Read traces of index entries.
+
+    Each file is opened only once.
+
+    :param index: (selected) index as list of dictionaries
+    :param root: directory of index
+    :param format: format of waveform files (default: autodetect)
+    :return: RFStream
+    """
+    from rf.rfstream import read_rf, RFStream
+    traces = collections.OrderedDict()
+    for row in index:
+        traces.setdefault(row['path'], []).append(row['trace'])
+    stream = RFStream()
+    for path, positions in traces.items():
+        stream2 = read_rf(os.path.join(root, path), format)
+        stream.extend([stream2[i] for i in positions])
+    return stream
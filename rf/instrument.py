@@ -0,0 +1,144 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Hooks for measuring the latency of processing stages.
+
+Registered callbacks are called after each stage with the arguments
+stage name, duration in seconds, number of traces and number of samples.
+Stages are the functions and methods `.RFStream.rf()`, `.deconvolve()`,
+`.RFStream.moveout()`, `.RFStream.ppoints()`, `.RFStream.stack()` and
+`.profile()` and parts of the batch processing (rfstats, get_waveforms,
+trim/merge, rotate and write).
+The number of traces and samples refers to the processed stream
+(for `.profile()` called with an iterable to the returned profile).
+If no callback is registered, the stages are not measured at all.
+
+Stages may be nested, e.g. rotate and deconvolve are part of the rf stage.
+`parent()` returns the innermost stage running in the current thread, it
+can be used by callbacks to detect nested stages. Threads running stages
+in the background, concurrently to the main processing (e.g. the writer
+thread of the batch processing), are marked with `set_background()`.
+
+>>> import rf.instrument
+>>> def callback(name, duration, ntraces, nsamples):
+...     print(name, ntraces)
+>>> rf.instrument.register(callback)
+>>> stream = read_rf().moveout()  # doctest: +SKIP
+moveout 3
+>>> rf.instrument.unregister(callback)
+"""
+import threading
+import time
+
+from decorator import decorator
+
+
+_CALLBACKS = []
+_LOCAL = threading.local()
+
+
+def register(callback):
+    """
+    Register callback.
+
+    :param callback: function with signature
+        ``callback(name, duration, ntraces, nsamples)``
+    """
+    if callback not in _CALLBACKS:
+        _CALLBACKS.append(callback)
+
+
+def unregister(callback):
+    """Remove registered callback."""
+    if callback in _CALLBACKS:
+        _CALLBACKS.remove(callback)
+
+
+def _stages():
+    """Return stack of stages running in the current thread."""
+    try:
+        return _LOCAL.stages
+    except AttributeError:
+        _LOCAL.stages = []
+        return _LOCAL.stages
+
+
+def parent():
+    """Return name of innermost running stage in this thread or None."""
+    stages = _stages()
+    return stages[-1] if stages else None
+
+
+def set_background(background=True):
+    """Mark stages of the current thread as running in the background."""
+    _LOCAL.background = background
+
+
+def is_background():
+    """Return True if the current thread runs in the background."""
+    return getattr(_LOCAL, 'background', False)
+
+
+def _size(stream):
+    """Return number of traces and samples of stream."""
+    traces = getattr(stream, 'traces', None)
+    if traces is None:
+        return 0, 0
+    return len(traces), sum(tr.stats.npts for tr in traces)
+
+
+def emit(name, duration, stream=None):
+    """Call registered callbacks for a stage."""
+    ntraces, nsamples = _size(stream)
+    for callback in list(_CALLBACKS):
+        callback(name, duration, ntraces, nsamples)
+
+
+class stage(object):
+
+    """
+    Context manager measuring a stage.
+
+    :param name: name of stage
+    :param stream: processed stream, its size is reported at the end of
+        the stage
+    """
+
+    def __init__(self, name, stream=None):
+        self.name = name
+        self.stream = stream
+        self._t1 = None
+
+    def __enter__(self):
+        if _CALLBACKS:
+            _stages().append(self.name)
+            self._t1 = time.time()
+        return self
+
+    def __exit__(self, *args):
+        if self._t1 is not None:
+            duration = time.time() - self._t1
+            _stages().pop()
+            emit(self.name, duration, self.stream)
+
+
+def instrumented(name):
+    """
+    Decorator measuring a function as stage.
+
+    The size of the first argument (the stream or self) is reported,
+    if it is not a stream the size of the returned stream.
+    """
+    def caller(func, *args, **kwargs):
+        if not _CALLBACKS:
+            return func(*args, **kwargs)
+        _stages().append(name)
+        t1 = time.time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            duration = time.time() - t1
+            _stages().pop()
+        stream = args[0] if args and hasattr(args[0], 'traces') else result
+        emit(name, duration, stream)
+        return result
+    return decorator(caller)
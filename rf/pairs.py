@@ -0,0 +1,257 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Persistent table with the results of rfstats for pairs of events and stations.
+
+`~rf.rfstream.rfstats()` calculates onset, slowness, inclination, distance,
+back azimuth and optionally the piercing point for each pair of event and
+station. The `PairTable` stores these values once per catalog, inventory
+and rfstats options, so that they can be reused by the batch commands
+and other tools (e.g. for planning data requests) without recalculation.
+Pairs which are rejected (station not available at the time of the event
+or distance outside the distance range) are stored with the reason of the
+rejection.
+
+The table is a header table (see `.archive`) in the file
+``pairs_{digest}.hdr`` of a cache directory. The digest is a hash of the
+events, the station and channel metadata and the rfstats options.
+If one of them changes, a new table is used, i.e. the table is
+invalidated automatically.
+Times (e.g. the onset) are stored as integer nanoseconds, i.e. with the
+full precision of `~obspy.core.utcdatetime.UTCDateTime`, so that the
+results do not depend on whether the table is used.
+Calculated rows are appended to the table immediately, an interrupted
+calculation continues where it stopped.
+The table is read-only in worker processes (``--jobs``), i.e. the table
+has to be complete for the processed pairs, see `PairTable.compute()`.
+
+>>> from rf.pairs import PairTable
+>>> pairs = PairTable(events, inventory, 'cache', phase='P', pp_depth=50)
+>>> pairs.compute()  # doctest: +SKIP
+>>> stats, reason = pairs.get(event, 'CX.PB01..BH?', 'Z')  # doctest: +SKIP
+
+The batch option ``pair_cache`` (``--pair-cache DIR``) uses the table for
+the commands data and pipeline.
+"""
+import hashlib
+import inspect
+import itertools
+import json
+import os.path
+
+from obspy import UTCDateTime
+from obspy.core import AttribDict
+from rf.archive import _UTC_HEADERS, stats2row, write_header_table
+from rf.util import _get_stations, _pair_stats, in_shard
+
+
+PAIRS_FNAME = 'pairs_{digest}.hdr'
+#: Version of the format of the rows, part of the digest
+PAIRS_VERSION = 2
+
+
+def _event_id(event):
+    return str(event.resource_id)
+
+
+def _pair_key(event_id, seedid):
+    return event_id + ' ' + seedid
+
+
+def _json_default(obj):
+    if isinstance(obj, UTCDateTime):
+        return obj.ns
+    return obj.item()  # numpy types
+
+
+def rfstats_options(**kwargs):
+    """Return all options of `~rf.rfstream.rfstats()` including defaults."""
+    from rf.rfstream import rfstats
+    options = inspect.getcallargs(rfstats, **kwargs)
+    for key in ('obj', 'event', 'station'):
+        options.pop(key)
+    return options
+
+
+def pairs_digest(events, inventory, **kwargs):
+    """
+    Return hash of events, inventory, rfstats options and the version of
+    the table format.
+
+    Only the properties of events, stations and channels which are used by
+    rfstats are considered.
+    """
+    def dump(obj):
+        return json.dumps(obj, sort_keys=True, default=str).encode('utf-8')
+
+    h = hashlib.sha1(dump([PAIRS_VERSION, rfstats_options(**kwargs)]))
+    lines = []
+    for event in events:
+        origin = event.preferred_origin() or event.origins[0]
+        magnitude = event.preferred_magnitude() or event.magnitudes[0]
+        lines.append(dump([_event_id(event), origin.time, origin.latitude,
+                           origin.longitude, origin.depth, magnitude.mag]))
+    for net in inventory:
+        for sta in net:
+            for cha in sta:
+                seedid = '.'.join((net.code, sta.code, cha.location_code,
+                                   cha.code))
+                lines.append(dump([seedid, cha.start_date, cha.end_date,
+                                   cha.latitude, cha.longitude,
+                                   cha.elevation, cha.depth]))
+    # the order of events and stations does not matter
+    for line in sorted(lines):
+        h.update(line)
+    return h.hexdigest()
+
+
+class PairTable(object):
+
+    r"""
+    Persistent table with the results of rfstats for pairs of events and
+    stations.
+
+    :param events: list of events or `~obspy.core.event.Catalog` instance
+    :param inventory: `~obspy.core.inventory.inventory.Inventory` instance
+    :param path: cache directory
+    :param buffer: number of rows which are written at once
+    :param \*\*kwargs: options passed to `~rf.rfstream.rfstats()`
+    """
+
+    def __init__(self, events, inventory, path='.', buffer=100, **kwargs):
+        self.events = events
+        self.inventory = inventory
+        self.kwargs = kwargs
+        self.digest = pairs_digest(events, inventory, **kwargs)
+        self.fname = os.path.join(path, PAIRS_FNAME.format(digest=self.digest))
+        self.buffer = buffer
+        self.rows = {}
+        self._pending = []
+        self._newline = False
+        self.readonly = False
+        self._load()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getstate__(self):
+        # do not pickle events and inventory for worker processes,
+        # the table is complete after compute(), the copies are read-only
+        state = self.__dict__.copy()
+        state['events'] = state['inventory'] = None
+        state['_pending'] = []
+        state['readonly'] = True
+        return state
+
+    def _load(self):
+        if not os.path.exists(self.fname):
+            return
+        with open(self.fname) as f:
+            text = f.read()
+        for line in text.splitlines():
+            try:
+                row = json.loads(line)
+            except ValueError:  # last row of interrupted calculation
+                continue
+            self.rows[_pair_key(row['event_id'], row['seedid'])] = row
+        self._newline = len(text) > 0 and not text.endswith('\n')
+
+    def flush(self):
+        """Append calculated rows to the file."""
+        if not self._pending:
+            return
+        if self.readonly:
+            raise ValueError('Pair table %s is read-only' % self.fname)
+        path = os.path.dirname(self.fname)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+        if self._newline:
+            # terminate incomplete row of an interrupted calculation
+            with open(self.fname, 'a') as f:
+                f.write('\n')
+            self._newline = False
+        write_header_table(self._pending, self.fname)
+        self._pending = []
+
+    def _compute(self, event, seedid, component):
+        stats, reason = _pair_stats(event, seedid, component, self.inventory,
+                                    **self.kwargs)
+        row = {} if stats is None else stats2row(stats)
+        row.update({'event_id': _event_id(event), 'seedid': seedid})
+        if reason is not None:
+            row['rejected'] = reason
+        # convert values like in the file, e.g. UTCDateTime to nanoseconds
+        row = json.loads(json.dumps(row, default=_json_default))
+        self.rows[_pair_key(row['event_id'], seedid)] = row
+        self._pending.append(row)
+        if len(self._pending) >= self.buffer:
+            self.flush()
+        return row
+
+    def get(self, event, seedid, component):
+        """
+        Return stats of a pair of event and station.
+
+        The stats are calculated and appended to the table if they are
+        not yet in the table.
+        A read-only table (in worker processes) raises a ValueError
+        instead.
+
+        :param event: event
+        :param seedid: seed id of station ending with '?'
+        :param component: component used to look up the station coordinates
+        :return: tuple of stats and None or None and the reason why the pair
+            is rejected ('station not available' or 'distance')
+        """
+        key = _pair_key(_event_id(event), seedid)
+        row = self.rows.get(key)
+        if row is None:
+            if self.readonly:
+                msg = 'Pair %s not in read-only pair table %s'
+                raise ValueError(msg % (key, self.fname))
+            row = self._compute(event, seedid, component)
+            self.flush()
+        if 'rejected' in row:
+            return None, row['rejected']
+        stats = dict(row)
+        del stats['event_id'], stats['seedid']
+        for head in _UTC_HEADERS:
+            if head in stats:
+                stats[head] = UTCDateTime(ns=stats[head])
+        return AttribDict(stats), None
+
+    def compute(self, pbar=None, shard=None):
+        """
+        Calculate all pairs which are not yet in the table.
+
+        :param pbar: tqdm instance for displaying a progressbar
+        :param shard: only calculate pairs of this shard, see `.in_shard()`
+        :return: number of calculated pairs
+        """
+        if self.readonly:
+            raise ValueError('Pair table %s is read-only' % self.fname)
+        stations = _get_stations(self.inventory)
+        if pbar is not None:
+            pbar.total = len(self.events) * len(stations)
+        num = 0
+        try:
+            for event, seedid in itertools.product(self.events, stations):
+                if pbar is not None:
+                    pbar.update(1)
+                if (_pair_key(_event_id(event), seedid) in self.rows or
+                        not in_shard(shard, seedid, event)):
+                    continue
+                self._compute(event, seedid, stations[seedid])
+                num += 1
+        finally:
+            self.flush()
+        return num
+
+    def iter_rows(self, rejected=False):
+        """
+        Yield rows of the table as dictionaries.
+
+        :param rejected: yield also rows of rejected pairs
+        """
+        for row in self.rows.values():
+            if rejected or 'rejected' not in row:
+                yield row
@@ -0,0 +1,337 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Dry run of batch commands with estimates of data volume, output and runtime.
+
+`plan()` determines the pairs of events and stations which are processed
+by the commands data or pipeline without retrieving data and without
+calculating travel times.
+The availability of the stations and the epicentral distances of all pairs
+are calculated at once with array operations. The spherical distances are
+checked with the exact distances of `~rf.rfstream.rfstats()` only near the
+limits of the distance range. If a `.PairTable` is given, its rows are
+used for the pairs contained in the table.
+
+The plan contains
+
+* the number of pairs, of rejected pairs by reason and of pairs
+  passing the distance filter,
+* the number of requested samples and bytes (4 bytes per sample,
+  the sampling rates are taken from the inventory),
+* the number of output files and the disk usage (estimated by writing
+  two empty example streams in the output format),
+* the estimated runtime, if a timing report written by the batch option
+  ``--timing`` is available, from the measured time per pair (rfstats per
+  pair and all other top-level stages per pair passing the distance
+  filter, nested stages and stages in the background are skipped because
+  they overlap the top-level stages).
+
+The batch command ::
+
+    rf plan data calc moveout --json plan.json
+
+prints the plan and writes it in JSON format.
+"""
+import collections
+import json
+import os.path
+import shutil
+import tempfile
+
+import numpy as np
+from rf.util import DEG2KM, _get_stations, in_shard
+
+
+#: Pairs with a spherical distance closer than this margin (in degree) to
+#: the limits of the distance range are checked with the exact distance.
+MARGIN = 0.5
+_BYTES_PER_SAMPLE = 4
+
+
+def _epochs(inventory, stations):
+    """
+    Return epochs of channels used for the station coordinates.
+
+    :return: dictionary {seed id: list of tuples (start, end, latitude,
+        longitude, sampling rate)}, start and end as timestamps
+    """
+    epochs = collections.defaultdict(list)
+    for net in inventory:
+        for sta in net:
+            for cha in sta:
+                seedid = '.'.join((net.code, sta.code, cha.location_code,
+                                   cha.code[:-1] + '?'))
+                if stations.get(seedid) != cha.code[-1]:
+                    continue
+                lat = sta.latitude if cha.latitude is None else cha.latitude
+                lon = (sta.longitude if cha.longitude is None else
+                       cha.longitude)
+                start = (-np.inf if cha.start_date is None else
+                         cha.start_date.timestamp)
+                end = (np.inf if cha.end_date is None else
+                       cha.end_date.timestamp)
+                epochs[seedid].append((start, end, lat, lon,
+                                       cha.sample_rate or np.nan))
+    return epochs
+
+
+def _spherical_distance(lat1, lon1, lat2, lon2):
+    """Return spherical distance in degree (arrays are broadcast)."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+def _default_dist_range(phase, dist_range):
+    if dist_range == 'default':
+        if phase.upper() in 'PS':
+            return (30, 90) if phase.upper() == 'P' else (50, 85)
+        return None
+    return dist_range
+
+
+def plan_pairs(events, inventory, phase='P', dist_range='default',
+               shard=None, pairs=None):
+    """
+    Determine pairs of events and stations which pass the distance filter.
+
+    :param events: list of events or `~obspy.core.event.Catalog` instance
+    :param inventory: `~obspy.core.inventory.inventory.Inventory` instance
+    :param phase,dist_range: see `~rf.rfstream.rfstats()`
+    :param shard: only consider pairs of this shard, see `.in_shard()`
+    :param pairs: `.PairTable` instance (optional)
+    :return: number of considered pairs, dictionary with numbers of
+        rejected pairs by reason and array with the sampling rates of the
+        pairs passing the distance filter
+    """
+    from obspy.geodetics import gps2dist_azimuth
+    from rf.pairs import _event_id, _pair_key
+    dist_range = _default_dist_range(phase, dist_range)
+    stations = _get_stations(inventory)
+    epochs = _epochs(inventory, stations)
+    origins = [ev.preferred_origin() or ev.origins[0] for ev in events]
+    otime = np.array([o.time.timestamp for o in origins])
+    elat = np.array([o.latitude for o in origins])
+    elon = np.array([o.longitude for o in origins])
+    total = 0
+    rejected = collections.OrderedDict([('station not available', 0),
+                                        ('distance', 0)])
+    rates = []
+    for seedid in stations:
+        if shard is None:
+            mask = np.ones(len(events), dtype=bool)
+        else:
+            mask = np.array([in_shard(shard, seedid, ev) for ev in events],
+                            dtype=bool)
+        total += int(np.count_nonzero(mask))
+        dist = np.full(len(events), np.nan)
+        sr = np.full(len(events), np.nan)
+        for start, end, lat, lon, rate in epochs[seedid][::-1]:
+            # the first matching epoch is used like in get_coordinates
+            inside = (otime >= start) & (otime <= end)
+            dist[inside] = _spherical_distance(lat, lon, elat[inside],
+                                               elon[inside])
+            sr[inside] = rate
+        available = mask & ~np.isnan(dist)
+        ok = available.copy()
+        if dist_range:
+            d1, d2 = dist_range
+            ok &= (dist >= d1 - MARGIN) & (dist <= d2 + MARGIN)
+            border = ok & ((dist < d1 + MARGIN) | (dist > d2 - MARGIN))
+            for i in np.nonzero(border)[0]:
+                for start, end, lat, lon, _ in epochs[seedid]:
+                    if start <= otime[i] <= end:
+                        break
+                d = gps2dist_azimuth(lat, lon, elat[i], elon[i])[0]
+                d = d / 1000 / DEG2KM
+                ok[i] = d1 <= d <= d2
+        if pairs is not None and len(pairs) > 0:
+            for i in np.nonzero(mask)[0]:
+                row = pairs.rows.get(_pair_key(_event_id(events[i]), seedid))
+                if row is not None:
+                    available[i] = row.get('rejected') != (
+                        'station not available')
+                    ok[i] = 'rejected' not in row
+        rejected['station not available'] += int(np.count_nonzero(
+            mask & ~available))
+        rejected['distance'] += int(np.count_nonzero(available & ~ok))
+        rates.append(sr[ok])
+    rates = np.hstack(rates) if rates else np.array([])
+    return total, rejected, rates
+
+
+def _output_npts(rates, commands, options, rf):
+    """Return number of samples per trace of the output."""
+    phase = options.get('phase', 'P')
+    window = options.get('request_window')
+    if window is None:
+        window = (-50, 150) if phase[-1].upper() == 'P' else (-100, 50)
+    npts = np.round((window[1] - window[0]) * rates) + 1
+    calc = 'calc' in commands
+    if calc and rf.get('trim'):
+        trim = rf['trim']
+        npts = np.minimum(npts, np.round((trim[1] - trim[0]) * rates) + 1)
+    if calc and rf.get('downsample'):
+        factor = np.maximum(rates // rf['downsample'], 1)
+        npts = np.ceil(npts / factor)
+    return window, npts
+
+
+def _output_size(format, dtype):
+    """
+    Estimate output size by writing three streams with two sizes.
+
+    :return: number of files and bytes independent of the number of pairs
+        and numbers of files, bytes and bytes per sample per pair
+        or None if the format cannot be written
+    """
+    from rf.batch import write
+    from rf.rfstream import RFStream, RFTrace
+    from rf.util import minimal_example_rf
+    template = minimal_example_rf()[:3]
+    path = tempfile.mkdtemp(prefix='rf_plan')
+    root = os.path.join(path, 'out')
+
+    def usage():
+        files = [os.path.join(p, f) for p, _, fs in os.walk(path)
+                 for f in fs]
+        return len(files), sum(os.path.getsize(f) for f in files)
+
+    sizes = []
+    try:
+        for i, npts in enumerate((100, 100, 1100)):
+            stream = RFStream()
+            for tr in template:
+                header = dict(tr.stats)
+                header.pop('sac', None)
+                header.pop('processing', None)
+                header['event_time'] = tr.stats.event_time + 3600 * i
+                header['onset'] = tr.stats.onset + 3600 * i
+                header['starttime'] = tr.stats.starttime + 3600 * i
+                header.pop('npts', None)
+                header.pop('endtime', None)
+                stream.append(RFTrace(data=np.zeros(npts, dtype=dtype),
+                                      header=header))
+            write(stream, root, format)
+            sizes.append(usage())
+    except ImportError:  # obspyh5 not installed
+        return
+    finally:
+        shutil.rmtree(path)
+    files_pair = sizes[1][0] - sizes[0][0]
+    bytes_pair = sizes[1][1] - sizes[0][1]
+    bytes_sample = (sizes[2][1] - sizes[1][1] - bytes_pair) / 3000.
+    bytes_pair -= 300 * bytes_sample
+    return (sizes[0][0] - files_pair, sizes[0][1] - bytes_pair - 300 *
+            bytes_sample, files_pair, bytes_pair, bytes_sample)
+
+
+def _runtime(timing, candidates, pairs, jobs, cached):
+    """Estimate runtime in seconds from timing report."""
+    if timing is None or not timing.get('pairs'):
+        return
+    stages = timing['stages']
+    t = 0
+    if not cached and 'rfstats' in stages:
+        st = stages['rfstats']
+        t += candidates * st['time'] / st['calls']
+    # nested stages (e.g. deconvolve in rf) and stages in the background
+    # (the writer thread) overlap the top-level stages
+    other = sum(st['time'] for name, st in stages.items()
+                if name != 'rfstats' and 'parent' not in st and
+                not st.get('background'))
+    t += pairs * other / timing['pairs']
+    return t / max(jobs, 1)
+
+
+def plan(command, events, inventory, commands=(), format='Q', options=None,
+         rf=None, jobs=1, shard=None, pairs=None, timing=None):
+    """
+    Return plan of batch command data or pipeline.
+
+    :param command: 'data' or 'pipeline'
+    :param events: list of events or `~obspy.core.event.Catalog` instance
+    :param inventory: `~obspy.core.inventory.inventory.Inventory` instance
+    :param commands: further commands of data ('calc', 'moveout') or
+        steps of pipeline
+    :param format: output format
+    :param options: config option options (options of `.iter_event_data()`)
+    :param rf: config option rf (options of `.RFStream.rf()`)
+    :param jobs: number of worker processes
+    :param shard: only consider pairs of this shard, see `.in_shard()`
+    :param pairs: `.PairTable` instance (optional)
+    :param timing: timing report (dictionary) or file name of timing report
+        written by the batch option ``--timing`` (optional)
+    :return: plan as ordered dictionary
+    """
+    options = options or {}
+    rf = rf or {}
+    if timing is not None and not isinstance(timing, dict):
+        with open(timing) as f:
+            timing = json.load(f)
+    phase = options.get('phase', 'P')
+    total, rejected, rates = plan_pairs(
+        events, inventory, phase=phase,
+        dist_range=options.get('dist_range', 'default'), shard=shard,
+        pairs=pairs)
+    npairs = len(rates)
+    window, npts = _output_npts(rates, commands, options, rf)
+    pad = options.get('pad', 10)
+    requested = 3 * np.nansum(
+        np.round((window[1] - window[0] + 2 * pad) * rates) + 1)
+    result = collections.OrderedDict([
+        ('command', ' '.join([command] + list(commands))),
+        ('events', len(events)),
+        ('stations', len(_get_stations(inventory))),
+        ('pairs', total),
+        ('rejected', rejected),
+        ('pairs_passing', npairs),
+        ('requested_samples', int(requested)),
+        ('requested_bytes', int(requested * _BYTES_PER_SAMPLE)),
+        ('format', format),
+        ('output_files', None),
+        ('output_bytes', None),
+        ('runtime', None)])
+    if command == 'data' or 'write' in commands:
+        # raw data is int32 as in miniSEED, receiver functions are float32,
+        # the writers convert the data to the dtype of the format
+        calc = 'calc' in commands
+        size = _output_size(format, np.float32 if calc else np.int32)
+        if size is not None:
+            files0, bytes0, files_pair, bytes_pair, bytes_sample = size
+            result['output_files'] = int(files0 * (npairs > 0) +
+                                         files_pair * npairs)
+            result['output_bytes'] = int(
+                bytes0 * (npairs > 0) + bytes_pair * npairs +
+                3 * bytes_sample * np.nansum(npts))
+    cached = pairs is not None and len(pairs) >= total
+    result['runtime'] = _runtime(timing, total, npairs, jobs, cached)
+    return result
+
+
+def _human(num, unit='B'):
+    for prefix in ('', 'k', 'M', 'G', 'T'):
+        if abs(num) < 1000 or prefix == 'T':
+            break
+        num /= 1000.
+    return '%.1f %s%s' % (num, prefix, unit)
+
+
+def format_plan(plan):
+    """Return plan as string."""
+    rejected = ', '.join('%s %d' % item for item in plan['rejected'].items())
+    lines = ['command:           %s' % plan['command'],
+             'events, stations:  %d, %d' % (plan['events'], plan['stations']),
+             'pairs:             %d' % plan['pairs'],
+             'rejected:          %s' % rejected,
+             'pairs passing:     %d' % plan['pairs_passing'],
+             'requested data:    %d samples, %s' % (
+                 plan['requested_samples'], _human(plan['requested_bytes']))]
+    if plan['output_files'] is not None:
+        lines.append('output (%s):%s%d files, %s' % (
+            plan['format'], ' ' * (9 - len(plan['format'])),
+            plan['output_files'], _human(plan['output_bytes'])))
+    if plan['runtime'] is not None:
+        lines.append('runtime:           %.1fs (estimated from timing '
+                     'report)' % plan['runtime'])
+    return '\n'.join(lines)
@@ -4,7 +4,9 @@
 Functions for receiver function profile calculation.
 """
 import numpy as np
-from rf.util import _add_processing_info, direct_geodetic
+from rf.instrument import instrumented
+from rf.util import (_add_processing_info, _percentile_traces,
+                     bootstrap_array, direct_geodetic, stack_array)
 
 
 _LARGE_BOX_WIDTH = 2000
@@ -72,17 +74,34 @@ def _find_box(latlon, boxes, crs=None):
             return box
 
 
+@instrumented('profile')
 @_add_processing_info
-def profile(stream, boxes, crs=None):
-    """
+def profile(stream, boxes, crs=None, method='mean', bootstrap=None,
+            percentiles=(2.5, 97.5), seed=None, **kwargs):
+    r"""
     Stack traces in stream by piercing point coordinates in defined boxes.
 
     :param stream: stream with pre-calculated piercing point coordinates
     :param boxes: boxes created with `get_profile_boxes()`
     :param crs: cartopy projection (default: AzimuthalEquidistant)
+    :param method: stacking method, one of 'mean', 'median', 'trim',
+        'nroot', 'pws', see `~rf.util.stack_array()`
+    :param bootstrap: number of bootstrap iterations. If set, each
+        box trace is followed by traces with the given percentiles of
+        the bootstrapped stacks (stats entry percentile),
+        see `~rf.util.bootstrap_array()`
+    :param percentiles: percentiles returned for bootstrap
+    :param seed: seed of the random number generator used for bootstrap
+    :param \*\*kwargs: other kwargs are passed to `~rf.util.stack_array()`
     :return: profile stream
+
+    For the default method 'mean' the traces are summed up on the fly.
+    For all other methods and for bootstrap the data of each box is collected
+    and stacked in one vectorized pass.
     """
     stack = {}
+    data = {}
+    collect = method != 'mean' or bootstrap
     for tr in stream:
         ppoint = (tr.stats.pp_latitude, tr.stats.pp_longitude)
         box = _find_box(ppoint, boxes, crs=crs)
@@ -100,7 +119,7 @@ def profile(stream, boxes, crs=None):
                       'profile_longitude': boxes[0]['profile']['latlon'][1],
                       'profile_azimuth': boxes[0]['profile']['azimuth'],
                       'profile_length': boxes[0]['profile']['length'],
-                      'num': 1,
+                      'num': 0,
                       'sampling_rate': tr.stats.sampling_rate,
                       'channel': '??' + comp}
             for entry in ('slowness', 'phase', 'moveout', 'processing'):
@@ -110,21 +129,78 @@ def profile(stream, boxes, crs=None):
             if 'onset' in tr.stats:
                 onset = tr.stats.onset - tr.stats.starttime
                 tr2.stats.onset = tr2.stats.starttime + onset
+            data[key] = [] if collect else 0
+        stack[key].stats.num += 1
+        if collect:
+            data[key].append(tr.data)
         else:
-            tr2 = stack[key]
-            tr2.data = tr2.data + tr.data
-            tr2.stats.num += 1
-    for tr2 in stack.values():
-        tr2.data = tr2.data / tr2.stats.num
+            data[key] = data[key] + tr.data
+    traces = []
+    for key, tr2 in stack.items():
+        if collect:
+            tr2.data = stack_array(data[key], method=method, **kwargs)
+        else:
+            tr2.data = data[key] / tr2.stats.num
+        traces.append(tr2)
+        if bootstrap:
+            perc = bootstrap_array(
+                data[key], iterations=bootstrap, percentiles=percentiles,
+                method=method, seed=seed, **kwargs)
+            traces.extend(_percentile_traces(tr2, perc, percentiles))
     if hasattr(stream, 'iterable'):  # support tqdm objects
         cls = stream.iterable.__class__
     else:
         cls = stream.__class__
     try:
-        profile = cls(traces=stack.values())
+        profile = cls(traces=traces)
     except TypeError:  # stream can be an iterator
         from rf import RFStream
-        profile = RFStream(traces=stack.values())
+        profile = RFStream(traces=traces)
+    profile.sort(['channel', 'box_pos'])
+    profile.type = 'profile'
+    return profile
+
+
+def merge_profiles(stream):
+    """
+    Merge profiles with the same boxes, e.g. profiles of different shards.
+
+    Traces of the same component and box are averaged with the number of
+    stacked traces (stats entry num) as weights. The result is the same as
+    the profile of all receiver functions for the default method 'mean'.
+    Traces with bootstrap percentiles cannot be merged and are discarded.
+
+    :param stream: stream with profiles
+    :return: merged profile stream
+    """
+    groups = {}
+    keys = []
+    discarded = 0
+    for tr in stream:
+        if 'percentile' in tr.stats:
+            discarded += 1
+            continue
+        key = (tr.stats.channel[-1], tr.stats.box_pos)
+        if key not in groups:
+            groups[key] = []
+            keys.append(key)
+        groups[key].append(tr)
+    if discarded:
+        import warnings
+        warnings.warn('Traces with bootstrap percentiles are discarded.')
+    traces = []
+    for key in keys:
+        trs = groups[key]
+        if any(tr.stats.npts != trs[0].stats.npts for tr in trs):
+            msg = 'Profile traces of box %s have different number of samples'
+            raise ValueError(msg % key[1])
+        nums = np.array([tr.stats.num for tr in trs], dtype=float)
+        tr2 = trs[0].copy()
+        data = np.dot(nums, [tr.data for tr in trs]) / np.sum(nums)
+        tr2.data = data.astype(tr2.data.dtype, copy=False)
+        tr2.stats.num = int(round(np.sum(nums)))
+        traces.append(tr2)
+    profile = stream.__class__(traces)
     profile.sort(['channel', 'box_pos'])
     profile.type = 'profile'
     return profile
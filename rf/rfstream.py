@@ -3,19 +3,21 @@
 """
 Classes and functions for receiver function calculation.
 """
+import glob
 import json
 from operator import itemgetter
-from pkg_resources import resource_filename
+import os.path
 import warnings
 
 import numpy as np
 from obspy import read, Stream, Trace
 from obspy.core import AttribDict
 from obspy.geodetics import gps2dist_azimuth
-from obspy.taup import TauPyModel
 from rf.deconvolve import deconvolve
 from rf.simple_model import load_model
-from rf.util import DEG2KM, IterMultipleComponents, _add_processing_info
+from rf.instrument import instrumented, stage
+from rf.util import (DEG2KM, IterMultipleComponents, _add_processing_info,
+                     _percentile_traces, bootstrap_array, stack_array)
 
 
 def __get_event_origin_prop(h):
@@ -55,7 +57,7 @@ _HEADERS = list(zip(*_STATION_GETTER))[0] + list(zip(*_EVENT_GETTER))[0] + (
     'onset', 'type', 'phase', 'moveout',
     'distance', 'back_azimuth', 'inclination', 'slowness',
     'pp_latitude', 'pp_longitude', 'pp_depth',
-    'box_pos', 'box_length')
+    'box_pos', 'box_length', 'percentile', 'num')
 
 # The following headers can at the moment only be stored for H5:
 # slowness_before_moveout, box_lonlat
@@ -64,7 +66,7 @@ _FORMATHEADERS = {'sac': ('stla', 'stlo', 'stel', 'evla', 'evlo',
                           'kuser0', 'kuser1', 'kuser2',
                           'gcarc', 'baz', 'user0', 'user1',
                           'user2', 'user3', 'user4',
-                          'user5', 'user6'),
+                          'user5', 'user6', 'user7', 'user8'),
                   # field 'COMMENT' is violated for different information
                   'sh': ('COMMENT', 'COMMENT', 'COMMENT',
                          'LAT', 'LON', 'DEPTH',
@@ -72,7 +74,7 @@ _FORMATHEADERS = {'sac': ('stla', 'stlo', 'stel', 'evla', 'evlo',
                          'COMMENT', 'COMMENT', 'COMMENT',
                          'DISTANCE', 'AZIMUTH', 'INCI', 'SLOWNESS',
                          'COMMENT', 'COMMENT', 'COMMENT',
-                         'COMMENT', 'COMMENT')}
+                         'COMMENT', 'COMMENT', 'COMMENT', 'COMMENT')}
 _HEADER_CONVERSIONS = {'sac': {'onset': (__SAC2UTC, __UTC2SAC),
                                'event_time': (__SAC2UTC, __UTC2SAC)}}
 
@@ -91,15 +93,112 @@ def read_rf(pathname_or_url=None, format=None, **kwargs):
     Read waveform files into RFStream object.
 
     See :func:`~obspy.core.stream.read` in ObsPy.
+    Additionally, the format 'NPY' (see `.archive`) is supported.
+    It is detected by the file ending '.npy'.
+
+    With ``headonly='lazy'`` only the headers are read. The data of a trace
+    is loaded on first access of its data attribute, only the data of this
+    trace is read (for Q and H5 files, files of other formats are read
+    again for each trace). Selecting, sorting and printing the stream works
+    on the headers alone. NPY archives are always memory-mapped and
+    therefore read lazily.
     """
     if pathname_or_url is None:   # use example file
+        from pkg_resources import resource_filename
         fname = resource_filename('rf', 'example/minimal_example.tar.gz')
         pathname_or_url = fname
         format = 'SAC'
+    if (format or '').upper() == 'NPY' or (
+            format is None and isinstance(pathname_or_url, str) and
+            pathname_or_url.lower().endswith('.npy')):
+        from rf.archive import read_npy
+        if kwargs.get('headonly') == 'lazy':
+            kwargs['headonly'] = False
+        return read_npy(pathname_or_url, **kwargs)
+    if kwargs.get('headonly') == 'lazy':
+        return _read_lazy(pathname_or_url, format, **kwargs)
     stream = read(pathname_or_url, format=format, **kwargs)
     return RFStream(stream)
 
 
+class _LazyFile(object):
+
+    """
+    Load data of single traces of a file, used by lazy traces.
+
+    :param stream: stream with headers of the file read with headonly=True
+    """
+
+    def __init__(self, fname, format, kwargs, stream):
+        self.fname = fname
+        self.format = format
+        self.kwargs = kwargs
+        self._records = None
+        if format == 'Q':
+            # position and byte order of the data of each trace in QBN file
+            path = kwargs.get('data_directory') or os.path.dirname(fname)
+            self._qbn = os.path.join(
+                path, os.path.splitext(os.path.basename(fname))[0] + '.QBN')
+            byteorder = kwargs.get('byteorder', '=')
+            offset = 0
+            self._records = []
+            for tr in stream:
+                byteorder = tr.stats.sh.get('BYTEORDER', byteorder)
+                self._records.append((offset, tr.stats.npts, byteorder))
+                offset += 4 * tr.stats.npts
+        elif format == 'H5':
+            # names of datasets in the order of obspyh5
+            import h5py
+            self._records = []
+            with h5py.File(fname, 'r') as f:
+                _h5_datasets(f['/'], self._records)
+
+    def load(self, i):
+        if self.format == 'Q':
+            offset, npts, byteorder = self._records[i]
+            with open(self._qbn, 'rb') as f:
+                f.seek(offset)
+                data = np.frombuffer(f.read(4 * npts), byteorder + 'f4')
+            return data.astype('=f4')
+        if self.format == 'H5':
+            stream = read(self.fname, format=self.format,
+                          group=self._records[i], **self.kwargs)
+            return stream[0].data
+        return read(self.fname, format=self.format, **self.kwargs)[i].data
+
+
+def _h5_datasets(group, names):
+    """Append names of datasets in group in the order of obspyh5.iterh5."""
+    import h5py
+    if isinstance(group, h5py.Dataset):
+        names.append(group.name)
+        return
+    for sub in group:
+        _h5_datasets(group[sub], names)
+
+
+def _read_lazy(pathname, format=None, **kwargs):
+    """Read headers of files and return stream of lazy traces."""
+    kwargs.pop('headonly')
+    if isinstance(pathname, str) and glob.has_magic(pathname):
+        fnames = sorted(glob.glob(pathname))
+        if len(fnames) == 0:
+            raise IOError('No file matching file pattern: %s' % pathname)
+    else:
+        fnames = [pathname]
+    traces = []
+    for fname in fnames:
+        stream = read(fname, format=format, headonly=True, **kwargs)
+        if len(stream) == 0:
+            continue
+        loader = _LazyFile(fname, stream[0].stats._format, kwargs, stream)
+        for i, tr in enumerate(stream):
+            tr = _LazyRFTrace(header=tr.stats)
+            tr._loader = (loader, i)
+            traces.append(tr)
+    return RFStream(traces)
+
+
 class RFStream(Stream):
 
     """
@@ -165,9 +264,14 @@ class RFStream(Stream):
         Save stream to file including format specific headers.
 
         See `Stream.write() <obspy.core.stream.Stream.write>` in ObsPy.
+        Format 'NPY' writes an archive (see `.archive`), use mode='a' to
+        append to an existing archive.
         """
         if len(self) == 0:
             return
+        if format.upper() == 'NPY':
+            from rf.archive import write_npy
+            return write_npy(self, filename, **kwargs)
         for tr in self:
             tr._write_format_specific_header(format)
             if format.upper() == 'Q':
@@ -234,6 +338,7 @@ class RFStream(Stream):
         self.traces = rsp.traces
         return self
 
+    @instrumented('rf')
     @_add_processing_info
     def rf(self, method=None, filter=None, trim=None, downsample=None,
            rotate='ZNE->LQT', deconvolve='time', source_components=None,
@@ -295,8 +400,9 @@ class RFStream(Stream):
                 if downsample <= tr.stats.sampling_rate:
                     tr.decimate(int(tr.stats.sampling_rate) // downsample)
         if rotate:
-            for stream3c in iter3c(self):
-                stream3c.rotate(rotate)
+            with stage('rotate', self):
+                for stream3c in iter3c(self):
+                    stream3c.rotate(rotate)
         # Multiply -1 on Q component, because Q component is pointing
         # towards the event after the rotation with ObsPy.
         # For a positive phase at a Moho-like velocity contrast,
@@ -326,6 +432,7 @@ class RFStream(Stream):
             self.method = method
         return self
 
+    @instrumented('moveout')
     @_add_processing_info
     def moveout(self, phase=None, ref=6.4, model='iasp91'):
         """
@@ -349,6 +456,7 @@ class RFStream(Stream):
             tr.stats.slowness = ref
         return self
 
+    @instrumented('ppoints')
     def ppoints(self, pp_depth, pp_phase=None, model='iasp91'):
         """
         Return coordinates of piercing point calculated by 1D ray tracing.
@@ -372,33 +480,106 @@ class RFStream(Stream):
         return np.array([(tr.stats.pp_latitude, tr.stats.pp_longitude)
                          for tr in self])
 
+    @instrumented('stack')
     @_add_processing_info
-    def stack(self):
-        """
+    def stack(self, key=None, bins=None, weights=None, method='mean',
+              bootstrap=None, percentiles=(2.5, 97.5), seed=None, **kwargs):
+        r"""
         Return stack of traces with same seed ids.
 
         Traces with same id need to have the same number of datapoints.
         Each trace in the returned stream will correspond to one unique seed
-        id.
+        id or, if key is given, to one unique combination of seed id and
+        group.
+
+        :param key: additionally group traces by this stats entry
+            (e.g. 'back_azimuth', 'distance')
+        :param bins: edges of the bins for the values of key.
+            If None, traces are grouped by the exact value of key.
+            Traces outside the bins are discarded. The stats entry key of
+            each stacked trace is set to the center of its bin.
+        :param weights: weights of the traces, an array with one value per
+            trace or the name of a stats entry (default: equal weights)
+        :param method: stacking method, one of 'mean', 'median', 'trim',
+            'nroot', 'pws', see `~rf.util.stack_array()`
+        :param bootstrap: number of bootstrap iterations. If set, each
+            stacked trace is followed by traces with the given percentiles of
+            the bootstrapped stacks (stats entry percentile),
+            see `~rf.util.bootstrap_array()`
+        :param percentiles: percentiles returned for bootstrap
+        :param seed: seed of the random number generator used for bootstrap
+        :param \*\*kwargs: other kwargs are passed to `~rf.util.stack_array()`
+
+        The traces are assigned to their groups in a single pass. The data
+        of each group is copied into one preallocated array which is stacked
+        in a vectorized manner. The stacked data are of type float64.
+        Groups with a sum of weights of zero are skipped with a warning.
         """
-        ids = set(tr.id for tr in self)
-        tr = self[0]
+        if isinstance(weights, str):
+            weights = [tr.stats[weights] for tr in self]
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)
+            if len(weights) != len(self):
+                msg = 'Number of weights (%d) and traces (%d) differ'
+                raise ValueError(msg % (len(weights), len(self)))
+        groups = {}
+        values = []
+        members = []
+        for i, tr in enumerate(self):
+            group = value = None
+            if key is not None:
+                value = tr.stats[key]
+                if bins is not None:
+                    group = np.digitize(value, bins)
+                    if group == 0 or group == len(bins):
+                        continue
+                    value = 0.5 * (bins[group - 1] + bins[group])
+                else:
+                    group = value
+            group = (tr.id, group)
+            if group not in groups:
+                groups[group] = len(groups)
+                values.append(value)
+                members.append([])
+            members[groups[group]].append(i)
         traces = []
-        for id in ids:
-            net, sta, loc, cha = id.split('.')
-            data = np.mean([tr.data for tr in self if tr.id == id], axis=0)
-            header = {'network': net, 'station': sta, 'location': loc,
-                      'channel': cha, 'sampling_rate': tr.stats.sampling_rate}
+        for value, index in zip(values, members):
+            tr = self[index[0]]
+            data = np.empty((len(index), tr.stats.npts))
+            for row, i in enumerate(index):
+                if self[i].stats.npts != tr.stats.npts:
+                    msg = 'Traces with id %s have different number of samples'
+                    raise ValueError(msg % tr.id)
+                data[row, :] = self[i].data
+            w = None if weights is None else weights[index]
+            if w is not None and np.sum(w) == 0:
+                msg = 'Skip stack of id %s with sum of weights of zero'
+                warnings.warn(msg % tr.id)
+                continue
+            if bootstrap:
+                perc = bootstrap_array(
+                    data, iterations=bootstrap, percentiles=percentiles,
+                    method=method, weights=w, seed=seed, **kwargs)
+            data = stack_array(data, method=method, weights=w, **kwargs)
+            header = {'network': tr.stats.network,
+                      'station': tr.stats.station,
+                      'location': tr.stats.location,
+                      'channel': tr.stats.channel,
+                      'sampling_rate': tr.stats.sampling_rate}
             for entry in ('phase', 'moveout', 'station_latitude',
                           'station_longitude', 'station_elevation',
                           'processing'):
                 if entry in tr.stats:
                     header[entry] = tr.stats[entry]
+            if key is not None:
+                header[key] = value
             tr2 = RFTrace(data=data, header=header)
             if 'onset' in tr.stats:
                 onset = tr.stats.onset - tr.stats.starttime
                 tr2.stats.onset = tr2.stats.starttime + onset
             traces.append(tr2)
+            if bootstrap:
+                traces.extend(_percentile_traces(tr2, perc, percentiles))
         return self.__class__(traces)
 
     def profile(self, *args, **kwargs):
@@ -410,6 +591,24 @@ class RFStream(Stream):
         from rf.profile import profile
         return profile(self, *args, **kwargs)
 
+    def harmonics(self, *args, **kwargs):
+        """
+        Return back-azimuth harmonic decomposition of the stream.
+
+        See `.harmonics.harmonics()` for help on arguments.
+        """
+        from rf.harmonics import harmonics
+        return harmonics(self, *args, **kwargs)
+
+    def hk_stack(self, *args, **kwargs):
+        """
+        Return H-κ stack of the receiver functions in the stream.
+
+        See `.hk.hk_stack()` for help on arguments.
+        """
+        from rf.hk import hk_stack
+        return hk_stack(self, *args, **kwargs)
+
     def plot_rf(self, *args, **kwargs):
         """
         Create receiver function plot.
@@ -484,6 +683,8 @@ class RFTrace(Trace):
             o3.append('pos:{box_pos:.2f}km')
         if 'slowness' in self.stats:
             o3.append('slow:{slowness:.2f}')
+        if 'percentile' in self.stats:
+            o3.append('perc:{percentile:.1f}%')
         if 'moveout' in self.stats:
             o3.append('({moveout} moveout)')
         if np.ma.count_masked(self.data):
@@ -589,6 +790,55 @@ class RFTrace(Trace):
         RFStream([self]).write(filename, format, **kwargs)
 
 
+class _LazyRFTrace(RFTrace):
+
+    """
+    RFTrace loading its data on first access, see `read_rf()`.
+
+    The attribute _loader holds the `_LazyFile` instance and the position
+    of the trace in the file until the data is loaded or set.
+    """
+
+    _loader = None
+
+    @property
+    def data(self):
+        if self._loader is not None:
+            loader, i = self._loader
+            self._loader = None
+            self.data = loader.load(i)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self.__dict__['_data'] = value
+        self.__dict__['_loader'] = None
+
+    def __str__(self, id_length=None):
+        if self._loader is None:
+            return super(_LazyRFTrace, self).__str__(id_length=id_length)
+        # print headers without loading the data
+        loader = self._loader
+        self._loader = None
+        try:
+            return super(_LazyRFTrace, self).__str__(id_length=id_length)
+        finally:
+            self._loader = loader
+
+
+_TAUP_CACHE = {}
+
+
+def _get_taup_model(name):
+    """Return cached `~obspy.taup.tau.TauPyModel` instance."""
+    try:
+        return _TAUP_CACHE[name]
+    except KeyError:
+        from obspy.taup import TauPyModel
+        _TAUP_CACHE[name] = model = TauPyModel(model=name)
+        return model
+
+
 def obj2stats(event=None, station=None):
     """
     Map event and station object to stats with attributes.
@@ -666,14 +916,14 @@ def rfstats(obj=None, event=None, station=None,
     dist = dist / 1000 / DEG2KM
     if dist_range and not dist_range[0] <= dist <= dist_range[1]:
         return
-    tt_model = TauPyModel(model=tt_model)
+    tt_model = _get_taup_model(tt_model)
     arrivals = tt_model.get_travel_times(stats.event_depth, dist, (phase,))
     if len(arrivals) == 0:
         raise Exception('TauPy does not return phase %s at distance %s' %
                         (phase, dist))
     if len(arrivals) > 1:
         msg = ('TauPy returns more than one arrival for phase %s at '
-               'distance -> take first arrival')
+               'distance %s -> take first arrival')
         warnings.warn(msg % (phase, dist))
     arrival = arrivals[0]
     onset = stats.event_time + arrival.time
@@ -0,0 +1,346 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Long-lived process running batch jobs sent to a Unix socket.
+
+Every call of the rf command line utility reads the events and stations
+and loads TauPy and `~rf.simple_model.SimpleModel` models again.
+The command ``rf serve`` starts a process which keeps these objects in
+memory and runs jobs sent to the Unix socket ``rf.sock``.
+This is useful for submitting a lot of small jobs, e.g. one job per
+station from a workflow scheduler.
+
+A job is a JSON object with the options of the configuration file
+(see :ref:`config_label`), the command and the arguments of the command
+line (commands, path_in, path_out, newformat, pipeline, shard, ...).
+Alternatively, the key ``conf`` names a configuration file, the other
+options of the job take precedence.
+Relative paths are relative to the working directory of the server.
+The client sends the job in one line and receives messages in JSON format,
+one per line, until the connection is closed by the server::
+
+    {"status": "queued", "job": 1}
+    {"status": "running", "job": 1, "worker": 4711}
+    {"status": "progress", "job": 1, "done": 8, "total": 13}
+    {"status": "done", "job": 1, "time": 3.2}
+
+The last message has the status ``done`` or ``error`` (with the error
+message in ``error``).
+The jobs are run by a pool of ``workers`` processes, at most ``workers``
+jobs are running at the same time, the other jobs are queued.
+Each worker process loads the models at start and reads events and
+stations of a job once, they are read again only if the modification
+time of the file changes.
+The message with status ``running`` contains the process id of the worker
+in ``worker``.
+Closing the connection before the job finished cancels the job at the next
+progress message.
+The options timing and metrics are not supported, because they measure
+all jobs running in a worker process. The option jobs is not supported,
+the jobs already run in several processes.
+
+>>> from rf.serve import submit
+>>> for msg in submit({'command': 'data', 'commands': ['calc'],
+...                    'conf': 'conf.json', 'path_out': 'rf',
+...                    'shard': '1/100'}):  # doctest: +SKIP
+...     print(msg)
+"""
+import json
+import multiprocessing
+import os
+import socket
+import threading
+from timeit import default_timer
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from rf.batch import ConfigJSONDecoder, ParseError, run_commands
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+SOCKET = 'rf.sock'
+#: Commands which cannot be run by the server
+_UNSUPPORTED = ('create', 'print', 'serve')
+#: Caches of a worker process, set by `_init_worker()`
+_WORKER = {}
+
+
+def _read_events(fname, format=None):
+    from obspy import read_events
+    return read_events(fname, format)
+
+
+def _read_inventory(fname, format=None):
+    from obspy import read_inventory
+    return read_inventory(fname, format)
+
+
+class _FileCache(object):
+
+    """
+    Objects read from files, read again if the modification time changes.
+
+    :param read: function reading the object, called with file name and
+        format
+    """
+
+    def __init__(self, read):
+        self.read = read
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def get(self, value):
+        """
+        Return object for value of configuration option.
+
+        Values which are not file names (or lists of file name and format)
+        of existing files are returned unchanged.
+        """
+        fname, format = value, None
+        if (isinstance(value, list) and len(value) == 2 and
+                isinstance(value[0], basestring)):
+            fname, format = value
+        if not isinstance(fname, basestring) or not os.path.isfile(fname):
+            return value
+        key = (os.path.abspath(fname), format)
+        mtime = os.path.getmtime(fname)
+        with self.lock:
+            entry = self.objects.get(key)
+            if entry is None or entry[0] != mtime:
+                entry = self.objects[key] = (mtime, self.read(fname, format))
+        return entry[1]
+
+
+class _Progress(object):
+
+    """
+    Progressbar sending the progress of a job.
+
+    At most one message is sent per interval seconds. The job is cancelled
+    with an exception if the event cancel is set.
+    """
+
+    def __init__(self, send, interval=1., cancel=None):
+        self.send = send
+        self.interval = interval
+        self.cancel = cancel
+        self.total = None
+        self.done = 0
+        self._last = None
+
+    def update(self, n=1):
+        if self.cancel is not None and self.cancel.is_set():
+            raise RuntimeError('job cancelled')
+        self.done += n
+        now = default_timer()
+        if (self._last is None or now - self._last >= self.interval or
+                self.done == self.total):
+            self._last = now
+            self.send({'status': 'progress', 'done': self.done,
+                       'total': self.total})
+
+
+def load_models(models):
+    """Load TauPy and SimpleModel models into the caches of rf."""
+    from rf.rfstream import _get_taup_model
+    from rf.simple_model import load_model
+    for model in models:
+        _get_taup_model(model)
+        load_model(model)
+
+
+def _init_worker(models):
+    """Load models and create caches of events and stations."""
+    load_models(models)
+    _WORKER['events'] = _FileCache(_read_events)
+    _WORKER['inventories'] = _FileCache(_read_inventory)
+
+
+def run_job(spec, progress=None):
+    """
+    Run job with the cached events and stations of this process.
+
+    :param spec: dictionary with the job, see module documentation
+    :param progress: function returning progressbars
+    """
+    spec = dict(spec)
+    command = spec.pop('command', None)
+    if command is None or command in _UNSUPPORTED:
+        raise ParseError('Unsupported command: %s' % command)
+    conf = spec.pop('conf', None)
+    if conf:
+        with open(conf) as f:
+            kw = json.load(f, cls=ConfigJSONDecoder)
+        kw.update(spec)
+        spec = kw
+    for opt in ('timing', 'metrics'):
+        if spec.get(opt):
+            raise ParseError('Option %s is not supported by serve' % opt)
+    if spec.get('jobs', 1) > 1:
+        raise ParseError('Option jobs is not supported by serve')
+    if not _WORKER:
+        _init_worker(())
+    if 'events' in spec:
+        spec['events'] = _WORKER['events'].get(spec['events'])
+    if 'inventory' in spec:
+        spec['inventory'] = _WORKER['inventories'].get(spec['inventory'])
+    run_commands(command, progress=progress, **spec)
+
+
+def _run_job(spec, messages, cancel, interval):
+    """
+    Run job in worker process and put its messages into the queue.
+
+    The last message has the status done or error.
+    """
+    messages.put({'status': 'running', 'worker': os.getpid()})
+    t1 = default_timer()
+    try:
+        run_job(spec, lambda: _Progress(messages.put, interval, cancel))
+    except Exception as ex:
+        msg = '%s: %s' % (ex.__class__.__name__, ex)
+        messages.put({'status': 'error', 'error': msg})
+    else:
+        messages.put({'status': 'done', 'time': default_timer() - t1})
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        job = server.next_job()
+
+        def send(msg):
+            msg['job'] = job
+            self.wfile.write((json.dumps(msg) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+        cancel = None
+        try:
+            line = self.rfile.readline().decode('utf-8')
+            try:
+                spec = json.loads(line, cls=ConfigJSONDecoder)
+            except ValueError as ex:
+                send({'status': 'error', 'error': 'invalid job: %s' % ex})
+                return
+            send({'status': 'queued'})
+            messages = server.manager.Queue()
+            cancel = server.manager.Event()
+            server.pool.apply_async(
+                _run_job, (spec, messages, cancel, server.interval))
+            while True:
+                msg = messages.get()
+                send(msg)
+                if msg['status'] in ('done', 'error'):
+                    break
+        except socket.error:
+            # client closed connection
+            if cancel is not None:
+                cancel.set()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    """
+    Server running jobs sent to a Unix socket.
+
+    Connections are handled in threads, the jobs are run by a pool of
+    worker processes.
+
+    :param address: path of the Unix socket
+    :param workers: number of worker processes, i.e. maximal number of
+        jobs running at the same time
+    :param interval: minimal interval between two progress messages of a
+        job in seconds
+    :param models: TauPy and SimpleModel models loaded at start of the
+        worker processes
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=SOCKET, workers=4, interval=1.,
+                 models=('iasp91',)):
+        _remove_stale_socket(address)
+        # start processes before the threads of the server
+        self.pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                         initargs=(models,))
+        self.manager = multiprocessing.Manager()
+        socketserver.UnixStreamServer.__init__(self, address, _Handler)
+        self.workers = workers
+        self.interval = interval
+        self._jobs = 0
+        self._lock = threading.Lock()
+
+    def next_job(self):
+        with self._lock:
+            self._jobs += 1
+            return self._jobs
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.pool.terminate()
+        self.pool.join()
+        self.manager.shutdown()
+
+
+def _remove_stale_socket(address):
+    """Remove socket file left by a server which is not running anymore."""
+    if not os.path.exists(address):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+    except socket.error:
+        os.remove(address)
+    else:
+        raise ParseError('Server already running at %s' % address)
+    finally:
+        sock.close()
+
+
+def serve(socket=SOCKET, workers=4, interval=1.):
+    """
+    Run jobs sent to Unix socket until interrupted.
+
+    :param socket: path of the Unix socket
+    :param workers: number of worker processes, i.e. maximal number of
+        jobs running at the same time
+    :param interval: minimal interval between two progress messages of a
+        job in seconds
+    """
+    server = Server(socket, workers=workers, interval=interval)
+    print('rf serve: listening on %s with %d workers' % (socket, workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def submit(job, address=SOCKET):
+    """
+    Send job to server and yield its messages.
+
+    :param job: dictionary with the job, see module documentation
+    :param address: path of the Unix socket
+    :return: generator of dictionaries
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+        sock.sendall((json.dumps(job) + '\n').encode('utf-8'))
+        f = sock.makefile('rb')
+        for line in f:
+            yield json.loads(line.decode('utf-8'))
+        f.close()
+    finally:
+        sock.close()
@@ -3,7 +3,6 @@
 Simple move out and piercing point calculation.
 """
 from math import floor
-from pkg_resources import resource_filename
 
 import numpy as np
 from rf.util import direct_geodetic, DEG2KM
@@ -34,6 +33,7 @@ def load_model(fname='iasp91'):
         pass
     fname_key = fname
     if fname == 'iasp91':
+        from pkg_resources import resource_filename
         fname = resource_filename('rf', 'data/iasp91.dat')
     values = np.loadtxt(fname, unpack=True)
     try:
@@ -81,14 +81,16 @@ class SimpleModel(object):
         """
         Calculate vertical slowness of P and S wave.
 
-        :param slowness: slowness in s/deg
+        :param slowness: slowness in s/deg, scalar or array
         :param phase: Weather to calculate only P, only S or both vertical
             slownesses
         :return: vertical slowness of P wave, vertical slowness of S wave
-            at different depths (z attribute of model instance)
+            at different depths (z attribute of model instance),
+            for an array of slownesses the depth is the last axis
         """
         phase = phase.upper()
-        hslow = slowness / DEG2KM  # convert to horizontal slowness (s/km)
+        # convert to horizontal slowness (s/km)
+        hslow = np.asarray(slowness)[..., np.newaxis] / DEG2KM
         qp, qs = 0, 0
         # catch warnings because of negative root
         # these values will be nan
@@ -103,15 +105,16 @@ class SimpleModel(object):
         """
         Calculate delay times between direct wave and converted phase.
 
-        :param slowness: ray parameter in s/deg
+        :param slowness: ray parameter in s/deg, scalar or array
         :param phase: Converted phase or multiple (e.g. Ps, Pppp)
-        :return: delay times at different depths
+        :return: delay times at different depths (bottoms of the layers),
+            for an array of slownesses the depth is the last axis
         """
         phase = phase.upper()
         qp, qs = self.calculate_vertical_slowness(slowness, phase=phase)
         dt = (qp * phase.count('P') + qs * phase.count('S') -
               2 * (qp if phase[0] == 'P' else qs)) * self.dz
-        return np.cumsum(dt)
+        return np.cumsum(dt, axis=-1)
 
     def stretch_delay_times(self, slowness, phase='Ps', ref=6.4):
         """
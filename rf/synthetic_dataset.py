@@ -0,0 +1,331 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Synthetic dataset of events, stations and waveforms for load tests.
+
+`create_synthetic_dataset()` writes a catalog with N teleseismic events
+(QuakeML), an inventory with M stations (StationXML) and 3 component
+waveforms of all pairs of events and stations in an SDS archive
+(miniSEED, readable with the ObsPy client ``filesystem.sds``).
+The seismograms are calculated in the LQT system:
+The L component is a Gaussian pulse, the Q component consists of the
+converted phase Ps and the multiples PpPs and PpSs of the interfaces with
+delay times calculated with a `.SimpleModel`, the T component is zero.
+The components are rotated to ZNE with the back azimuth and inclination
+and white noise and gaps are added.
+Receiver functions calculated from these seismograms show the converted
+phases at the delay times of the model.
+
+All random numbers are drawn from one seeded generator, the waveforms of
+all stations of an event are calculated at once with array operations.
+Onset, slowness and inclination are interpolated from a table of travel
+times calculated once with TauPy for a grid of distances and the
+discrete event depths.
+
+The dataset can also be created with the batch command ::
+
+    rf create --synthetic 100 50
+"""
+import os.path
+import shutil
+
+import numpy as np
+from obspy import UTCDateTime
+from rf.util import DEG2KM
+
+
+EVENT_DEPTHS = (10., 35., 100., 200., 400., 600.)
+_TT_DISTANCES = np.arange(20, 97, 2.)
+_TT_CACHE = {}
+SDS_FNAME = ('{year}/{network}/{station}/{channel}.D/'
+             '{network}.{station}.{location}.{channel}.D.{year}.{doy:03d}')
+
+
+def _travel_time_table(depth, phase='P', model='iasp91'):
+    """
+    Return travel times, slownesses and incident angles at the distances
+    of the table for an event depth.
+    """
+    from rf.rfstream import _get_taup_model
+    key = (depth, phase, model)
+    if key not in _TT_CACHE:
+        taup = _get_taup_model(model)
+        table = np.empty((3, len(_TT_DISTANCES)))
+        for i, dist in enumerate(_TT_DISTANCES):
+            arrival = taup.get_travel_times(depth, dist, (phase,))[0]
+            table[:, i] = (arrival.time, arrival.ray_param_sec_degree,
+                           arrival.incident_angle)
+        _TT_CACHE[key] = table
+    return _TT_CACHE[key]
+
+
+def _direct(lat, lon, azi, dist):
+    """Return coordinates at spherical distance and azimuth (degree)."""
+    lat, lon, azi, dist = map(np.radians, (lat, lon, azi, dist))
+    lat2 = np.arcsin(np.sin(lat) * np.cos(dist) +
+                     np.cos(lat) * np.sin(dist) * np.cos(azi))
+    lon2 = lon + np.arctan2(np.sin(azi) * np.sin(dist) * np.cos(lat),
+                            np.cos(dist) - np.sin(lat) * np.sin(lat2))
+    lon2 = (np.degrees(lon2) + 180) % 360 - 180
+    return np.degrees(lat2), lon2
+
+
+def synthetic_events(nevents, latlon=(-21., -69.5), dist_range=(25, 93),
+                     starttime='2011-01-01', interval=3600, seed=None):
+    """
+    Return catalog with random teleseismic events.
+
+    :param nevents: number of events
+    :param latlon: coordinates of the center of the stations
+    :param dist_range: range of the distance of the events to the center
+    :param starttime: time of the first event
+    :param interval: mean time between events in seconds, additionally
+        the events are separated by at least 15 minutes, so that the
+        waveforms of different events do not overlap
+    :param seed: seed or `numpy.random.RandomState` instance
+    :return: `~obspy.core.event.Catalog`
+    """
+    from obspy.core.event import Catalog, Event, Magnitude, Origin
+    rs = np.random.RandomState(seed) if not hasattr(seed, 'rand') else seed
+    azi = rs.uniform(0, 360, nevents)
+    dist = rs.uniform(dist_range[0], dist_range[1], nevents)
+    lat, lon = _direct(latlon[0], latlon[1], azi, dist)
+    depth = np.array(EVENT_DEPTHS)[rs.randint(len(EVENT_DEPTHS),
+                                              size=nevents)]
+    mag = np.round(rs.uniform(5.5, 7., nevents), 1)
+    times = np.cumsum(900 + rs.exponential(interval, nevents))
+    starttime = UTCDateTime(starttime)
+    events = []
+    for i in range(nevents):
+        origin = Origin(time=starttime + times[i], latitude=lat[i],
+                        longitude=lon[i], depth=1000 * depth[i])
+        magnitude = Magnitude(mag=mag[i], magnitude_type='Mw')
+        event = Event(origins=[origin], magnitudes=[magnitude])
+        event.preferred_origin_id = origin.resource_id.id
+        event.preferred_magnitude_id = magnitude.resource_id.id
+        events.append(event)
+    return Catalog(events)
+
+
+def synthetic_inventory(nstations, latlon=(-21., -69.5), radius=2.,
+                        sampling_rate=10., network='SY', seed=None):
+    """
+    Return inventory with random stations.
+
+    :param nstations: number of stations
+    :param latlon: coordinates of the center of the stations
+    :param radius: maximal distance of stations to the center in degree
+    :param sampling_rate: sampling rate of the channels BHZ, BHN, BHE
+    :param network: network code, station codes are S0001, S0002, ...
+    :param seed: seed or `numpy.random.RandomState` instance
+    :return: `~obspy.core.inventory.inventory.Inventory`
+    """
+    from obspy.core.inventory import Channel, Inventory, Network, Station
+    rs = np.random.RandomState(seed) if not hasattr(seed, 'rand') else seed
+    azi = rs.uniform(0, 360, nstations)
+    dist = radius * np.sqrt(rs.uniform(0, 1, nstations))
+    lat, lon = _direct(latlon[0], latlon[1], azi, dist)
+    elev = np.round(rs.uniform(0, 2000, nstations))
+    stations = []
+    for i in range(nstations):
+        kw = {'latitude': lat[i], 'longitude': lon[i], 'elevation': elev[i]}
+        channels = [Channel(cha, '', depth=0, azimuth=azimuth, dip=dip,
+                            sample_rate=sampling_rate, **kw)
+                    for cha, azimuth, dip in (('BHZ', 0, -90),
+                                              ('BHN', 0, 0),
+                                              ('BHE', 90, 0))]
+        stations.append(Station('S%04d' % (i + 1), channels=channels,
+                                creation_date=UTCDateTime(2000, 1, 1), **kw))
+    return Inventory([Network(network, stations=stations)], 'rf')
+
+
+def _delay_times(model, slowness, phase, depth):
+    """Return delay times of phase at interface depth for all slownesses."""
+    # delay times at the layer bottoms, one row per slowness
+    delays = model.calculate_delay_times(slowness, phase)
+    zb = model.z + model.dz
+    # same as np.interp(depth, zb, row) for each row
+    i = min(max(np.searchsorted(zb, depth), 1), len(zb) - 1)
+    w = min(max((depth - zb[i - 1]) / (zb[i] - zb[i - 1]), 0), 1)
+    return (1 - w) * delays[:, i - 1] + w * delays[:, i]
+
+
+def _pairs(event, inventory, phase='P'):
+    """Return coordinates, distance, back azimuth and travel time table."""
+    from obspy.geodetics import gps2dist_azimuth
+    origin = event.preferred_origin() or event.origins[0]
+    coords = []
+    for net in inventory:
+        for sta in net:
+            coords.append((net.code, sta.code, sta.latitude, sta.longitude))
+    dist = np.empty(len(coords))
+    baz = np.empty(len(coords))
+    for i, (_, _, lat, lon) in enumerate(coords):
+        # use the same geodetic calculation as rfstats
+        d, baz[i], _ = gps2dist_azimuth(lat, lon, origin.latitude,
+                                        origin.longitude)
+        dist[i] = d / 1000 / DEG2KM
+    table = _travel_time_table(origin.depth / 1000, phase=phase)
+    tt, slowness, inc = [np.interp(dist, _TT_DISTANCES, row)
+                         for row in table]
+    return coords, origin.time, tt, slowness, inc, baz
+
+
+def synthetic_waveforms(event, inventory, model='iasp91',
+                        interfaces=((35., 0.15),), phase_amplitudes=(
+                            ('Ps', 1.), ('PpPs', 0.5), ('PpSs', -0.5)),
+                        window=(-100, 200), width=0.5, noise=0.05, gaps=0.,
+                        seed=None):
+    """
+    Return 3 component seismograms of one event at all stations.
+
+    :param event: event
+    :param inventory: inventory, the sampling rate of the first channel
+        is used for all stations
+    :param model: `.SimpleModel` instance or name of model file
+        for the delay times
+    :param interfaces: tuples of depth (km) and amplitude of the Ps
+        conversion relative to the direct P wave
+    :param phase_amplitudes: phases and their amplitudes relative to the
+        Ps conversion
+    :param window: time window around the onset of the P wave in seconds
+    :param width: width of the Gaussian pulse in seconds
+    :param noise: standard deviation of white noise relative to the
+        amplitude of the P wave
+    :param gaps: fraction of event-station pairs with a gap of 5s
+        20s after the onset in one of the components
+    :param seed: seed or `numpy.random.RandomState` instance
+    :return: `~obspy.core.stream.Stream`
+    """
+    from obspy import Stream, Trace
+    from rf.simple_model import load_model
+    rs = np.random.RandomState(seed) if not hasattr(seed, 'rand') else seed
+    if not hasattr(model, 'moveout'):
+        model = load_model(model)
+    coords, otime, tt, slowness, inc, baz = _pairs(event, inventory)
+    sr = inventory[0][0][0].sample_rate
+    npts = int(round((window[1] - window[0]) * sr)) + 1
+    # start at a sample of the sampling rate, onset is between samples
+    onset = np.array([otime + t for t in tt])
+    start = [UTCDateTime(round((o + window[0]).timestamp * sr) / sr)
+             for o in onset]
+    t = (np.arange(npts) / sr)[np.newaxis, :] + np.array(
+        [s - o for s, o in zip(start, onset)])[:, np.newaxis]
+    mag = (event.preferred_magnitude() or event.magnitudes[0]).mag
+    amp = 1000 * 10 ** (mag - 6)
+
+    def pulse(delay):
+        return np.exp(-((t - delay[:, np.newaxis]) / width) ** 2)
+
+    nsta = len(coords)
+    ldata = pulse(np.zeros(nsta))
+    qdata = np.zeros_like(ldata)
+    for depth, amplitude in interfaces:
+        for phase, phase_amp in phase_amplitudes:
+            delay = _delay_times(model, slowness, phase, depth)
+            qdata += amplitude * phase_amp * pulse(delay)
+    # Q points towards the event in ObsPy's LQT system, see RFStream.rf
+    qdata = -qdata
+    # rotate LQT -> ZNE for all stations at once, T component is zero
+    # (same as obspy.signal.rotate.rotate_lqt_zne)
+    ba = np.radians(baz)[:, np.newaxis]
+    inc = np.radians(inc)[:, np.newaxis]
+    z = ldata * np.cos(inc) + qdata * np.sin(inc)
+    n = (-ldata * np.sin(inc) * np.cos(ba) +
+         qdata * np.cos(inc) * np.cos(ba))
+    e = (-ldata * np.sin(inc) * np.sin(ba) +
+         qdata * np.cos(inc) * np.sin(ba))
+    data = amp * (np.array([z, n, e]) +
+                  rs.normal(0, noise, (3, nsta, npts)))
+    data = data.astype(np.float32)
+    gap = rs.uniform(0, 1, nsta) < gaps
+    gap_comp = rs.randint(3, size=nsta)
+    stream = Stream()
+    for i, (net, sta, _, _) in enumerate(coords):
+        for j, cha in enumerate(('BHZ', 'BHN', 'BHE')):
+            header = {'network': net, 'station': sta, 'location': '',
+                      'channel': cha, 'sampling_rate': sr,
+                      'starttime': start[i]}
+            if gap[i] and gap_comp[i] == j:
+                i1 = int((20 - window[0]) * sr)
+                i2 = i1 + int(5 * sr)
+                stream.append(Trace(data[j, i, :i1], header=header))
+                header['starttime'] = start[i] + i2 / sr
+                stream.append(Trace(data[j, i, i2:], header=header))
+            else:
+                stream.append(Trace(data[j, i], header=header))
+    return stream
+
+
+def _split_days(tr):
+    """Split trace at midnight."""
+    traces = []
+    while True:
+        t = tr.stats.starttime
+        midnight = UTCDateTime(t.year, t.month, t.day) + 24 * 3600
+        if tr.stats.endtime < midnight:
+            traces.append(tr)
+            return traces
+        k = int(np.ceil((midnight - t) * tr.stats.sampling_rate))
+        tr2 = tr.copy()
+        tr.data = tr.data[:k]
+        tr2.data = tr2.data[k:]
+        tr2.stats.starttime = t + k * tr.stats.delta
+        traces.append(tr)
+        tr = tr2
+
+
+def write_sds(stream, root):
+    """
+    Append traces of stream to the day files of an SDS archive.
+
+    Existing day files are not overwritten, see
+    `create_synthetic_dataset()`.
+    """
+    for tr in stream:
+        for tr2 in _split_days(tr):
+            t = tr2.stats.starttime
+            fname = os.path.join(root, SDS_FNAME.format(
+                year=t.year, doy=t.julday, **tr2.stats))
+            head = os.path.dirname(fname)
+            if not os.path.isdir(head):
+                os.makedirs(head)
+            with open(fname, 'ab') as f:
+                tr2.write(f, 'MSEED', encoding='FLOAT32')
+
+
+def create_synthetic_dataset(nevents, nstations, path='.', seed=0,
+                             events_fname='synthetic_events.xml',
+                             inventory_fname='synthetic_inventory.xml',
+                             data_root='synthetic_data', sampling_rate=10.,
+                             **kwargs):
+    r"""
+    Create and write synthetic events, stations and waveforms.
+
+    :param nevents,nstations: number of events and stations
+    :param path: directory of the files
+    :param seed: seed of the random number generator
+    :param events_fname,inventory_fname: file names of events and inventory
+    :param data_root: root directory of SDS archive with waveforms
+    :param sampling_rate: sampling rate of the waveforms
+    :param \*\*kwargs: passed to `synthetic_waveforms()`
+    :return: events and inventory
+
+    An existing SDS archive at data_root is removed before the waveforms
+    are written.
+    Use the configuration options
+    ``"data": "filesystem.sds", "client_options": {"sds_root": data_root}``
+    for processing the dataset.
+    """
+    rs = np.random.RandomState(seed)
+    events = synthetic_events(nevents, seed=rs)
+    inventory = synthetic_inventory(nstations, sampling_rate=sampling_rate,
+                                    seed=rs)
+    root = os.path.join(path, data_root)
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+    events.write(os.path.join(path, events_fname), 'QUAKEML')
+    inventory.write(os.path.join(path, inventory_fname), 'STATIONXML')
+    for event in events:
+        stream = synthetic_waveforms(event, inventory, seed=rs, **kwargs)
+        write_sds(stream, root)
+    return events, inventory
@@ -0,0 +1,262 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Forward modelling of P and S receiver functions for layered models.
+
+The response of a stack of homogeneous isotropic layers over a half space
+to a plane P or SV wave incident from below is calculated in the frequency
+domain with propagator matrices (Haskell method).
+The surface displacement is rotated to the LQT system with the incidence
+angle at the surface and the receiver function is the spectral ratio of
+the Q and L components (P receiver functions) or of the L and Q components
+(S receiver functions) filtered with a Gaussian low-pass.
+Signs, normalization and mirroring of S receiver functions are the same as
+for receiver functions calculated with `.RFStream.rf()`.
+
+All models and slownesses are calculated at once with array operations.
+Models with a different number of layers are padded with layers of zero
+thickness.
+
+>>> from rf.synthetics import synthetic_rf
+>>> model = ([0, 35], [6.0, 8.0], [3.5, 4.5])
+>>> stream = synthetic_rf(model, [5., 6., 7., 8.])
+>>> stream.select(component='Q').plot_rf()  # doctest: +SKIP
+
+Models can be specified like the arguments of `.SimpleModel` by a tuple
+of depths of the top of the layers (the last layer is the half space),
+P and S wave velocities and optionally densities, or by a
+`.SimpleModel` instance.
+"""
+import numpy as np
+from obspy import UTCDateTime
+from rf.util import DEG2KM
+
+
+def _layers(model):
+    """Return thickness, vp, vs and rho of model, the last is half space."""
+    if hasattr(model, 'vp'):
+        z, vp, vs = model.z, model.vp, model.vs
+        rho = None
+    else:
+        z, vp, vs = model[:3]
+        rho = model[3] if len(model) > 3 else None
+    z, vp, vs = [np.asarray(v, dtype=float) for v in (z, vp, vs)]
+    if not len(z) == len(vp) == len(vs):
+        raise ValueError('Depths and velocities of model differ in length')
+    if np.any(vs <= 0):
+        raise ValueError('Only solid layers with vs > 0 are supported')
+    if rho is None:
+        # relation between density and P wave velocity (Berteussen, 1977)
+        rho = 0.32 * vp + 0.77
+    thickness = np.hstack((np.diff(z), [0.]))
+    return np.array([thickness, vp, vs, np.asarray(rho, dtype=float)])
+
+
+def _as_models(models):
+    """Return array of shape (number of models, 4, number of layers)."""
+    if hasattr(models, 'vp') or np.ndim(models[0][0]) == 0:
+        models = [models]
+    layers = [_layers(model) for model in models]
+    nl = max(l.shape[1] for l in layers)
+    result = np.empty((len(layers), 4, nl))
+    for i, l in enumerate(layers):
+        n = l.shape[1]
+        result[i, :, :n - 1] = l[:, :-1]
+        # pad with layers of zero thickness with half space velocities
+        result[i, :, n - 1:] = l[:, -1:]
+        result[i, 0, n - 1:] = 0
+    return result
+
+
+def _eigenvectors(p, vp, vs, rho):
+    """
+    Return eigenvector matrices of the motion-stress vector and vertical
+    slownesses.
+
+    The motion-stress vector is (u_x, u_z, tau_xz / (i omega),
+    tau_zz / (i omega)) with z pointing downwards. The columns correspond
+    to the down-going P and S and the up-going P and S waves.
+    """
+    p = p + 0j
+    eta_a = np.sqrt(vp ** -2 - p ** 2 + 0j)
+    eta_b = np.sqrt(vs ** -2 - p ** 2 + 0j)
+    mu = rho * vs ** 2
+    c = mu * (eta_b ** 2 - p ** 2)
+    E = np.empty(np.broadcast(p, vp).shape + (4, 4), dtype=complex)
+    for j, sign in ((0, 1), (2, -1)):
+        E[..., 0, j] = p
+        E[..., 1, j] = sign * eta_a
+        E[..., 2, j] = sign * 2 * mu * p * eta_a
+        E[..., 3, j] = c
+        E[..., 0, j + 1] = sign * eta_b
+        E[..., 1, j + 1] = -p
+        E[..., 2, j + 1] = c
+        E[..., 3, j + 1] = -sign * 2 * mu * p * eta_b
+    return E, eta_a, eta_b
+
+
+def surface_response(models, slowness, freq, phase='P'):
+    """
+    Return spectra of vertical and radial surface displacement.
+
+    :param models: model or list of models, see module documentation
+    :param slowness: array of slownesses (ray parameters) in s/deg
+    :param freq: array of frequencies in Hz
+    :param phase: 'P' or 'S' for an incident P or SV wave
+        with unit amplitude in the half space
+    :return: complex arrays of the vertical (positive upwards) and radial
+        (positive in the direction of propagation) displacement with shape
+        (number of models, number of slownesses, number of frequencies)
+
+    The spectra follow the sign convention of `numpy.fft`.
+    """
+    return _surface_response(_as_models(models), slowness, freq, phase)
+
+
+def _surface_response(layers, slowness, freq, phase):
+    p = np.asarray(slowness, dtype=float) / DEG2KM
+    p = p[np.newaxis, :]
+    omega = 2 * np.pi * np.asarray(freq, dtype=float)
+    # propagate the motion-stress vectors of the two free surface
+    # solutions (u_x = 1 and u_z = 1) down to the top of the half space
+    B = np.zeros(layers.shape[:1] + p.shape[1:2] + omega.shape + (4, 2),
+                 dtype=complex)
+    B[..., 0, 0] = 1
+    B[..., 1, 1] = 1
+    for k in range(layers.shape[2] - 1):
+        d, vp, vs, rho = [v[:, np.newaxis] for v in
+                          layers[:, :, k].T]
+        if np.all(d == 0):
+            continue
+        E, eta_a, eta_b = _eigenvectors(p, vp, vs, rho)
+        Einv = np.linalg.inv(E)
+        d = d[..., np.newaxis]
+        # phase shifts of the four waves for all frequencies
+        arg = 1j * omega * d
+        lam = np.exp(np.array([arg * eta_a[..., np.newaxis],
+                               arg * eta_b[..., np.newaxis],
+                               -arg * eta_a[..., np.newaxis],
+                               -arg * eta_b[..., np.newaxis]]))
+        lam = np.moveaxis(lam, 0, -1)
+        W = np.matmul(Einv[:, :, np.newaxis], B)
+        B = np.matmul(E[:, :, np.newaxis], lam[..., np.newaxis] * W)
+    _, vp, vs, rho = [v[:, np.newaxis] for v in
+                      layers[:, :, -1].T]
+    E, _, _ = _eigenvectors(p, vp, vs, rho)
+    # amplitudes of the up-going waves in the half space
+    A = np.matmul(np.linalg.inv(E)[:, :, np.newaxis, 2:, :], B)
+    det = A[..., 0, 0] * A[..., 1, 1] - A[..., 0, 1] * A[..., 1, 0]
+    if phase.upper() == 'P':
+        ux, uz = A[..., 1, 1] / det, -A[..., 1, 0] / det
+    elif phase.upper() == 'S':
+        ux, uz = -A[..., 0, 1] / det, A[..., 0, 0] / det
+    else:
+        raise ValueError("phase must be one of 'P', 'S'")
+    # time dependence exp(-i omega t) -> sign convention of numpy.fft
+    return np.conjugate(-uz), np.conjugate(ux)
+
+
+def synthetic_rf_data(models, slowness, phase='P', sampling_rate=10.,
+                      window=(-10, 70), gauss=2.):
+    """
+    Return data of synthetic receiver functions.
+
+    :param models: model or list of models, see module documentation
+    :param slowness: array of slownesses (ray parameters) in s/deg
+    :param phase: 'P' or 'S' for P or S receiver functions
+    :param sampling_rate: sampling rate in Hz
+    :param window: time window relative to the onset in seconds
+    :param gauss: Gauss parameter of low-pass filter (see `.deconvf()`)
+    :return: array with shape (number of models, number of slownesses,
+        3 components L, Q, T, number of samples) and incidence angles
+        in degree with shape (number of models, number of slownesses)
+
+    Phases arriving later than the end of the window may wrap around.
+    """
+    from obspy.signal.util import next_pow_2
+    phase = phase.upper()
+    if phase not in 'PS' or len(phase) != 1:
+        raise ValueError("phase must be one of 'P', 'S'")
+    layers = _as_models(models)
+    slowness = np.asarray(slowness, dtype=float)
+    npts = int(round((window[1] - window[0]) * sampling_rate)) + 1
+    nfft = 2 * next_pow_2(npts)
+    freq = np.fft.rfftfreq(nfft, 1. / sampling_rate)
+    v0 = layers[:, 1 if phase == 'P' else 2, 0, np.newaxis]
+    inc = np.arcsin(slowness[np.newaxis, :] / DEG2KM * v0)
+    data = np.zeros(layers.shape[:1] + slowness.shape + (3, npts))
+    # calculate chunks of models to limit memory usage
+    chunk = max(1, 100000 // (len(slowness) * len(freq)))
+    for i in range(0, len(layers), chunk):
+        z, r = _surface_response(layers[i:i + chunk], slowness, freq,
+                                 phase)
+        ci = np.cos(inc[i:i + chunk, :, np.newaxis])
+        si = np.sin(inc[i:i + chunk, :, np.newaxis])
+        l = z * ci + r * si
+        # Q component points away from the event as after RFStream.rf()
+        q = r * ci - z * si
+        src, rsp = (l, q) if phase == 'P' else (q, l)
+        # S receiver functions are mirrored at the onset afterwards
+        tshift = -window[0] if phase == 'P' else window[1]
+        filt = np.exp(-(np.pi * freq / gauss) ** 2 -
+                      2j * np.pi * freq * tshift)
+        rf_src = np.fft.irfft(filt, nfft)[:npts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rf_rsp = np.fft.irfft(filt * rsp / src, nfft)[..., :npts]
+        rf_rsp = np.nan_to_num(rf_rsp) / np.max(rf_src)
+        j1, j2 = (0, 1) if phase == 'P' else (1, 0)
+        data[i:i + chunk, :, j1, :] = rf_src / np.max(rf_src)
+        data[i:i + chunk, :, j2, :] = rf_rsp
+    if phase == 'S':
+        data = data[..., ::-1]
+    return data, np.degrees(inc)
+
+
+def synthetic_rf(models, slowness, phase='P', sampling_rate=10.,
+                 window=(-10, 70), gauss=2., back_azimuth=0.,
+                 starttime=UTCDateTime(0), channel='BH'):
+    """
+    Return synthetic receiver functions.
+
+    :param models: model or list of models, see module documentation
+    :param slowness: slowness or array of slownesses (ray parameters)
+        in s/deg
+    :param phase: 'P' or 'S' for P or S receiver functions
+    :param sampling_rate: sampling rate in Hz
+    :param window: time window relative to the onset in seconds
+    :param gauss: Gauss parameter of low-pass filter (see `.deconvf()`)
+    :param back_azimuth: back azimuth written to the headers
+    :param starttime: onset of the first receiver function, the onsets
+        of the following slownesses are shifted by one hour each,
+        so that receiver functions can be told apart by their onset
+        (e.g. with `.IterMultipleComponents`)
+    :param channel: first two letters of the channel codes
+    :return: `.RFStream` with L, Q and T components for all models and
+        slownesses, the station code of the i-th model is M0001+i
+
+    The headers type, phase, method, onset, slowness, inclination and
+    back_azimuth are set, the receiver functions can be processed further
+    e.g. with `.RFStream.moveout()` or `.RFStream.stack()`.
+    """
+    from rf.rfstream import RFStream, RFTrace
+    slowness = np.atleast_1d(np.asarray(slowness, dtype=float))
+    data, inc = synthetic_rf_data(models, slowness, phase=phase,
+                                  sampling_rate=sampling_rate, window=window,
+                                  gauss=gauss)
+    phase = phase.upper()
+    starttime = UTCDateTime(starttime)
+    traces = []
+    for i in range(data.shape[0]):
+        for j in range(data.shape[1]):
+            onset = starttime + 3600 * j
+            for k, comp in enumerate('LQT'):
+                header = {'network': 'SY', 'station': 'M%04d' % (i + 1),
+                          'location': '', 'channel': channel + comp,
+                          'sampling_rate': sampling_rate,
+                          'starttime': onset + window[0], 'onset': onset,
+                          'type': 'rf', 'phase': phase, 'method': phase,
+                          'slowness': slowness[j],
+                          'inclination': inc[i, j],
+                          'back_azimuth': back_azimuth}
+                traces.append(RFTrace(data=data[i, j, k].copy(),
+                                      header=header))
+    return RFStream(traces)
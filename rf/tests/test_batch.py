@@ -3,6 +3,7 @@
 Tests for batch module.
 """
 from glob import glob
+import json
 import unittest
 import os
 from pkg_resources import load_entry_point
@@ -11,8 +12,13 @@ import warnings
 import matplotlib
 matplotlib.use('Agg')
 
-from rf.batch import init_data, run_cli as script
+import numpy as np
+from rf import read_rf, RFStream
+import rf.batch
+from rf.batch import (AsyncWriter, Writer, init_data, run_cli as script,
+                      write)
 from rf.tests.util import quiet, tempdir
+from rf.util import minimal_example_rf
 try:
     import obspyh5
 except ImportError:
@@ -28,6 +34,46 @@ def substitute(old, new):
         f.write(text)
 
 
+def _read_files(root, format):
+    """Return dictionary with content of all output files of root."""
+    if format in ('Q', 'SAC'):
+        fnames = glob(os.path.join(root, '*', '*'))
+        key = lambda fname: os.path.relpath(fname, root)
+    else:
+        fnames = glob(root + '.*')
+        key = lambda fname: os.path.splitext(fname)[1]
+    contents = {}
+    for fname in fnames:
+        with open(fname, 'rb') as f:
+            contents[key(fname)] = f.read()
+    return contents
+
+
+def _mtimes(root, format):
+    """Return modification times of all output files of root."""
+    if format in ('Q', 'SAC'):
+        fnames = glob(os.path.join(root, '*', '*'))
+    else:
+        fnames = glob(root + '.' + format.lower())
+    return {fname: os.path.getmtime(fname) for fname in fnames}
+
+
+def _read_stream(root, format):
+    """Read all receiver functions or profile traces written to root."""
+    if format == 'SAC':
+        fnames = [os.path.join(root, '*.SAC'),
+                  os.path.join(root, '*', '*.SAC')]
+    elif format == 'Q':
+        fnames = [root + '.QHD', os.path.join(root, '*', '*.QHD')]
+    else:
+        fnames = [root + '.' + format.lower()]
+    stream = RFStream()
+    for fname in fnames:
+        if glob(fname):
+            stream.extend(read_rf(fname, format))
+    return stream
+
+
 def test_format(testcase, format):
     join = os.path.join
 
@@ -41,23 +87,108 @@ def test_format(testcase, format):
         script(['moveout', 'datarf', 'mout2'])
         script(['stack', 'mout1', 'stack'])
         script(['profile', 'mout1', 'profile'])
+        script(['hk', 'mout1', 'hk'])
+        testcase.assertEqual(len(glob(join('hk', '*.npz'))), 1)
+        if format in ('Q', 'SAC'):
+            script(['index', 'mout1'])
+            testcase.assertTrue(os.path.exists(join('mout1', 'index.hdr')))
+            script(['stack', 'mout1', 'stack_indexed'])
+            script(['moveout', 'datarf', 'mout_indexed'])
+            testcase.assertEqual(len(glob(join('stack_indexed', '*'))),
+                                 len(glob(join('stack', '*'))))
         if format in ('Q', 'SAC'):
             patterns = [join('data', '*', '*'), join('mout1', '*', '*'),
                         join('mout2', '*', '*'), join('stack', '*'),
                         join('profile', '*') if format == 'SAC' else
                         'profile*.*']
         else:
-            patterns = ['data.h5', 'mout1.h5', 'mout2.h5', 'stack.h5',
-                        'profile.h5']
+            ext = format.lower()
+            patterns = ['data.' + ext, 'mout1.' + ext, 'mout2.' + ext,
+                        'stack.' + ext, 'profile.' + ext]
         nums = [len(glob(p)) for p in patterns]
         nums2 = {'Q': [14, 14, 14, 2, 2],
                  'SAC': [21, 21, 21, 3, 6],
-                 'H5': [1, 1, 1, 1, 1]}
+                 'H5': [1, 1, 1, 1, 1],
+                 'NPY': [1, 1, 1, 1, 1]}
         testcase.assertEqual(nums, nums2[format])
-        if format in ('Q', 'H5'):
+        # sharded processing and merging of shards
+        for i in (1, 2):
+            shard = '%d/2' % i
+            script(['--shard', shard, 'calc', 'moveout', 'data', 'mout_s'])
+            script(['--shard', shard, 'profile', 'mout1', 'profile_s'])
+        if format in ('H5', 'NPY'):
+            testcase.assertEqual(len(glob('mout_s_shard*')),
+                                 2 if format == 'H5' else 4)
+            script(['merge', 'mout_s', 'mout_s'])
+        script(['merge', 'profile_s', 'profile_s'])
+        for root, root2 in (('mout1', 'mout_s'), ('profile', 'profile_s')):
+            stream = _read_stream(root, format)
+            stream2 = _read_stream(root2, format)
+            testcase.assertEqual(len(stream2), len(stream))
+            stream.sort()
+            stream2.sort()
+            for tr, tr2 in zip(stream, stream2):
+                testcase.assertEqual(tr.id, tr2.id)
+                testcase.assertEqual(tr.stats.get('num'), tr2.stats.get('num'))
+                np.testing.assert_allclose(tr2.data, tr.data, rtol=1e-5,
+                                           atol=1e-6)
+        # incremental processing
+        if format != 'NPY':
+            args = ['--incremental', 'moveout', 'datarf', 'mout_inc']
+            script(args)
+            files = _read_files('mout_inc', format)
+            files.pop('.json', None)  # manifest
+            testcase.assertEqual(files, _read_files('mout2', format))
+            mtimes = _mtimes('mout_inc', format)
+            script(args)
+            testcase.assertEqual(_mtimes('mout_inc', format), mtimes)
+            script(['--moveout', '{"phase": "Ppps"}'] + args)
+            testcase.assertNotEqual(_mtimes('mout_inc', format), mtimes)
+            if format in ('Q', 'SAC'):
+                # missing outputs are written again
+                ext = '*.QHD' if format == 'Q' else '*.SAC'
+                fname = sorted(glob(join('mout_inc', '*', ext)))[0]
+                os.remove(fname)
+                script(['--moveout', '{"phase": "Ppps"}'] + args)
+                testcase.assertTrue(os.path.exists(fname))
+                # shards write separate manifests, which are merged
+                args = ['--incremental', 'moveout', 'datarf', 'mout_inc_s']
+                for i in (1, 2):
+                    script(['--shard', '%d/2' % i] + args)
+                testcase.assertEqual(
+                    len(glob(join('mout_inc_s', 'manifest.*of2.json'))), 2)
+                mtimes = _mtimes('mout_inc_s', format)
+                script(args)
+                testcase.assertEqual(_mtimes('mout_inc_s', format), mtimes)
+        # single pass pipeline
+        script(['pipeline', 'pipe', 'calc', 'moveout', 'stack', 'profile',
+                'write'])
+        for root, root2 in (('mout1', join('pipe', 'rf')),
+                            ('stack', join('pipe', 'stack')),
+                            ('profile', join('pipe', 'profile'))):
+            stream = _read_stream(root, format)
+            stream2 = _read_stream(root2, format)
+            testcase.assertEqual(len(stream2), len(stream))
+            stream.sort()
+            stream2.sort()
+            for tr, tr2 in zip(stream, stream2):
+                testcase.assertEqual(tr.id, tr2.id)
+                np.testing.assert_allclose(tr2.data, tr.data, rtol=1e-3,
+                                           atol=1e-3 * max(abs(tr.data)))
+        # parallel processing gives the same files
+        script(['data', 'data_jobs', '--jobs', '2'])
+        script(['calc', 'moveout', 'data', 'mout_jobs', '-j', '2'])
+        for root, root2 in (('data', 'data_jobs'), ('mout1', 'mout_jobs')):
+            testcase.assertEqual(_read_files(root2, format),
+                                 _read_files(root, format))
+        if format in ('Q', 'H5', 'NPY'):
             script(['convert', 'mout1', 'mout_SAC', 'SAC'])
-        if format in ('H5', 'SAC'):
+            testcase.assertEqual(len(glob(join('mout_SAC', '*', '*'))), 21)
+        if format in ('H5', 'SAC', 'NPY'):
             script(['convert', 'mout1', 'mout_Q', 'Q'])
+        if format in ('Q', 'SAC'):
+            script(['convert', 'mout1', 'mout_NPY', 'NPY'])
+            testcase.assertEqual(len(glob('mout_NPY.*')), 2)
         if obspyh5 and format in ('Q', 'SAC'):
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
@@ -92,6 +223,187 @@ class BatchTestCase(unittest.TestCase):
     def test_batch_command_interface_H5(self):
         test_format(self, 'H5')
 
+    def test_batch_command_interface_NPY(self):
+        test_format(self, 'NPY')
+
+    @unittest.skipIf(obspyh5 is None, 'obspyh5 not installed')
+    def test_writer_H5(self):
+        stream = minimal_example_rf()
+        for tr in stream:
+            tr.stats.pop('sac')
+        streams = [stream[i:i + 3] for i in range(0, len(stream), 3)]
+        with tempdir():
+            for st in streams:
+                write(st, 'rf1', 'H5')
+            with Writer('rf2', 'H5', buffer=5) as writer:
+                for st in streams:
+                    writer.write(st)
+                self.assertIsNotNone(writer._h5)
+            self.assertIsNone(writer._h5)
+            # other versions of obspyh5 use the public interface
+            versions = rf.batch.H5_KEEP_OPEN_VERSIONS
+            rf.batch.H5_KEEP_OPEN_VERSIONS = ()
+            try:
+                with Writer('rf3', 'H5', buffer=5) as writer:
+                    for st in streams:
+                        writer.write(st)
+                    self.assertIsNone(writer._h5)
+            finally:
+                rf.batch.H5_KEEP_OPEN_VERSIONS = versions
+            stream1 = read_rf('rf1.h5')
+            self.assertEqual(len(stream1), len(stream))
+            for fname in ('rf2.h5', 'rf3.h5'):
+                stream2 = read_rf(fname)
+                self.assertEqual(str(stream1), str(stream2))
+
+    def test_async_writer(self):
+        stream = minimal_example_rf()
+        with tempdir():
+            written = []
+            with AsyncWriter('rf', 'NPY', buffer=2, maxsize=1) as writer:
+                for i in range(len(stream)):
+                    writer.write(stream[i:i + 1],
+                                 callback=lambda i=i: written.append(i))
+            stream2 = read_rf('rf.npy')
+            self.assertEqual(str(stream2), str(stream))
+            # callbacks are called after the streams were written
+            self.assertEqual(sorted(written), list(range(len(stream))))
+            # errors of the writer thread are raised in the main thread
+            written = []
+            writer = AsyncWriter('rf', 'unknown_format')
+            writer.write(stream, callback=lambda: written.append(0))
+            with self.assertRaises(KeyError):
+                writer.close()
+            self.assertEqual(written, [])
+
+    def test_timing(self):
+        stages = ['rfstats', 'get_waveforms', 'trim/merge', 'rotate',
+                  'deconvolve', 'moveout', 'write']
+        with tempdir():
+            script(['create', '-t'])
+            for jobs in ('1', '2'):
+                with quiet():
+                    script(['--timing', 'data', 'calc', 'moveout', 'mout',
+                            '-j', jobs])
+                with open('timing.json') as f:
+                    report = json.load(f)
+                for name in stages + ['rf']:
+                    self.assertIn(name, report['stages'])
+                self.assertEqual(report['pairs'], 7)
+                self.assertEqual(report['stages']['rfstats']['calls'],
+                                 7 + sum(report['rejected'].values()))
+                self.assertGreater(report['pairs_per_second'], 0)
+                # nested stages overlap the rf stage
+                for name in ('rotate', 'deconvolve'):
+                    self.assertEqual(report['stages'][name]['parent'], 'rf')
+            # metrics file in the text format of Prometheus
+            script(['--metrics', 'rf.prom', '--metrics-interval', '0.01',
+                    'data', 'calc', 'mout_metrics', '-j', '2'])
+            with open('rf.prom') as f:
+                lines = f.read().splitlines()
+            for line in ('rf_pairs_processed_total 7.0',
+                         'rf_pairs_rejected_total{reason="distance"} 6.0',
+                         'rf_stage_duration_seconds_count{stage="rfstats"} '
+                         '13.0',
+                         'rf_queue_depth{queue="write"} 0.0',
+                         'rf_queue_depth{queue="tasks"} 0.0'):
+                self.assertIn(line, lines)
+            written = [l for l in lines if l.startswith('rf_written_bytes')]
+            self.assertGreater(float(written[0].split()[1]), 0)
+            self.assertFalse(os.path.exists('rf.prom.tmp'))
+
+    def test_npy_rerun(self):
+        # running a command again replaces the archive
+        with tempdir():
+            script(['create', '-t'])
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                for _ in range(2):
+                    script(['--format', 'NPY', 'data', 'calc', 'rf'])
+                    self.assertEqual(len(read_rf('rf.npy')), 21)
+                    script(['--format', 'NPY', 'moveout', 'rf', 'mout'])
+                    self.assertEqual(len(read_rf('mout.npy')), 21)
+                    script(['--format', 'NPY', 'stack', 'mout', 'stack'])
+                    self.assertEqual(len(read_rf('stack.npy')), 3)
+                # traces appended again replace earlier traces when read
+                stream = read_rf('rf.npy')
+                write(stream[:3], 'rf', 'NPY')
+                self.assertEqual(len(read_rf('rf.npy')), 24)
+                script(['--format', 'NPY', 'moveout', 'rf', 'mout'])
+                self.assertEqual(len(read_rf('mout.npy')), 21)
+
+    def test_index_update(self):
+        # files written after building the index are added to the index
+        with tempdir():
+            script(['create', '-t'])
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                script(['--shard', '1/2', 'data', 'calc', 'rf'])
+                script(['index', 'rf'])
+                num = len(glob(os.path.join('rf', '*', '*.QHD')))
+                script(['--shard', '2/2', 'data', 'calc', 'rf'])
+                # files written again replace their entries
+                script(['--shard', '2/2', 'data', 'calc', 'rf'])
+                script(['moveout', 'rf', 'mout'])
+            from rf.index import read_index
+            self.assertLess(num, 7)
+            self.assertEqual(len(glob(os.path.join('rf', '*', '*.QHD'))), 7)
+            self.assertEqual(len(read_index('rf')), 21)
+            self.assertEqual(len(glob(os.path.join('mout', '*', '*.QHD'))),
+                             7)
+
+    def test_sharded_layout(self):
+        with tempdir():
+            script(['create', '-t'])
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                for format in ('Q', 'SAC'):
+                    args = ['--format', format]
+                    script(args + ['data', 'calc', 'rf_flat'])
+                    script(args + ['--layout', 'sharded', 'data', 'calc',
+                                   'rf_' + format])
+                    # files of both layouts are read without option
+                    script(args + ['stack', 'rf_' + format,
+                                   'stack_' + format])
+                    script(args + ['stack', 'rf_flat', 'stack_flat'])
+                    script(args + ['--layout', 'sharded', 'convert',
+                                   'rf_' + format, 'rf2_' + format, 'Q'])
+                    script(args + ['--layout', 'sharded', 'index',
+                                   'rf_' + format])
+                    # files are listed only once after a rerun
+                    script(args + ['--layout', 'sharded', 'data', 'calc',
+                                   'rf_' + format])
+            for format in ('Q', 'SAC'):
+                ext = '.QHD' if format == 'Q' else '.SAC'
+                root = 'rf_' + format
+                fnames = glob(os.path.join(root, '*', '*', '*', '*' + ext))
+                self.assertEqual(glob(os.path.join(root, '*', '*.*')),
+                                 [os.path.join(root, 'CX.PB01.', 'files.hdr')])
+                self.assertEqual(len(fnames), 7 * (format == 'Q' or 3))
+                for fname in fnames:
+                    year, month = fname.split(os.sep)[2:4]
+                    self.assertIn(year + '-' + month, fname)
+                stream1 = read_rf(os.path.join(root, '*', '*', '*', '*' + ext))
+                stream2 = read_rf(os.path.join('rf2_' + format, '*', '*',
+                                               '*', '*.QHD'))
+                self.assertEqual(len(stream1), 21)
+                self.assertEqual(len(stream2), 21)
+                # file list of station directories
+                fnames2 = []
+                for fname in glob(os.path.join(root, '*', 'files.hdr')):
+                    with open(fname) as f:
+                        rows = [json.loads(line) for line in f]
+                    fnames2.extend(os.path.join(root, row['path'])
+                                   for row in rows)
+                self.assertEqual(sorted(fnames2), sorted(fnames))
+                self.assertTrue(os.path.exists(os.path.join(root,
+                                                            'index.hdr')))
+                stack1 = read_rf(os.path.join('stack_' + format, '*' + ext))
+                stack2 = read_rf(os.path.join('stack_flat', '*' + ext))
+                self.assertEqual(len(stack1), len(stack2))
+                for tr1, tr2 in zip(stack1.sort(), stack2.sort()):
+                    np.testing.assert_array_equal(tr1.data, tr2.data)
+
     def test_plugin_option(self):
         f = init_data('plugin', plugin='rf.tests.test_batch : gw_test')
         self.assertEqual(f(nework=4, station=2), 42)
@@ -0,0 +1,63 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Tests for benchmarks module.
+"""
+import unittest
+
+from rf.benchmarks import (IMPORT_BUDGET, append_history, compare, find_run,
+                           import_time, read_history, run_benchmarks,
+                           synthetic_stream)
+from rf.tests.util import tempdir
+
+
+class BenchmarksTestCase(unittest.TestCase):
+
+    def test_synthetic_stream(self):
+        stream = synthetic_stream(10)
+        self.assertEqual(len(stream), 12)
+        self.assertEqual(
+            len(set(str(tr.stats.event_time) for tr in stream)), 4)
+        self.assertEqual(str(synthetic_stream(10)), str(stream))
+        stream = synthetic_stream(3, raw=True)
+        self.assertEqual([tr.stats.channel[-1] for tr in stream],
+                         ['E', 'N', 'Z'])
+
+    def test_run_benchmarks(self):
+        names = ['moveout', 'stack', 'write_Q', 'read_Q', 'rfstats']
+        results = run_benchmarks(names, sizes=(6, 12), repeat=1)
+        self.assertEqual(sorted(results), sorted(names))
+        for name in names:
+            self.assertEqual(sorted(results[name]), ['12', '6'])
+        with tempdir():
+            append_history(results, 'history.json', label='a')
+            self.assertIsNone(find_run(read_history('history.json')))
+            append_history(results, 'history.json')
+            history = read_history('history.json')
+            self.assertEqual(len(history), 2)
+            self.assertEqual(find_run(history)['label'], 'a')
+            self.assertEqual(find_run(history, 'a')['label'], 'a')
+            self.assertIsNone(find_run(history, 'no-such-label'))
+
+    def test_compare(self):
+        old = {'stack': {'1000': 1.0, '10000': 10.0}}
+        new = {'stack': {'1000': 1.1, '10000': 13.0, '100000': 130.}}
+        rows = compare(old, new, threshold=0.2)
+        self.assertEqual([row[1] for row in rows], [1000, 10000])
+        self.assertEqual([row[-1] for row in rows], [False, True])
+
+    def test_import_time(self):
+        # heavy dependencies are imported on first use,
+        # allow for noise of the measurement on busy machines,
+        # the benchmark runner checks the budget itself
+        for module in ('rf', 'rf.batch'):
+            t, imported = import_time(module)
+            self.assertEqual(imported, [])
+            self.assertLess(t, 3 * IMPORT_BUDGET)
+
+
+def suite():
+    return unittest.makeSuite(BenchmarksTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
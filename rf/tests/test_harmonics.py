@@ -0,0 +1,78 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Tests for harmonics module.
+"""
+import unittest
+import warnings
+
+import numpy as np
+from rf import RFStream
+from rf.harmonics import HARMONICS, harmonics
+from rf.rfstream import RFTrace
+from rf.util import minimal_example_rf
+
+
+def synthetic_harmonics(coef, bazs):
+    """Return Q and T traces for given harmonic coefficients."""
+    coef = np.asarray(coef, dtype=float)
+    traces = []
+    for i, baz in enumerate(bazs):
+        b = np.radians(baz)
+        q = (coef[0] + coef[1] * np.cos(b) + coef[2] * np.sin(b) +
+             coef[3] * np.cos(2 * b) + coef[4] * np.sin(2 * b))
+        t = (coef[1] * np.sin(b) - coef[2] * np.cos(b) +
+             coef[3] * np.sin(2 * b) - coef[4] * np.cos(2 * b))
+        for comp, data in (('Q', q), ('T', t)):
+            tr = RFTrace(data=data, header={'channel': 'BH' + comp,
+                                            'back_azimuth': baz})
+            tr.stats.onset = tr.stats.starttime + i
+            traces.append(tr)
+    return RFStream(traces)
+
+
+class HarmonicsTestCase(unittest.TestCase):
+
+    def test_harmonics_synthetic(self):
+        coef = np.random.RandomState(0).normal(size=(5, 20))
+        stream = synthetic_harmonics(coef, np.arange(0, 360, 20))
+        result = stream.harmonics()
+        self.assertEqual(len(result), 5)
+        self.assertEqual([tr.stats.harmonic for tr in result],
+                         list(HARMONICS))
+        self.assertEqual(result[1].stats.channel, 'BH1')
+        for tr, c in zip(result, coef):
+            np.testing.assert_allclose(tr.data, c, atol=1e-10)
+        result = harmonics(stream, components='Q')
+        for tr, c in zip(result, coef):
+            np.testing.assert_allclose(tr.data, c, atol=1e-10)
+
+    def test_harmonics_underdetermined(self):
+        coef = np.random.RandomState(0).normal(size=(5, 20))
+        stream = synthetic_harmonics(coef, [30, 30, 30])
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            stream.harmonics()
+        self.assertEqual(len(w), 1)
+        self.assertIn('not constrain', str(w[0].message))
+
+    def test_harmonics_bootstrap(self):
+        stream = minimal_example_rf()
+        result = stream.harmonics(bootstrap=50, seed=1)
+        self.assertEqual(len(result), 15)
+        self.assertEqual([tr.stats.get('percentile') for tr in result[:3]],
+                         [None, 2.5, 97.5])
+        self.assertIn('harmonics(', ' '.join(result[0].stats.processing))
+        # result does not depend on chunk size
+        result2 = stream.harmonics(bootstrap=50, seed=1, chunksize=7)
+        for tr1, tr2 in zip(result, result2):
+            np.testing.assert_allclose(tr1.data, tr2.data, atol=1e-10)
+        with self.assertRaises(ValueError):
+            stream.harmonics(components='L')
+
+
+def suite():
+    return unittest.makeSuite(HarmonicsTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
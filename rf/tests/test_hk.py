@@ -0,0 +1,70 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Tests for hk module.
+"""
+import unittest
+
+import numpy as np
+from rf import RFStream
+from rf.hk import _delay_times, hk_stack
+from rf.rfstream import RFTrace
+from rf.simple_model import SimpleModel
+
+
+def synthetic_rf(H=35., k=1.75, vp=6.3, slownesses=(5., 6., 7., 8.)):
+    """Return stream with spikes at delay times of Ps and multiples."""
+    traces = []
+    for slowness in slownesses:
+        times = np.arange(-10, 40, 0.1)
+        data = np.exp(-(times / 0.3) ** 2)
+        for phase, amp in zip(('Ps', 'PpPs', 'PpSs'), (0.3, 0.2, -0.1)):
+            t = _delay_times([H], [k], [slowness], vp, phase)[0, 0, 0]
+            data += amp * np.exp(-((times - t) / 0.3) ** 2)
+        tr = RFTrace(data=data)
+        tr.stats.sampling_rate = 10.
+        tr.stats.channel = 'BHQ'
+        tr.stats.onset = tr.stats.starttime + 10
+        tr.stats.slowness = slowness
+        traces.append(tr)
+    return RFStream(traces)
+
+
+class HkTestCase(unittest.TestCase):
+
+    def test_delay_times_consistent_with_simple_model(self):
+        model = SimpleModel(np.array([0, 35, 35.]), np.array([6.3, 6.3, 8.]),
+                            np.array([3.6, 3.6, 4.5]))
+        for phase in ('Ps', 'PpPs', 'PpSs'):
+            t1 = model.calculate_delay_times(6.4, phase=phase)[0]
+            t2 = _delay_times([35], [6.3 / 3.6], [6.4], 6.3, phase)[0, 0, 0]
+            self.assertAlmostEqual(t1, t2)
+
+    def test_hk_stack(self):
+        stream = synthetic_rf()
+        stream.append(stream[0].copy())
+        stream[-1].stats.channel = 'BHT'
+        result = stream.hk_stack()
+        self.assertEqual(result.stack.shape, (201, 161))
+        self.assertEqual(result.num, 4)
+        self.assertAlmostEqual(result.H_best, 35., delta=1.)
+        self.assertAlmostEqual(result.k_best, 1.75, delta=0.03)
+        result2 = hk_stack(stream, chunksize=1)
+        np.testing.assert_allclose(result.stack, result2.stack)
+
+    def test_hk_stack_errors(self):
+        stream = synthetic_rf()
+        with self.assertRaises(ValueError):
+            hk_stack(stream, weights=(1, 0))
+        stream[0].stats.sampling_rate = 20
+        with self.assertRaises(ValueError):
+            hk_stack(stream)
+        with self.assertRaises(ValueError):
+            hk_stack(RFStream())
+
+
+def suite():
+    return unittest.makeSuite(HkTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,77 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Tests for index module.
+"""
+import os
+import unittest
+
+from rf.index import (append_index, build_index, index_filename, query,
+                      read_index, read_indexed, stream_index_rows)
+from rf.tests.util import tempdir
+from rf.util import minimal_example_rf
+
+
+class IndexTestCase(unittest.TestCase):
+
+    def test_index(self):
+        stream = minimal_example_rf()
+        with tempdir():
+            os.mkdir('rfs')
+            for i, tr in enumerate(stream):
+                tr.write(os.path.join('rfs', 'rf%02d.SAC' % i), 'SAC')
+            index = build_index('rfs', os.path.join('rfs', '*.SAC'))
+            self.assertEqual(len(index), len(stream))
+            self.assertEqual(read_index('rfs'), index)
+            # update index, removed files are dropped
+            os.remove(os.path.join('rfs', 'rf00.SAC'))
+            index = build_index('rfs', os.path.join('rfs', '*.SAC'))
+            self.assertEqual(len(index), len(stream) - 1)
+            sel = query(index, back_azimuth=(90, 180), channel='BHQ')
+            expected = [tr for tr in stream[1:] if
+                        90 <= tr.stats.back_azimuth <= 180 and
+                        tr.stats.channel == 'BHQ']
+            self.assertGreater(len(expected), 0)
+            self.assertEqual(len(sel), len(expected))
+            sel2 = query(index, event_time=(expected[0].stats.event_time - 1,
+                                            expected[0].stats.event_time + 1))
+            self.assertEqual(len(sel2), 3)
+            stream2 = read_indexed(sel, 'rfs')
+        self.assertEqual(len(stream2), len(expected))
+        for tr, tr2 in zip(expected, stream2):
+            self.assertLess(abs(tr.stats.onset - tr2.stats.onset), 0.01)
+
+    def test_append_index(self):
+        stream = minimal_example_rf()
+        with tempdir():
+            os.mkdir('rfs')
+            build_index('rfs', os.path.join('rfs', '*.SAC'))
+            fnames = []
+            for i, tr in enumerate(stream):
+                fnames.append(os.path.join('rfs', 'rf%02d.SAC' % i))
+                tr.write(fnames[-1], 'SAC')
+            # entries from the headers in memory
+            rows = stream_index_rows(stream, 'rfs', fnames, 'SAC')
+            append_index('rfs', rows[:3])
+            # incomplete last row of an interrupted write is ignored
+            with open(index_filename('rfs'), 'a') as f:
+                f.write('{"path": "rf')
+            self.assertEqual(len(read_index('rfs')), 3)
+            append_index('rfs', rows[3:])
+            index = read_index('rfs')
+            index2 = build_index('rfs', os.path.join('rfs', '*.SAC'))
+        self.assertEqual(len(index), len(stream))
+        self.assertEqual(len(index2), len(stream))
+        for row, row2 in zip(index, index2):
+            for key in ('path', 'trace', 'mtime', 'station', 'channel',
+                        'event_time'):
+                self.assertEqual(row[key], row2[key])
+            self.assertAlmostEqual(row['back_azimuth'], row2['back_azimuth'],
+                                   3)
+
+
+def suite():
+    return unittest.makeSuite(IndexTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,107 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Tests for instrument module.
+"""
+import threading
+import unittest
+
+from rf import read_rf, rfstats
+import rf.instrument
+from rf.profile import get_profile_boxes, profile
+from rf.timing import Timings
+
+
+class InstrumentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        rf.instrument.register(self.callback)
+
+    def tearDown(self):
+        rf.instrument.unregister(self.callback)
+
+    def callback(self, name, duration, ntraces, nsamples):
+        self.events.append((name, duration, ntraces, nsamples))
+
+    def test_instrument(self):
+        stream = read_rf()
+        rfstats(stream)
+        stream.rf()
+        stream.moveout()
+        stream.ppoints(50)
+        stream.stack()
+        names = [event[0] for event in self.events]
+        self.assertEqual(names[0], 'rotate')
+        self.assertIn('deconvolve', names)
+        self.assertEqual(names[-4:], ['rf', 'moveout', 'ppoints', 'stack'])
+        for name, duration, ntraces, nsamples in self.events[-4:]:
+            self.assertGreaterEqual(duration, 0)
+            self.assertEqual(ntraces, len(stream))
+            self.assertEqual(nsamples, sum(tr.stats.npts for tr in stream))
+        boxes = get_profile_boxes((-21, -69.5), 85, [0, 50, 100], width=300)
+        del self.events[:]
+        profile(stream, boxes)
+        prof = profile(iter(stream), boxes)
+        self.assertEqual([event[0] for event in self.events],
+                         ['profile', 'profile'])
+        # size of input stream or of profile for iterables
+        self.assertEqual(self.events[0][2], len(stream))
+        self.assertEqual(self.events[1][2], len(prof))
+        # no measurement without callback
+        rf.instrument.unregister(self.callback)
+        del self.events[:]
+        stream.moveout()
+        self.assertEqual(self.events, [])
+
+    def test_nested_stages(self):
+        timings = Timings()
+        rf.instrument.register(timings)
+        try:
+            stream = read_rf()
+            rfstats(stream)
+            stream.rf()
+            stream.moveout()
+
+            def background():
+                rf.instrument.set_background()
+                with rf.instrument.stage('write'):
+                    pass
+            thread = threading.Thread(target=background)
+            thread.start()
+            thread.join()
+        finally:
+            rf.instrument.unregister(timings)
+        self.assertIsNone(rf.instrument.parent())
+        self.assertFalse(rf.instrument.is_background())
+        self.assertEqual(timings.parent, {'rotate': 'rf',
+                                          'deconvolve': 'rf'})
+        self.assertEqual(timings.background, {'write'})
+        self.assertEqual(timings.total(),
+                         timings.time['rf'] + timings.time['moveout'])
+        stages = timings.report()['stages']
+        self.assertEqual(stages['deconvolve']['parent'], 'rf')
+        self.assertTrue(stages['write']['background'])
+        self.assertNotIn('parent', stages['rf'])
+        # nested stages follow their parent, shares of top-level stages
+        lines = timings.table().splitlines()
+        labels = [line[:16].rstrip() for line in lines[1:5]]
+        self.assertEqual(labels, ['rf', '  rotate', '  deconvolve',
+                                  'moveout'])
+        shares = [line.split()[-1] for line in lines[1:6]]
+        self.assertEqual(shares[1:3], ['-', '-'])
+        self.assertEqual(shares[4], '-')
+        self.assertAlmostEqual(float(shares[0]) + float(shares[3]), 100,
+                               delta=0.2)
+        # nesting is kept when merging reports of worker processes
+        merged = Timings()
+        merged.update(timings.report())
+        self.assertEqual(merged.parent, timings.parent)
+        self.assertEqual(merged.background, timings.background)
+
+
+def suite():
+    return unittest.makeSuite(InstrumentTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
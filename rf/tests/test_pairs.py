@@ -0,0 +1,140 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Tests for pairs module.
+"""
+from glob import glob
+import json
+import multiprocessing
+import os.path
+import pickle
+from pkg_resources import resource_filename
+import unittest
+import warnings
+
+from obspy import read_events, read_inventory
+from rf import read_rf
+from rf.batch import _init_worker, run_cli as script
+from rf.pairs import PairTable
+from rf.rfstream import rfstats
+from rf.tests.util import quiet, tempdir
+
+
+def _worker_readonly(_):
+    from rf.batch import _WORKER
+    return _WORKER['pairs'].readonly
+
+
+class PairsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # turn off progressbar
+        import rf.batch
+        rf.batch.tqdm = lambda: None
+        self.events = read_events(
+            resource_filename('rf', 'example/example_events.xml'))
+        self.inventory = read_inventory(
+            resource_filename('rf', 'example/example_inventory.xml'))
+
+    def test_pair_table(self):
+        with tempdir():
+            pairs = PairTable(self.events, self.inventory, 'cache',
+                              pp_depth=50)
+            self.assertEqual(pairs.compute(), 13)
+            self.assertEqual(len(glob('cache/pairs_*.hdr')), 1)
+            rows = list(pairs.iter_rows())
+            self.assertEqual(len(rows), 7)
+            self.assertEqual(len(list(pairs.iter_rows(rejected=True))), 13)
+            # the table is reused
+            pairs2 = PairTable(self.events, self.inventory, 'cache',
+                               pp_depth=50, phase='P')
+            self.assertEqual(pairs2.fname, pairs.fname)
+            self.assertEqual(pairs2.compute(), 0)
+            event = [ev for ev in self.events
+                     if str(ev.resource_id) == rows[0]['event_id']][0]
+            seedid = rows[0]['seedid']
+            stats, reason = pairs2.get(event, seedid, 'Z')
+            self.assertIsNone(reason)
+            coords = self.inventory.get_coordinates(
+                seedid[:-1] + 'Z', event.origins[0].time)
+            expected = rfstats(station=coords, event=event, pp_depth=50)
+            self.assertEqual(set(stats), set(expected))
+            for key in expected:
+                self.assertEqual(stats[key], expected[key])
+            self.assertEqual(stats.onset.ns, expected.onset.ns)
+            # copies for worker processes are read-only
+            pairs6 = pickle.loads(pickle.dumps(pairs2))
+            self.assertEqual(pairs6.get(event, seedid, 'Z')[0], stats)
+            pairs6.rows.pop(rows[0]['event_id'] + ' ' + seedid)
+            self.assertRaises(ValueError, pairs6.get, event, seedid, 'Z')
+            self.assertRaises(ValueError, pairs6.compute)
+            # the table is read-only in worker processes of the batch
+            # commands, also if they are forked (default on Linux)
+            pool = multiprocessing.Pool(
+                2, initializer=_init_worker,
+                initargs=(('convert',), {}, None, None, None, None, False,
+                          pairs2))
+            try:
+                self.assertEqual(pool.map(_worker_readonly, range(4)),
+                                 [True] * 4)
+            finally:
+                pool.close()
+                pool.join()
+            # the table is invalidated by other options or events
+            pairs3 = PairTable(self.events, self.inventory, 'cache')
+            self.assertNotEqual(pairs3.fname, pairs.fname)
+            pairs4 = PairTable(self.events[:3], self.inventory, 'cache',
+                               pp_depth=50)
+            self.assertNotEqual(pairs4.fname, pairs.fname)
+            # an interrupted calculation is continued
+            with open(pairs.fname) as f:
+                text = f.read()
+            with open(pairs.fname, 'w') as f:
+                f.write(text[:len(text) // 2])
+            pairs5 = PairTable(self.events, self.inventory, 'cache',
+                               pp_depth=50)
+            num = len(pairs5)
+            self.assertLess(num, 13)
+            self.assertEqual(pairs5.compute(), 13 - num)
+            self.assertEqual(len(pairs5), 13)
+            with open(pairs.fname) as f:
+                rows = [json.loads(line) for line in f if line.count('}')]
+            self.assertEqual(len(rows), 13)
+
+    def test_batch_pair_cache(self):
+        with tempdir():
+            script(['create', '-t'])
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                script(['data', 'rf1'])
+                script(['--pair-cache', 'pairs', 'data', 'rf2'])
+                with quiet():
+                    script(['--pair-cache', 'pairs', '--timing', 'data',
+                            'rf3', '-j', '2'])
+            with open('timing.json') as f:
+                report = json.load(f)
+            self.assertNotIn('rfstats', report['stages'])
+            self.assertEqual(report['rejected'], {'distance': 6})
+            self.assertEqual(len(glob(os.path.join('pairs', '*.hdr'))), 1)
+            stream1 = read_rf('rf1/*/*.QHD')
+            for path in ('rf2', 'rf3'):
+                stream2 = read_rf(path + '/*/*.QHD')
+                self.assertEqual(len(stream2), len(stream1))
+                for tr1, tr2 in zip(stream1, stream2):
+                    self.assertEqual(tr1.stats.onset.ns, tr2.stats.onset.ns)
+                    self.assertEqual(tr1.stats.slowness, tr2.stats.slowness)
+                    self.assertEqual(tr1.stats.pp_latitude,
+                                     tr2.stats.pp_latitude)
+                    self.assertEqual(tr1.data.tolist(), tr2.data.tolist())
+                # cached and uncached runs give the same files
+                for fname in glob('rf1/*/*'):
+                    fname2 = path + fname[3:]
+                    with open(fname, 'rb') as f1, open(fname2, 'rb') as f2:
+                        self.assertEqual(f1.read(), f2.read())
+
+
+def suite():
+    return unittest.makeSuite(PairsTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
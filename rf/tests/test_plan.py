@@ -0,0 +1,119 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Tests for plan module.
+"""
+from glob import glob
+import json
+import os.path
+import unittest
+import warnings
+
+from rf.batch import run_cli as script
+from rf.pairs import PairTable
+from rf.plan import _runtime, plan, plan_pairs
+from rf.synthetic_dataset import synthetic_events, synthetic_inventory
+from rf.tests.util import quiet, tempdir
+try:
+    import obspyh5
+except ImportError:
+    obspyh5 = None
+
+
+class PlanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # turn off progressbar
+        import rf.batch
+        rf.batch.tqdm = lambda: None
+
+    def test_plan_pairs(self):
+        # vectorized distances agree with rfstats
+        events = synthetic_events(20, dist_range=(20, 100), seed=2)
+        inventory = synthetic_inventory(10, radius=5, seed=2)
+        for phase in ('P', 'S'):
+            total, rejected, rates = plan_pairs(events, inventory, phase)
+            with tempdir():
+                pairs = PairTable(events, inventory, phase=phase)
+                pairs.compute()
+            self.assertEqual(total, 200)
+            self.assertEqual(len(rates), len(list(pairs.iter_rows())))
+            self.assertEqual(rejected['distance'], 200 - len(rates))
+        total, _, rates = plan_pairs(events, inventory, shard=(1, 2))
+        self.assertLess(total, 200)
+        total2, _, rates2 = plan_pairs(events, inventory, shard=(2, 2))
+        self.assertEqual(total + total2, 200)
+        result = plan('data', events, inventory)
+        self.assertEqual(result['pairs_passing'], len(rates) + len(rates2))
+        self.assertIsNone(result['runtime'])
+
+    def test_batch_plan(self):
+        with tempdir():
+            script(['create', '-t'])
+            with quiet():
+                script(['plan', 'data', 'calc', '--json', 'plan1.json'])
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                with quiet():
+                    script(['--timing', 'data', 'calc', 'rfs'])
+                    script(['plan', 'data', 'calc', '-j', '2',
+                            '--json', 'plan2.json'])
+            with open('plan1.json') as f:
+                plan1 = json.load(f)
+            with open('plan2.json') as f:
+                plan2 = json.load(f)
+            with open('timing.json') as f:
+                report = json.load(f)
+            self.assertEqual(plan1['pairs'], 13)
+            self.assertEqual(plan1['pairs_passing'], report['pairs'])
+            self.assertEqual(plan1['rejected']['distance'],
+                             report['rejected']['distance'])
+            self.assertEqual(plan1['output_files'],
+                             len(glob(os.path.join('rfs', '*', '*'))))
+            self.assertGreater(plan1['output_bytes'], 0)
+            self.assertGreater(plan1['requested_bytes'], 0)
+            self.assertIsNone(plan1['runtime'])
+            self.assertGreater(plan2['runtime'], 0)
+            self.assertLess(plan2['runtime'], report['wall_time'])
+
+    def test_runtime(self):
+        # nested and background stages do not add to the runtime
+        stages = {'rfstats': {'calls': 20, 'time': 2.},
+                  'get_waveforms': {'calls': 10, 'time': 3.},
+                  'rf': {'calls': 10, 'time': 5.},
+                  'rotate': {'calls': 10, 'time': 1., 'parent': 'rf'},
+                  'deconvolve': {'calls': 10, 'time': 3., 'parent': 'rf'},
+                  'write': {'calls': 2, 'time': 4., 'background': True}}
+        timing = {'pairs': 10, 'stages': stages}
+        self.assertAlmostEqual(_runtime(timing, 40, 20, 1, False), 20.)
+        self.assertAlmostEqual(_runtime(timing, 40, 20, 2, True), 8.)
+
+    def test_output_bytes_dtype(self):
+        # raw data is int32, receiver functions float32, Q stores float32,
+        # H5 keeps the dtype and NPY stores float64 for int32 data
+        formats = ['Q', 'NPY'] + ['H5'] * (obspyh5 is not None)
+        ratio = {}
+        with tempdir():
+            script(['create', '-t'])
+            with open('conf.json') as f:
+                text = f.read()
+            for format in formats:
+                with open('conf.json', 'w') as f:
+                    f.write(text.replace('#"format": "Q"',
+                                         '"format": "%s"' % format))
+                sizes = []
+                for commands in (['data'], ['data', 'calc']):
+                    with quiet():
+                        script(['plan'] + commands + ['--json', 'plan.json'])
+                    with open('plan.json') as f:
+                        sizes.append(json.load(f)['output_bytes'])
+                ratio[format] = float(sizes[0]) / sizes[1]
+        self.assertAlmostEqual(ratio['NPY'] / ratio['Q'], 2, delta=0.1)
+        if 'H5' in ratio:
+            self.assertAlmostEqual(ratio['H5'] / ratio['Q'], 1, delta=0.15)
+
+def suite():
+    return unittest.makeSuite(PlanTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
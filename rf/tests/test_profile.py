@@ -30,6 +30,14 @@ class ProfileTestCase(unittest.TestCase):
         self.assertEqual(str(profile[0]), str_)
         test_io_header(self, profile[:1])
         self.assertIn('profile(', ' '.join(profile[0].stats.processing))
+        profile2 = stream.select(component='Q').profile(boxes, method='pws')
+        self.assertEqual(len(profile2), 3)
+        self.assertEqual([tr.stats.num for tr in profile2],
+                         [tr.stats.num for tr in profile])
+        profile3 = stream.select(component='Q').profile(boxes, bootstrap=20)
+        self.assertEqual(len(profile3), 9)
+        self.assertEqual([tr.stats.get('percentile') for tr in profile3[:3]],
+                         [None, 2.5, 97.5])
         # test plots
         profile.plot_profile(top='hist')
         from rf.imaging import plot_profile_map
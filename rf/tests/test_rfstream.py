@@ -3,13 +3,16 @@
 Tests for rfstream module.
 """
 import unittest
+import warnings
 
+import numpy as np
 from obspy import read, read_events
 from obspy.core import AttribDict
 from obspy.core.util import NamedTemporaryFile
 from rf import read_rf, RFStream, rfstats
 from rf.rfstream import (obj2stats, _HEADERS, _STATION_GETTER, _EVENT_GETTER,
                          _FORMATHEADERS)
+from rf.tests.util import tempdir
 from rf.util import minimal_example_rf, minimal_example_Srf
 
 _HEADERS_TEST_IO = (50.3, -100.2, 400.3,  # station coordinates
@@ -18,9 +21,12 @@ _HEADERS_TEST_IO = (50.3, -100.2, 400.3,  # station coordinates
                     'rf', 'P', 'Ps',  # type, phase, moveout
                     57.6, 90.1, 10.2, 10.,  # arrival properties
                     10., -20, 150,  # piercing points
-                    15.7, 2.5)  # box properties
+                    15.7, 2.5,  # box properties
+                    97.5,  # bootstrap percentile
+                    12)  # number of stacked traces
 
-_HEADERS_NOT_BY_RFSTATS = ('moveout', 'box_pos', 'box_length', 'type')
+_HEADERS_NOT_BY_RFSTATS = ('moveout', 'box_pos', 'box_length', 'type',
+                           'percentile', 'num')
 
 FORMATS = list(_FORMATHEADERS.keys())
 
@@ -102,6 +108,72 @@ class RFStreamTestCase(unittest.TestCase):
 #            tr.stats.pop('sac')
         test_io_header(self, stream)
 
+    def test_io_npy_archive(self):
+        stream = minimal_example_rf()
+        with tempdir():
+            stream[:3].write('rf.npy', 'NPY')
+            stream[3:].write('rf.npy', 'NPY', mode='a')
+            stream2 = read_rf('rf.npy')
+            stream3 = read_rf('rf.npy', 'NPY', headonly=True)
+            self.assertEqual(len(stream2), len(stream))
+            self.assertEqual(len(stream3), len(stream))
+            for tr, tr2, tr3 in zip(stream, stream2, stream3):
+                np.testing.assert_array_equal(tr.data, tr2.data)
+                self.assertEqual(tr.id, tr2.id)
+                self.assertEqual(str(tr), str(tr2))
+                self.assertEqual(str(tr), str(tr3))
+                self.assertEqual(tr.stats.processing, tr2.stats.processing)
+            # data of traces are views into one memory-mapped array
+            base = stream2[0].data.base
+            self.assertIsNotNone(base)
+            self.assertTrue(all(np.shares_memory(tr.data, base)
+                                for tr in stream2))
+            # float32 and float64 data keep their data type
+            self.assertEqual(stream2[0].data.dtype, np.float32)
+            for tr in stream:
+                tr.data = tr.data.astype(np.float64) / 3
+            stream.write('rf64.npy', 'NPY')
+            stream4 = read_rf('rf64.npy')
+            for tr, tr4 in zip(stream, stream4):
+                self.assertEqual(tr4.data.dtype, np.float64)
+                np.testing.assert_array_equal(tr.data, tr4.data)
+
+    def test_read_lazy(self):
+        stream = minimal_example_rf()
+        for format in ('SAC', 'Q', 'H5'):
+            with tempdir():
+                if format == 'SAC':
+                    for i, tr in enumerate(stream):
+                        tr.write('rf%d.sac' % i, format)
+                    fname = 'rf*.sac'
+                elif format == 'Q':
+                    fname = 'rf.QHD'
+                    stream.write(fname, format)
+                else:
+                    fname = 'rf.h5'
+                    stream2 = stream.copy()
+                    for tr in stream2:
+                        tr.stats.pop('sac')
+                    stream2.write(fname, format)
+                stream2 = read_rf(fname, format)
+                stream3 = read_rf(fname, format, headonly='lazy')
+                self.assertEqual(len(stream3), len(stream2))
+                stream2.sort(['back_azimuth'])
+                stream3.sort(['back_azimuth'])
+                sel = stream3.select(component='Q')
+                self.assertEqual(len(sel), len(stream2.select(component='Q')))
+                self.assertEqual(str(stream3), str(stream2))
+                self.assertTrue(all(tr._loader for tr in stream3))
+                # loading one trace does not load the other traces
+                loader = stream3[0]._loader[0]
+                stream3[0].data
+                self.assertTrue(all(tr._loader for tr in stream3[1:]))
+                self.assertNotIn('_data', vars(loader))
+                for tr2, tr3 in zip(stream2, stream3):
+                    np.testing.assert_array_equal(tr3.data, tr2.data)
+                    self.assertIsNone(tr3._loader)
+                    self.assertEqual(tr3.stats.npts, tr2.stats.npts)
+
     def test_obj2stats(self):
         stats = obj2stats(event=self.event, station=self.station)
         for head, _ in _STATION_GETTER + _EVENT_GETTER:
@@ -153,6 +225,82 @@ class RFStreamTestCase(unittest.TestCase):
         onset = Q[0].stats.onset - Q[0].stats.starttime
         self.assertAlmostEqual(Q[0].data.argmax() * dt - onset, 8.6, delta=0.1)
 
+    def test_stack(self):
+        stream = minimal_example_rf().select(component='Q')
+        stack = stream.stack()
+        self.assertEqual(len(stack), 1)
+        np.testing.assert_allclose(
+            stack[0].data, np.mean([tr.data for tr in stream], axis=0),
+            atol=1e-6)
+        weights = np.arange(len(stream), dtype=float)
+        stack = stream.stack(weights=weights)
+        np.testing.assert_allclose(
+            stack[0].data, np.average([tr.data for tr in stream], axis=0,
+                                      weights=weights), atol=1e-6)
+        bins = [0, 180, 360]
+        stack = stream.stack(key='back_azimuth', bins=bins)
+        bazs = np.array([tr.stats.back_azimuth for tr in stream])
+        self.assertEqual(len(stack), len(np.unique(np.digitize(bazs, bins))))
+        for tr in stack:
+            self.assertIn(tr.stats.back_azimuth, (90., 270.))
+            sel = [tr2.data for tr2 in stream if
+                   abs(tr2.stats.back_azimuth - tr.stats.back_azimuth) < 90]
+            np.testing.assert_allclose(tr.data, np.mean(sel, axis=0),
+                                       atol=1e-6)
+        # float64 for input of other types, groups without weight skipped
+        stream2 = stream.copy()
+        for tr in stream2:
+            tr.data = np.round(tr.data * 1000).astype(np.int32)
+        weights = np.ones(len(stream2))
+        weights[0] = 0.5
+        weights[bazs > 180] = 0
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            stack = stream2.stack(key='back_azimuth', bins=bins,
+                                  weights=weights)
+        self.assertEqual(len(w), 1)
+        self.assertEqual(len(stack), 1)
+        self.assertEqual(stack[0].data.dtype, np.float64)
+        sel = [tr.data for tr in stream2 if tr.stats.back_azimuth < 180]
+        np.testing.assert_allclose(stack[0].data, np.average(
+            sel, axis=0, weights=weights[bazs < 180]))
+
+    def test_stack_methods(self):
+        stream = minimal_example_rf().select(component='Q')
+        data = np.array([tr.data for tr in stream], dtype=float)
+        median = stream.stack(method='median')[0].data
+        np.testing.assert_allclose(median, np.median(data, axis=0),
+                                   atol=1e-6)
+        trim = stream.stack(method='trim', trim=0.)[0].data
+        np.testing.assert_allclose(trim, np.mean(data, axis=0), atol=1e-6)
+        nroot = stream.stack(method='nroot', nroot=1)[0].data
+        np.testing.assert_allclose(nroot, np.mean(data, axis=0), atol=1e-6)
+        pws = stream.stack(method='pws')[0].data
+        self.assertTrue(np.all(np.abs(pws) <= np.abs(np.mean(data, axis=0)) +
+                               1e-6))
+        # phase-weighted stack of identical traces is the plain stack
+        stream2 = RFStream([stream[0], stream[0].copy(), stream[0].copy()])
+        pws = stream2.stack(method='pws')[0].data
+        np.testing.assert_allclose(pws, stream[0].data, atol=1e-6)
+        with self.assertRaises(ValueError):
+            stream.stack(method='median', weights=np.ones(len(stream)))
+
+    def test_stack_bootstrap(self):
+        stream = minimal_example_rf().select(component='Q')
+        stack = stream.stack(bootstrap=200, percentiles=(5, 95), seed=42)
+        self.assertEqual(len(stack), 3)
+        self.assertNotIn('percentile', stack[0].stats)
+        self.assertEqual([tr.stats.percentile for tr in stack[1:]], [5, 95])
+        lower, upper = stack[1].data, stack[2].data
+        self.assertTrue(np.all(lower <= upper))
+        self.assertTrue(np.mean((lower <= stack[0].data + 1e-6) &
+                                (stack[0].data - 1e-6 <= upper)) > 0.9)
+        stack2 = stream.stack(bootstrap=200, percentiles=(5, 95), seed=42)
+        np.testing.assert_array_equal(stack[1].data, stack2[1].data)
+        self.assertIn('perc:5.0%', str(stack[1]))
+        with self.assertRaises(ValueError):
+            stream.stack(method='median', bootstrap=10)
+
     def test_minimal_example_Srf(self):
         stream = minimal_example_Srf()
 #        stream.select(component='L').plot_rf()
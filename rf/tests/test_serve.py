@@ -0,0 +1,112 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Tests for serve module.
+"""
+from glob import glob
+import os.path
+import socket
+import threading
+import unittest
+import warnings
+
+from rf import read_rf
+from rf.batch import run_cli as script
+from rf.tests.util import tempdir
+
+
+@unittest.skipIf(not hasattr(socket, 'AF_UNIX'), 'no Unix sockets')
+class ServeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # turn off progressbar
+        import rf.batch
+        rf.batch.tqdm = lambda: None
+
+    def test_serve(self):
+        from rf.serve import Server, submit
+        with tempdir():
+            script(['create', '-t'])
+            server = Server('rf.sock', workers=2, interval=0)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    script(['data', 'calc', 'rf_cli'])
+                    results = [None] * 3
+                    received = []
+
+                    def run(i):
+                        job = {'command': 'data', 'commands': ['calc'],
+                               'conf': 'conf.json', 'path_out': 'rf',
+                               'shard': '%d/3' % (i + 1)}
+                        results[i] = []
+                        for msg in submit(job, 'rf.sock'):
+                            results[i].append(msg)
+                            received.append((i, msg['status']))
+
+                    threads = [threading.Thread(target=run, args=(i,))
+                               for i in range(3)]
+                    for t in threads:
+                        t.start()
+                    for t in threads:
+                        t.join()
+                    errors = list(submit({'command': 'create'}, 'rf.sock'))
+                    for opt in ('timing', 'jobs'):
+                        errors.extend(submit(
+                            {'command': 'data', opt: 2, 'conf': 'conf.json'},
+                            'rf.sock'))
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+            self.assertFalse(os.path.exists('rf.sock'))
+            for msgs in results:
+                status = [msg['status'] for msg in msgs]
+                self.assertEqual(status[:2], ['queued', 'running'])
+                self.assertEqual(status[-1], 'done')
+                self.assertIn('progress', status)
+                self.assertEqual(len(set(msg['job'] for msg in msgs)), 1)
+                progress = [msg for msg in msgs
+                            if msg['status'] == 'progress']
+                self.assertEqual(progress[-1]['done'], 13)
+            # two jobs run at the same time in the two worker processes
+            order = [status for _, status in received
+                     if status in ('running', 'done')]
+            self.assertEqual(order[:2], ['running', 'running'])
+            workers = set(msgs[1]['worker'] for msgs in results)
+            self.assertEqual(len(workers), 2)
+            self.assertNotIn(os.getpid(), workers)
+            self.assertEqual([msg['status'] for msg in errors],
+                             ['queued', 'running', 'error'] * 3)
+            self.assertIn('Unsupported command', errors[2]['error'])
+            self.assertIn('timing', errors[5]['error'])
+            self.assertIn('jobs', errors[8]['error'])
+            stream1 = read_rf(os.path.join('rf_cli', '*', '*.QHD'))
+            stream2 = read_rf(os.path.join('rf', '*', '*.QHD'))
+            self.assertEqual(len(glob(os.path.join('rf', '*', '*.QHD'))), 7)
+            self.assertEqual(len(stream2), len(stream1))
+            for tr1, tr2 in zip(stream1.sort(), stream2.sort()):
+                self.assertEqual(tr1.stats.onset, tr2.stats.onset)
+                self.assertEqual(tr1.data.tolist(), tr2.data.tolist())
+
+    def test_run_job(self):
+        # events and stations are read once per process
+        from rf.serve import _WORKER, run_job
+        _WORKER.clear()
+        with tempdir():
+            script(['create', '-t'])
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                for i in (1, 2):
+                    run_job({'command': 'data', 'conf': 'conf.json',
+                             'path_out': 'data', 'shard': '%d/10' % i})
+            self.assertEqual(len(_WORKER['events'].objects), 1)
+            self.assertEqual(len(_WORKER['inventories'].objects), 1)
+
+def suite():
+    return unittest.makeSuite(ServeTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -133,6 +133,16 @@ class SimpleModelTestCase(unittest.TestCase):
         pp2 = degrees2kilometers((pdist[-1] - pdist[-index-1]) * 180 / np.pi)
         self.assertLess(abs(pp1-pp2)/pp2, 0.1)
 
+    def test_delay_times_array(self):
+        model = load_model()
+        slowness = np.array([4., 6.4, 9.])
+        for phase in ('Ps', 'Ppps', 'Ppss', 'Sp'):
+            t = model.calculate_delay_times(slowness, phase)
+            self.assertEqual(t.shape, (3, len(model.z)))
+            for i, slow in enumerate(slowness):
+                t1 = model.calculate_delay_times(slow, phase)
+                np.testing.assert_array_equal(t[i], t1)
+
     def test_moveout_vs_XY(self):
         stream = RFStream(read())[:1]
         for tr in stream:
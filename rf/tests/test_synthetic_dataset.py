@@ -0,0 +1,83 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Tests for synthetic_dataset module.
+"""
+from glob import glob
+import os.path
+import unittest
+import warnings
+
+import numpy as np
+from rf import read_rf
+from rf.batch import ParseError, _create_synthetic, run_cli as script
+from rf.simple_model import load_model
+from rf.synthetic_dataset import (synthetic_events, synthetic_inventory,
+                                  synthetic_waveforms)
+from rf.tests.util import quiet, tempdir
+
+
+class SyntheticDatasetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # turn off progressbar
+        import rf.batch
+        rf.batch.tqdm = lambda: None
+
+    def test_synthetic_waveforms(self):
+        events = synthetic_events(3, seed=1)
+        inventory = synthetic_inventory(4, seed=1)
+        self.assertEqual(len(events), 3)
+        self.assertEqual(len(inventory.get_contents()['channels']), 12)
+        stream = synthetic_waveforms(events[0], inventory, seed=1)
+        self.assertEqual(len(stream), 12)
+        stream2 = synthetic_waveforms(events[0], inventory, seed=1)
+        np.testing.assert_array_equal(stream[0].data, stream2[0].data)
+        stream = synthetic_waveforms(events[0], inventory, gaps=1, seed=1)
+        self.assertEqual(len(stream), 16)
+
+    def test_create_synthetic(self):
+        with tempdir():
+            script(['create', '--synthetic', '4', '3'])
+            self.assertTrue(os.path.exists('synthetic_events.xml'))
+            self.assertTrue(os.path.exists('synthetic_inventory.xml'))
+            self.assertEqual(len(glob('synthetic_data/*/SY/*/*/*')), 9)
+            sizes = [os.path.getsize(fname)
+                     for fname in sorted(glob('synthetic_data/*/SY/*/*/*'))]
+            # creating the dataset again does not append to the day files
+            script(['create', '--synthetic', '4', '3'])
+            self.assertEqual(
+                [os.path.getsize(fname)
+                 for fname in sorted(glob('synthetic_data/*/SY/*/*/*'))],
+                sizes)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                with quiet():
+                    script(['data', 'calc', 'rfs'])
+            stream = read_rf(os.path.join('rfs', '*', '*.QHD'))
+            # configuration file without the options of the example
+            with open('conf.json', 'w') as f:
+                f.write('{"events": "events.xml"}')
+            self.assertRaises(ParseError, _create_synthetic, 'conf.json',
+                              4, 3)
+        self.assertGreater(len(stream), 0)
+        # the maximum of the Q component is the Ps conversion at 35km,
+        # its time is disturbed by the noise
+        model = load_model()
+        offsets = []
+        for tr in stream.select(component='Q'):
+            t = tr.times() - (tr.stats.onset - tr.stats.starttime)
+            delays = model.calculate_delay_times(tr.stats.slowness, 'Ps')
+            t_ps = np.interp(35, model.z + model.dz, delays)
+            mask = (t > 1) & (t < 10)
+            index = np.argmax(tr.data[mask])
+            offsets.append(t[mask][index] - t_ps)
+        self.assertLess(np.median(np.abs(offsets)), 0.2)
+        self.assertLess(np.max(np.abs(offsets)), 1)
+
+
+def suite():
+    return unittest.makeSuite(SyntheticDatasetTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,105 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Tests for synthetics module.
+"""
+import unittest
+
+import numpy as np
+from obspy import UTCDateTime
+from rf import RFStream
+from rf.rfstream import RFTrace
+from rf.simple_model import SimpleModel
+from rf.synthetics import surface_response, synthetic_rf, synthetic_rf_data
+from rf.util import DEG2KM
+
+
+MODEL = ([0, 35], [6.0, 8.0], [3.5, 4.5])
+
+
+def _delays(slowness, h=35., vp=6., vs=3.5):
+    p = slowness / DEG2KM
+    qp = np.sqrt(vp ** -2 - p ** 2)
+    qs = np.sqrt(vs ** -2 - p ** 2)
+    return {'Ps': h * (qs - qp), 'PpPs': h * (qs + qp), 'PpSs': 2 * h * qs}
+
+
+class SyntheticsTestCase(unittest.TestCase):
+
+    def test_phases(self):
+        slowness = [5., 6.4, 8.]
+        stream = synthetic_rf(MODEL, slowness)
+        self.assertEqual(len(stream), 9)
+        for tr in stream.select(component='L'):
+            self.assertAlmostEqual(tr.data[100], 1)
+        for tr in stream.select(component='Q'):
+            t = tr.times() - 10
+            for phase, delay in _delays(tr.stats.slowness).items():
+                mask = np.abs(t - delay) < 1
+                sign = -1 if phase == 'PpSs' else 1
+                index = np.argmax(sign * tr.data[mask])
+                self.assertLess(abs(t[mask][index] - delay), 0.15)
+                self.assertGreater(sign * tr.data[mask][index], 0.05)
+        for tr in stream.select(component='T'):
+            self.assertFalse(np.any(tr.data))
+
+    def test_many_models(self):
+        model2 = ([0, 20, 40], [5.8, 6.5, 8.0], [3.4, 3.7, 4.5])
+        simple = SimpleModel(np.array([0., 35., 100.]), np.array([6., 8., 8.]),
+                             np.array([3.5, 4.5, 4.5]))
+        data, inc = synthetic_rf_data([MODEL, model2, simple], [5., 7.])
+        self.assertEqual(data.shape, (3, 2, 3, 801))
+        self.assertEqual(inc.shape, (3, 2))
+        single, _ = synthetic_rf_data(model2, [7.])
+        np.testing.assert_allclose(data[1, 1], single[0, 0], atol=1e-10)
+        # layer below 35km has the velocities of the half space
+        np.testing.assert_allclose(data[2], data[0], atol=1e-10)
+
+    def test_rf_pipeline(self):
+        # receiver functions calculated by RFStream.rf from the surface
+        # displacement are the same as the synthetic receiver functions
+        sr = 10.
+        nfft = 4096
+        freq = np.fft.rfftfreq(nfft, 1. / sr)
+        for phase, slowness, v0 in (('P', 6., 6.), ('S', 11., 3.5)):
+            z, r = surface_response(MODEL, [slowness], freq, phase)
+            src = np.exp(-(np.pi * freq) ** 2 - 2j * np.pi * freq * 100)
+            z = np.fft.irfft(z[0, 0] * src, nfft)
+            r = np.fft.irfft(r[0, 0] * src, nfft)
+            baz = 30.
+            inc = np.degrees(np.arcsin(slowness / DEG2KM * v0))
+            t0 = UTCDateTime(0)
+            stream = RFStream()
+            for cha, data in (('Z', z), ('N', -r * np.cos(np.radians(baz))),
+                              ('E', -r * np.sin(np.radians(baz)))):
+                header = {'channel': 'BH' + cha, 'sampling_rate': sr,
+                          'starttime': t0, 'onset': t0 + 100,
+                          'back_azimuth': baz, 'inclination': inc,
+                          'slowness': slowness, 'phase': phase}
+                stream.append(RFTrace(data=data, header=header))
+            stream.rf(deconvolve='freq', gauss=2., waterlevel=1e-6,
+                      trim=(-50, 100))
+            stream.trim2(-10, 70, 'onset')
+            syn = synthetic_rf(MODEL, slowness, phase=phase)
+            self.assertEqual(syn[0].stats.method, phase)
+            for comp in 'LQ':
+                data1 = stream.select(component=comp)[0].data
+                data2 = syn.select(component=comp)[0].data
+                n = min(len(data1), len(data2))
+                data1, data2 = data1[:n], data2[:n]
+                self.assertEqual(np.argmax(np.abs(data1)),
+                                 np.argmax(np.abs(data2)))
+                self.assertLess(np.max(np.abs(data1 - data2)), 0.1)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            synthetic_rf(MODEL, 6., phase='SKS')
+        with self.assertRaises(ValueError):
+            synthetic_rf(([0, 5, 35], [1.5, 6., 8.], [0, 3.5, 4.5]), 6.)
+
+
+def suite():
+    return unittest.makeSuite(SyntheticsTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
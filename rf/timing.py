@@ -0,0 +1,328 @@
+# Copyright 2013-2016 Tom Eulenfeld, MIT license
+"""
+Wall time and call counts of processing stages.
+
+Timing is switched on with `start_timing()`. Afterwards the stages of the
+processing (rfstats, get_waveforms, trim/merge, rotate, deconvolve, moveout,
+write and the other stages of `rf.instrument`) are measured and the reasons
+for rejected pairs of events and stations are counted until `stop_timing()`
+is called. The `Timings` instance is registered as callback in
+`rf.instrument`. Nested stages (e.g. rotate and deconvolve inside rf) and
+stages in the background (write with the asynchronous writer) overlap the
+other stages, they are marked in the summary table and not included in
+the shares of the stages.
+
+>>> from rf.timing import start_timing, stop_timing
+>>> timings = start_timing()
+>>> stream = read_rf().rf()  # doctest: +SKIP
+>>> stop_timing()
+>>> print(timings.table())  # doctest: +SKIP
+
+The command line option ``--timing`` of the batch script prints the summary
+table and writes the report in JSON format.
+The option ``--metrics`` periodically writes the metrics in the text format
+of Prometheus (see `MetricsFile`), e.g. for the textfile collector of the
+node exporter.
+"""
+import collections
+import json
+import os
+import threading
+import time
+
+from rf import instrument
+
+
+_TIMINGS = None
+_COUNTER_HELP = {'written_bytes': 'Bytes of written trace data.'}
+
+
+class Timings(object):
+
+    """
+    Collect wall time and number of calls per stage and rejected pairs.
+
+    Stage times measured in worker processes are added with `update()`,
+    therefore the sum of stage times may exceed the wall time.
+    For each stage the enclosing stage (parent, e.g. rf for rotate and
+    deconvolve) and whether it runs in a background thread are recorded.
+    Nested and background stages overlap the other stages. They are
+    excluded from `total()` and from the shares in the summary table.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.end = None
+        self.calls = collections.OrderedDict()
+        self.time = collections.OrderedDict()
+        self.rejected = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+        self.parent = {}
+        self.background = set()
+        self.pairs = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, duration, calls=1, parent=None, background=False):
+        """
+        Add duration and number of calls of a stage.
+
+        :param parent: name of the enclosing stage for nested stages
+        :param background: stage runs in a background thread
+        """
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + calls
+            self.time[name] = self.time.get(name, 0) + duration
+            if parent is not None and parent != name:
+                self.parent[name] = parent
+            if background:
+                self.background.add(name)
+
+    def __call__(self, name, duration, ntraces, nsamples):
+        self.add(name, duration, parent=instrument.parent(),
+                 background=instrument.is_background())
+
+    def top_level(self, name):
+        """Return True if stage is neither nested nor in the background."""
+        return name not in self.parent and name not in self.background
+
+    def total(self):
+        """Return sum of times of top-level stages."""
+        return sum(t for name, t in self.time.items() if self.top_level(name))
+
+    def reject(self, reason, num=1):
+        """Count rejected pair of event and station."""
+        with self._lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + num
+
+    def count(self, name, num=1):
+        """Increase counter, e.g. written_bytes."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + num
+
+    def update(self, report):
+        """Add stages, rejections, counters and pairs of another report."""
+        for name, st in report['stages'].items():
+            self.add(name, st['time'], calls=st['calls'],
+                     parent=st.get('parent'),
+                     background=st.get('background', False))
+        for reason, num in report['rejected'].items():
+            self.reject(reason, num)
+        for name, num in report['counters'].items():
+            self.count(name, num)
+        self.pairs += report['pairs']
+
+    @property
+    def wall_time(self):
+        return (self.end or time.time()) - self.start
+
+    def report(self):
+        """Return report as dictionary which can be serialized to JSON."""
+        wall_time = self.wall_time
+        stages = collections.OrderedDict()
+        for name in self.calls:
+            st = {'calls': self.calls[name], 'time': self.time[name]}
+            if name in self.parent:
+                st['parent'] = self.parent[name]
+            if name in self.background:
+                st['background'] = True
+            stages[name] = st
+        pps = self.pairs / wall_time if wall_time > 0 else None
+        return collections.OrderedDict([
+            ('wall_time', wall_time), ('pairs', self.pairs),
+            ('pairs_per_second', pps), ('stages', stages),
+            ('rejected', collections.OrderedDict(self.rejected)),
+            ('counters', collections.OrderedDict(self.counters))])
+
+    def _ordered(self, parent=None, depth=0, seen=None):
+        """Return stages and depths, nested stages follow their parent."""
+        if seen is None:
+            seen = set()
+        names = []
+        for name in self.calls:
+            if self.parent.get(name) == parent and name not in seen:
+                seen.add(name)
+                names.append((name, depth))
+                names.extend(self._ordered(name, depth + 1, seen))
+        if parent is None:
+            # nested stages whose parent was not measured
+            names.extend((name, 1) for name in self.calls
+                         if name not in seen)
+        return names
+
+    def table(self):
+        """
+        Return summary table as string.
+
+        Nested stages are indented below their parent, stages running in
+        the background are marked with an asterisk. The share column refers
+        to the sum of top-level stages.
+        """
+        lines = ['%-16s %8s %10s %10s %6s' % ('stage', 'calls', 'time/s',
+                                              'ms/call', '%')]
+        total = self.total()
+        names = self._ordered()
+        for name, depth in names:
+            t = self.time[name]
+            n = self.calls[name]
+            label = '  ' * depth + name
+            if name in self.background:
+                label += ' *'
+            if self.top_level(name) and total > 0:
+                share = '%6.1f' % (100 * t / total)
+            else:
+                share = '%6s' % '-'
+            lines.append('%-16s %8d %10.3f %10.3f %s' %
+                         (label, n, t, 1000 * t / n, share))
+        if self.parent or self.background:
+            lines.append('(indented: nested in stage above, '
+                         '*: background thread, not in %)')
+        wall_time = self.wall_time
+        pps = self.pairs / wall_time if wall_time > 0 else 0
+        lines.append('wall time %.3fs, %d pairs, %.2f pairs/s' %
+                     (wall_time, self.pairs, pps))
+        if self.rejected:
+            rejected = ', '.join('%s %d' % item
+                                 for item in self.rejected.items())
+            lines.append('rejected: %s' % rejected)
+        return '\n'.join(lines)
+
+    def write(self, fname):
+        """Write report in JSON format."""
+        with open(fname, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def prometheus(self):
+        """
+        Return metrics in the text format of Prometheus.
+
+        Processed and rejected pairs and counters are exposed as counters,
+        the stage latencies as summaries (sum and count) and the queue
+        depths and wall time as gauges.
+        """
+        def metric(name, type_, help, values):
+            lines.append('# HELP rf_%s %s' % (name, help))
+            lines.append('# TYPE rf_%s %s' % (name, type_))
+            for suffix, labels, value in values:
+                labels = ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                                  for k, v in labels)
+                if labels:
+                    labels = '{%s}' % labels
+                lines.append('rf_%s%s%s %s' % (name, suffix, labels,
+                                               repr(float(value))))
+        lines = []
+        with self._lock:
+            metric('pairs_processed_total', 'counter',
+                   'Processed pairs of events and stations.',
+                   [('', (), self.pairs)])
+            metric('pairs_rejected_total', 'counter',
+                   'Rejected pairs of events and stations by reason.',
+                   [('', (('reason', r),), n)
+                    for r, n in self.rejected.items()])
+            for name, num in self.counters.items():
+                help = _COUNTER_HELP.get(name, name.replace('_', ' '))
+                metric(name + '_total', 'counter', help, [('', (), num)])
+            values = []
+            for name in self.calls:
+                values.append(('_sum', (('stage', name),), self.time[name]))
+                values.append(('_count', (('stage', name),),
+                               self.calls[name]))
+            metric('stage_duration_seconds', 'summary',
+                   'Wall time of processing stages.', values)
+            metric('queue_depth', 'gauge', 'Number of items in queues.',
+                   [('', (('queue', name),), func())
+                    for name, func in self.gauges.items()])
+        metric('wall_time_seconds', 'gauge', 'Wall time since start.',
+               [('', (), self.wall_time)])
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsFile(object):
+
+    """
+    Write metrics in the text format of Prometheus periodically.
+
+    The file is written by a background thread every interval seconds
+    and a last time by `close()`. It is replaced atomically, so that it can
+    be read at any time by the textfile collector of the node exporter.
+
+    :param timings: `Timings` instance
+    :param fname: name of metrics file (should end with .prom)
+    :param interval: interval in seconds
+    """
+
+    def __init__(self, timings, fname, interval=60):
+        self.timings = timings
+        self.fname = fname
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        """Write metrics file."""
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.timings.prometheus())
+        # os.replace is not available in Python 2
+        getattr(os, 'replace', os.rename)(tmp, self.fname)
+
+    def close(self):
+        """Stop the background thread and write metrics a last time."""
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+
+def start_timing():
+    """Switch timing on and return new `Timings` instance."""
+    global _TIMINGS
+    stop_timing()
+    _TIMINGS = Timings()
+    instrument.register(_TIMINGS)
+    return _TIMINGS
+
+
+def stop_timing():
+    """Switch timing off."""
+    global _TIMINGS
+    if _TIMINGS is not None:
+        _TIMINGS.end = time.time()
+        instrument.unregister(_TIMINGS)
+    _TIMINGS = None
+
+
+def get_timings():
+    """Return active `Timings` instance or None."""
+    return _TIMINGS
+
+
+def count(name, num=1):
+    """Increase counter if timing is switched on."""
+    if _TIMINGS is not None:
+        _TIMINGS.count(name, num)
+
+
+def set_gauge(name, func):
+    """Register function returning the depth of a queue if timing is on."""
+    if _TIMINGS is not None:
+        _TIMINGS.gauges[name] = func
+
+
+def reject(reason):
+    """Count rejected pair of event and station if timing is switched on."""
+    if _TIMINGS is not None:
+        _TIMINGS.reject(reason)
+
+
+def count_pairs(iterable):
+    """Count the items of iterable as processed pairs."""
+    for item in iterable:
+        if _TIMINGS is not None:
+            _TIMINGS.pairs += 1
+        yield item
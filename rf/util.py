@@ -5,7 +5,7 @@ Utility functions and classes for receiver function calculation.
 import collections
 import inspect
 import itertools
-from pkg_resources import resource_filename
+import zlib
 
 from decorator import decorator
 import numpy as np
@@ -20,8 +20,30 @@ def _get_stations(inventory):
     return stations
 
 
+def in_shard(shard, seedid, event=None):
+    """
+    Return if the pair of station and event belongs to a shard.
+
+    The pairs are partitioned by a hash of seed id and origin time, which is
+    independent of the order of events and stations.
+
+    :param shard: tuple (i, n) for shard i of n shards (1 <= i <= n) or None
+    :param seedid: seed id, only network, station and location are used
+    :param event: event or None, if None only stations are partitioned
+    """
+    if shard is None:
+        return True
+    i, n = shard
+    key = '.'.join(seedid.split('.')[:3])
+    if event is not None:
+        ot = (event.preferred_origin() or event.origins[0])['time']
+        key = key + '_' + str(ot)
+    return zlib.crc32(key.encode('utf-8')) % n == i - 1
+
+
 def iter_event_data(events, inventory, get_waveforms, phase='P',
-                    request_window=None, pad=10, pbar=None, **kwargs):
+                    request_window=None, pad=10, pbar=None, shard=None,
+                    pairs=None, **kwargs):
     """
     Return iterator yielding three component streams per station and event.
 
@@ -36,6 +58,11 @@ def iter_event_data(events, inventory, get_waveforms, phase='P',
     :param float pad: add specified time in seconds to request window and
        trim afterwards again
     :param pbar: tqdm_ instance for displaying a progressbar
+    :param shard: only yield pairs of event and station of this shard,
+        see `in_shard()`
+    :param pairs: `~rf.pairs.PairTable` instance, the results of
+        `~rf.rfstream.rfstats()` are taken from this table
+        (kwargs for rfstats are ignored)
     :param kwargs: all other kwargs are passed to `~rf.rfstream.rfstats()`
 
     :return: three component streams with raw data
@@ -50,54 +77,104 @@ def iter_event_data(events, inventory, get_waveforms, phase='P',
 
     .. _tqdm: https://pypi.python.org/pypi/tqdm
     """
-    from rf.rfstream import rfstats, RFStream
-    method = phase[-1].upper()
-    if request_window is None:
-        request_window = (-50, 150) if method == 'P' else (-100, 50)
     stations = _get_stations(inventory)
     if pbar is not None:
         pbar.total = len(events) * len(stations)
     for event, seedid in itertools.product(events, stations):
         if pbar is not None:
             pbar.update(1)
-        origin_time = (event.preferred_origin() or event.origins[0])['time']
-        try:
-            args = (seedid[:-1] + stations[seedid], origin_time)
-            coords = inventory.get_coordinates(*args)
-        except:  # station not available at that time
+        if not in_shard(shard, seedid, event):
             continue
-        stats = rfstats(station=coords, event=event, phase=phase, **kwargs)
-        if not stats:
-            continue
-        net, sta, loc, cha = seedid.split('.')
-        starttime = stats.onset + request_window[0]
-        endtime = stats.onset + request_window[1]
-        kws = {'network': net, 'station': sta, 'location': loc,
-               'channel': cha, 'starttime': starttime - pad,
-               'endtime': endtime + pad}
-        try:
+        stream = _get_event_data(
+            event, seedid, stations[seedid], inventory, get_waveforms,
+            phase=phase, request_window=request_window, pad=pad,
+            pairs=pairs, **kwargs)
+        if stream is not None:
+            yield stream
+
+
+def _pair_stats(event, seedid, component, inventory, **kwargs):
+    """
+    Return stats of one event and one station calculated by `rfstats()`.
+
+    Return tuple of stats and None or None and the reason why the pair is
+    rejected ('station not available' or 'distance').
+    """
+    from rf.rfstream import rfstats
+    from rf.instrument import stage
+    origin_time = (event.preferred_origin() or event.origins[0])['time']
+    try:
+        args = (seedid[:-1] + component, origin_time)
+        coords = inventory.get_coordinates(*args)
+    except:  # station not available at that time
+        return None, 'station not available'
+    with stage('rfstats'):
+        stats = rfstats(station=coords, event=event, **kwargs)
+    if not stats:
+        return None, 'distance'
+    return stats, None
+
+
+def _get_event_data(event, seedid, component, inventory, get_waveforms,
+                    phase='P', request_window=None, pad=10, pairs=None,
+                    **kwargs):
+    """
+    Return three component stream of one event and one station.
+
+    See `iter_event_data()`. The seed id ends with '?' instead of the
+    component, the component is used to look up the station coordinates.
+    Return None if no suitable data is available.
+    """
+    from rf.rfstream import RFStream
+    from rf.instrument import stage
+    from rf.timing import reject
+    if request_window is None:
+        method = phase[-1].upper()
+        request_window = (-50, 150) if method == 'P' else (-100, 50)
+    if pairs is not None:
+        stats, reason = pairs.get(event, seedid, component)
+    else:
+        stats, reason = _pair_stats(event, seedid, component, inventory,
+                                    phase=phase, **kwargs)
+    if reason is not None:
+        reject(reason)
+        return
+    net, sta, loc, cha = seedid.split('.')
+    starttime = stats.onset + request_window[0]
+    endtime = stats.onset + request_window[1]
+    kws = {'network': net, 'station': sta, 'location': loc,
+           'channel': cha, 'starttime': starttime - pad,
+           'endtime': endtime + pad}
+    try:
+        with stage('get_waveforms'):
             stream = get_waveforms(**kws)
-        except:  # no data available
-            continue
+    except:  # no data available
+        stream = None
+    if stream is None:
+        reject('no data')
+        return
+    with stage('trim/merge'):
         stream.trim(starttime, endtime)
         stream.merge()
-        if len(stream) != 3:
-            from warnings import warn
-            warn('Need 3 component seismograms. %d components '
-                 'detected for event %s, station %s.'
-                 % (len(stream), event.resource_id, seedid))
-            continue
-        if any(isinstance(tr.data, np.ma.masked_array) for tr in stream):
-            from warnings import warn
-            warn('Gaps or overlaps detected for event %s, station %s.'
-                 % (event.resource_id, seedid))
-            continue
-        for tr in stream:
-            tr.stats.update(stats)
-        yield RFStream(stream)
-
-
-def iter_event_metadata(events, inventory, pbar=None):
+    if len(stream) != 3:
+        from warnings import warn
+        warn('Need 3 component seismograms. %d components '
+             'detected for event %s, station %s.'
+             % (len(stream), event.resource_id, seedid))
+        reject('components')
+        return
+    if any(isinstance(tr.data, np.ma.masked_array) for tr in stream):
+        from warnings import warn
+        warn('Gaps or overlaps detected for event %s, station %s.'
+             % (event.resource_id, seedid))
+        reject('gaps')
+        return
+    for tr in stream:
+        tr.stats.update(stats)
+    return RFStream(stream)
+
+
+def iter_event_metadata(events, inventory, pbar=None, shard=None):
     """
     Return iterator yielding metadata per station and event.
 
@@ -105,6 +182,8 @@ def iter_event_metadata(events, inventory, pbar=None):
     :param inventory: `~obspy.core.inventory.inventory.Inventory` instance
         with station and channel information
     :param pbar: tqdm_ instance for displaying a progressbar
+    :param shard: only yield pairs of event and station of this shard,
+        see `in_shard()`, if events is None stations are partitioned
     """
     stations = _get_stations(inventory)
     if events is None:
@@ -114,6 +193,8 @@ def iter_event_metadata(events, inventory, pbar=None):
     for event, seedid in itertools.product(events, stations):
         if pbar is not None:
             pbar.update(1)
+        if not in_shard(shard, seedid, event):
+            continue
         net, sta, loc, cha = seedid.split('.')
         meta = {'network': net, 'station': sta, 'location': loc,
                 'channel': cha}
@@ -157,6 +238,117 @@ class IterMultipleComponents(object):
             yield s
 
 
+STACK_METHODS = ('mean', 'median', 'trim', 'nroot', 'pws')
+
+
+def stack_array(data, method='mean', weights=None, trim=0.1, nroot=4,
+                power=2):
+    """
+    Stack the rows of a 2-D array in one vectorized pass.
+
+    :param data: array with shape (traces, samples)
+    :param method: 'mean' (weighted mean), 'median', 'trim' (trimmed mean),
+        'nroot' (N-th root stack) or 'pws' (phase-weighted stack,
+        Schimmel and Paulssen 1997)
+    :param weights: weights of the traces with shape (traces,).
+        With shape (stacks, traces) several weighted stacks are calculated at
+        once. Not supported for methods 'median' and 'trim'.
+    :param trim: proportion of values cut off at each end for method 'trim'
+    :param nroot: order of root for method 'nroot'
+    :param power: exponent of the phase stack for method 'pws'
+    :return: stack with shape (samples,) or (stacks, samples)
+    """
+    data = np.asarray(data, dtype=float)
+    if method not in STACK_METHODS:
+        msg = 'method must be one of %s, but is %s'
+        raise ValueError(msg % (STACK_METHODS, method))
+    if method in ('median', 'trim'):
+        if weights is not None:
+            msg = 'weights are not supported by stacking method %s'
+            raise ValueError(msg % method)
+        if method == 'median':
+            return np.median(data, axis=0)
+        n = len(data)
+        cut = int(trim * n)
+        if 2 * cut >= n:
+            msg = 'trim=%s removes all of the %d traces'
+            raise ValueError(msg % (trim, n))
+        data = np.sort(data, axis=0)
+        return np.mean(data[cut:n - cut], axis=0)
+    ndim = 1 if weights is None else np.ndim(weights)
+    if weights is None:
+        weights = np.ones(len(data))
+    weights = np.atleast_2d(np.asarray(weights, dtype=float))
+    norm = weights.sum(axis=1)[:, np.newaxis]
+
+    def wmean(x):
+        return np.dot(weights, x) / norm
+    if method == 'mean':
+        stack = wmean(data)
+    elif method == 'nroot':
+        stack = wmean(np.sign(data) * np.abs(data) ** (1. / nroot))
+        stack = np.sign(stack) * np.abs(stack) ** nroot
+    elif method == 'pws':
+        from scipy.signal import hilbert
+        analytic = hilbert(data, axis=1)
+        amplitude = np.abs(analytic)
+        amplitude[amplitude == 0] = 1
+        coherence = np.abs(wmean(analytic / amplitude)) ** power
+        stack = wmean(data) * coherence
+    return stack[0] if ndim == 1 else stack
+
+
+def bootstrap_array(data, iterations=1000, percentiles=(2.5, 97.5),
+                    method='mean', weights=None, chunksize=100, seed=None,
+                    **kwargs):
+    """
+    Return percentiles of bootstrapped stacks of the rows of a 2-D array.
+
+    The resampling of the traces is expressed by random weights (number of
+    draws of each trace). For each chunk of iterations a matrix with shape
+    (chunksize, traces) is drawn and all bootstrap stacks of the chunk are
+    calculated at once with a matrix multiplication against the data.
+
+    :param data: array with shape (traces, samples)
+    :param iterations: number of bootstrap iterations
+    :param percentiles: percentiles to return
+    :param method: stacking method, one of 'mean', 'nroot', 'pws'
+        (see `stack_array()`)
+    :param weights: weights of the traces with shape (traces,)
+    :param chunksize: number of iterations calculated at once,
+        bounds the used memory
+    :param seed: seed for the random number generator
+    :param kwargs: other kwargs are passed to `stack_array()`
+    :return: array with shape (len(percentiles), samples)
+    """
+    if method in ('median', 'trim'):
+        msg = 'bootstrap is not supported by stacking method %s'
+        raise ValueError(msg % method)
+    data = np.asarray(data, dtype=float)
+    n = len(data)
+    rs = np.random.RandomState(seed)
+    stacks = np.empty((iterations, data.shape[1]))
+    for i in range(0, iterations, chunksize):
+        num = min(chunksize, iterations - i)
+        w = rs.multinomial(n, np.ones(n) / n, size=num).astype(float)
+        if weights is not None:
+            w = w * weights
+        stacks[i:i + num] = stack_array(data, method=method, weights=w,
+                                        **kwargs)
+    return np.percentile(stacks, percentiles, axis=0)
+
+
+def _percentile_traces(trace, data, percentiles):
+    """Return copies of trace with data of the given percentiles."""
+    traces = []
+    for d, p in zip(data, percentiles):
+        tr = trace.copy()
+        tr.data = d.astype(trace.data.dtype, copy=False)
+        tr.stats.percentile = p
+        traces.append(tr)
+    return traces
+
+
 def direct_geodetic(latlon, azi, dist):
     """
     Solve direct geodetic problem with geographiclib.
@@ -203,6 +395,7 @@ def minimal_example_Srf():
     if cache_key in __CACHE:
         return __CACHE[cache_key].copy()
     from rf.rfstream import read_rf, rfstats
+    from pkg_resources import resource_filename
     fname = resource_filename('rf', 'example/minimal_example_S.tar.gz')
     stream = read_rf(fname)
     rfstats(stream, phase='S')